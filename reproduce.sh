@@ -15,6 +15,14 @@ MODEL_NAME="gpt-4-1106-preview"
 
 
 ##################### Run Model (Table 2) #####################
+# The same runs can be executed by a few long-lived workers that share their caches (the workers read the API key
+# from the OPENAI_API_KEY environment variable):
+# OPENAI_API_KEY=${OPENAI_API_KEY} python3 src/experiment_grid.py --grid grids/paper_table_2.json --workers 4 \
+#   --set env_args.fd_py_path=${FD_PY_PATH} --set env_args.val_bin_path=${VAL_BIN_PATH} \
+#   --set wandb_args.entity=${WANDB_ENTITY} --set wandb_args.project=${WANDB_PROJECT}
+# or spread over several nodes through a queue directory on a shared filesystem:
+# python3 src/work_queue.py submit --queue /shared/queue --grid grids/paper_table_2.json --set ...
+# OPENAI_API_KEY=${OPENAI_API_KEY} python3 src/work_queue.py work --queue /shared/queue --node_workers 1   # on each node
 
 for domain_name in "termes" "grippers" "grippers-ood" "hiking-agl14-strips" "floortile" "driverlog" "miconic" "movie"  "childsnack-opt14-strips" "barman"; do
   for seed in "42" "43" "44" "45"; do
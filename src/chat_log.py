@@ -0,0 +1,158 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Append-only, gzip-compressed JSONL log of the LLM conversations of a run. Each message is written once, as a node
+record {"id", "parent", "role", "content"}, and conversations are head records {"conv_id", "head"} pointing at the
+last node of the conversation, so forked conversations share their prefix in the log as in memory. The log is
+flushed after every record, so it can be read back up to the last flushed record even if the run crashed.
+
+Export a log to chat_<id>.json files with: python src/chat_log.py <log_path> --export_dir <dir> [--conv_id <id>]
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import zlib
+from typing import Dict, List
+
+from conversation_tree import ChatNode
+
+
+class ChatLogWriter:
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Appending starts a new gzip member, which readers handle transparently
+        self._next_node_id = self._get_next_node_id(path)
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_next_node_id(path: str) -> int:
+        next_node_id = 0
+        for record in _iter_records(path):
+            if 'id' in record:
+                next_node_id = max(next_node_id, record['id'] + 1)
+        return next_node_id
+
+    def log_head(self, conv_id: str, node: ChatNode):
+        """
+        Writes the records of the not yet logged messages of the conversation, then its new head.
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            new_nodes = []
+            cur_node = node
+            while cur_node is not None and cur_node.log_id is None:
+                new_nodes.append(cur_node)
+                cur_node = cur_node.parent
+            for new_node in reversed(new_nodes):
+                new_node.log_id = self._next_node_id
+                self._next_node_id += 1
+                self._write({
+                    'id': new_node.log_id, 'parent': None if new_node.parent is None else new_node.parent.log_id,
+                    'role': new_node.role, 'content': new_node.content,
+                })
+            self._write({'conv_id': conv_id, 'head': None if node is None else node.log_id})
+            self._file.flush()
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _iter_records(path: str):
+    if not os.path.exists(path):
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            logging.warning(f"The chat log {path} is truncated, reading it up to the last complete record.")
+
+
+def read_chat_log(path: str) -> Dict[str, List[dict]]:
+    """
+    Reconstructs the last state of every conversation in the log.
+    """
+    nodes, heads = {}, {}
+    for record in _iter_records(path):
+        if 'conv_id' in record:
+            heads[record['conv_id']] = record['head']
+        else:
+            nodes[record['id']] = record
+    return {conv_id: _get_messages(nodes, head) for conv_id, head in heads.items()}
+
+
+def read_conversation(path: str, conv_id: str) -> List[dict]:
+    nodes, head, found = {}, None, False
+    for record in _iter_records(path):
+        if 'conv_id' in record:
+            if record['conv_id'] == conv_id:
+                head, found = record['head'], True
+        else:
+            nodes[record['id']] = record
+    if not found:
+        raise KeyError(f"Conversation {conv_id} is not in the chat log {path}")
+    return _get_messages(nodes, head)
+
+
+def _get_messages(nodes: dict, head) -> List[dict]:
+    messages = []
+    while head is not None:
+        node = nodes[head]
+        messages.append({'role': node['role'], 'content': node['content']})
+        head = node['parent']
+    return messages[::-1]
+
+
+def load_chats(chats_path: str) -> Dict[str, List[dict]]:
+    """
+    Loads the conversations of a chat log, or of a directory of chat_<id>.json files.
+    """
+    if os.path.isfile(chats_path):
+        return read_chat_log(chats_path)
+    chats = {}
+    for f_name in sorted(glob.glob(os.path.join(chats_path, "chat_*.json"))):
+        with open(f_name, 'r') as f:
+            chats[os.path.basename(f_name)[len("chat_"):-len(".json")]] = json.load(f)
+    return chats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export conversations from a chat log to chat_<id>.json files.")
+    parser.add_argument('log_path')
+    parser.add_argument('--export_dir', required=True)
+    parser.add_argument('--conv_id', default=None, help="Only export this conversation.")
+    args = parser.parse_args()
+    if args.conv_id is not None:
+        chats = {args.conv_id: read_conversation(args.log_path, args.conv_id)}
+    else:
+        chats = read_chat_log(args.log_path)
+    os.makedirs(args.export_dir, exist_ok=True)
+    for conv_id, chat in chats.items():
+        with open(os.path.join(args.export_dir, f"chat_{conv_id}.json"), 'w') as f:
+            json.dump(chat, f)
+    print(f"Exported {len(chats)} conversations to {args.export_dir}")
+
+
+if __name__ == '__main__':
+    main()
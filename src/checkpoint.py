@@ -0,0 +1,84 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Incremental checkpoints of a run, so that a crashed or interrupted run can be resumed (cfg.resume) without
+re-issuing the LLM calls and planner runs it already completed. The checkpoint is one JSON file, rewritten atomically
+after each refinement turn and each evaluated task.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from concurrency import get_rng
+
+
+def atomic_write_json(path: str, obj):
+    """
+    Writes obj to path through a temporary file and a rename, so that readers never see a partially written file.
+    """
+    temp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(temp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def get_rng_state():
+    """
+    State of the random number generator of the current job (see concurrency.get_rng), as JSON-serializable lists.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = get_rng().get_state()
+    return [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+
+
+def set_rng_state(rng_state):
+    name, keys, pos, has_gauss, cached_gaussian = rng_state
+    get_rng().set_state((name, keys, pos, has_gauss, cached_gaussian))
+
+
+class RunCheckpoint:
+    """
+    Key-value state of a run. Each update saves the whole state together with the token counters of the GPT client,
+    which are restored when a checkpoint is loaded.
+    """
+
+    def __init__(self, path: str, gpt_client, resume: bool = False):
+        self.path = path
+        self.gpt_client = gpt_client
+        self.state = {}
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.state = json.load(f)
+            gpt_client.restore_counters(self.state.get('gpt_counters', {}))
+            logging.info(f"Resuming from the checkpoint {path} with keys {sorted(self.state.keys())}")
+        elif resume:
+            logging.warning(f"No checkpoint found at {path}, starting the run from scratch.")
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self.state.get(key, default)
+
+    def update(self, key: str, value):
+        with self._lock:
+            self.state[key] = value
+            self.state['gpt_counters'] = self.gpt_client.get_counters()
+            atomic_write_json(self.path, self.state)
+
+    def update_item(self, key: str, index: int, value, length: int):
+        """
+        Sets one item of a list of the state (e.g. the result of one task), which is created with the given length.
+        """
+        with self._lock:
+            items = self.state.setdefault(key, [None] * length)
+            items[index] = value
+            self.state['gpt_counters'] = self.gpt_client.get_counters()
+            atomic_write_json(self.path, self.state)
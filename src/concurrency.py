@@ -0,0 +1,156 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Helpers to run parts of the pipeline concurrently in threads: cooperative cancellation of LLM requests, planner
+subprocesses and random walks, and per-job random number generators so that results do not depend on scheduling.
+Both are carried by context variables, which submit_in_context passes on to worker threads.
+"""
+
+import contextlib
+import contextvars
+import os
+import signal
+import subprocess
+import threading
+from concurrent.futures import Executor, Future, TimeoutError as FutureTimeoutError
+from typing import List
+
+import numpy as np
+
+POLL_INTERVAL_SECONDS = 0.1
+
+_CANCEL_TOKEN = contextvars.ContextVar('cancel_token', default=None)
+_RNG = contextvars.ContextVar('rng', default=None)
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """
+    Cancellation flag shared by the jobs of one unit of work. Cancelling a token also cancels its children.
+    """
+
+    def __init__(self, parent: 'CancelToken' = None):
+        self.parent = parent
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+
+def get_cancel_token():
+    return _CANCEL_TOKEN.get()
+
+
+def new_child_token() -> CancelToken:
+    return CancelToken(parent=get_cancel_token())
+
+
+def is_cancelled() -> bool:
+    token = _CANCEL_TOKEN.get()
+    return token is not None and token.cancelled
+
+
+def raise_if_cancelled():
+    if is_cancelled():
+        raise OperationCancelled()
+
+
+@contextlib.contextmanager
+def cancel_scope(token: CancelToken):
+    reset_token = _CANCEL_TOKEN.set(token)
+    try:
+        yield token
+    finally:
+        _CANCEL_TOKEN.reset(reset_token)
+
+
+def get_rng():
+    """
+    Random number generator of the current job, or the global numpy one outside of an rng_scope.
+    """
+    rng = _RNG.get()
+    return np.random if rng is None else rng
+
+
+@contextlib.contextmanager
+def rng_scope(seed: int):
+    reset_token = _RNG.set(np.random.RandomState(seed))
+    try:
+        yield
+    finally:
+        _RNG.reset(reset_token)
+
+
+def spawn_seeds(n: int) -> List[int]:
+    """
+    Seeds for n jobs, drawn from the current generator before the jobs are started, so they do not depend on the
+    order in which the jobs run.
+    """
+    return [int(seed) for seed in get_rng().randint(2 ** 31 - 1, size=n)]
+
+
+def submit_in_context(executor: Executor, fn, *args, **kwargs) -> Future:
+    """
+    Submits fn to the executor so that it runs with the caller's cancel token and random number generator.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+
+def wait_for_future(future: Future):
+    """
+    Waits for a future of another thread or event loop, and cancels it if the current job is cancelled.
+    """
+    while True:
+        if is_cancelled():
+            future.cancel()
+            raise OperationCancelled()
+        try:
+            return future.result(timeout=POLL_INTERVAL_SECONDS)
+        except FutureTimeoutError:
+            continue
+
+
+def run_subprocess(args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run with captured text output, which kills the process and its children (e.g. the planner's search
+    process started by its driver script) if the current job is cancelled.
+    """
+    with subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, start_new_session=True, **kwargs
+    ) as process:
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=POLL_INTERVAL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                if is_cancelled():
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.communicate()
+                    raise OperationCancelled()
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def join_process(process):
+    """
+    Joins a multiprocessing.Process, and kills it if the current job is cancelled.
+    """
+    while process.is_alive():
+        if is_cancelled():
+            process.kill()
+            process.join()
+            raise OperationCancelled()
+        process.join(timeout=POLL_INTERVAL_SECONDS)
+    process.join()
@@ -0,0 +1,141 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, List
+
+
+class ChatNode:
+    """
+    Immutable message node. A conversation is the path from a node to the root, so forked conversations share
+    their common prefix. log_id is set once the node has been written to a chat log (see chat_log.py).
+    """
+    __slots__ = ('role', 'content', 'parent', 'depth', 'log_id')
+
+    def __init__(self, role: str, content: str, parent: 'ChatNode' = None):
+        self.role = role
+        self.content = content
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.log_id = None
+
+    def to_messages(self) -> List[dict]:
+        messages = [None] * (self.depth + 1)
+        node = self
+        while node is not None:
+            messages[node.depth] = {'role': node.role, 'content': node.content}
+            node = node.parent
+        return messages
+
+
+class ConversationTree:
+    """
+    Maps conversation ids to the last node of their conversation. Nodes only point to their parent, so a branch is
+    freed as soon as no conversation id points into it (see release).
+    """
+
+    def __init__(self):
+        self.heads: Dict[str, ChatNode] = {}
+
+    def __contains__(self, conv_id):
+        return conv_id in self.heads
+
+    def __len__(self):
+        return len(self.heads)
+
+    def new_conversation(self, conv_id: str, messages: List[dict]):
+        self.heads[conv_id] = None
+        self.extend(conv_id, messages)
+
+    def extend(self, conv_id: str, messages: List[dict]):
+        node = self.heads[conv_id]
+        for message in messages:
+            node = ChatNode(message['role'], message['content'], node)
+        self.heads[conv_id] = node
+
+    def fork(self, conv_id: str, new_conv_ids: Iterable[str]):
+        for new_conv_id in new_conv_ids:
+            self.heads[new_conv_id] = self.heads[conv_id]
+
+    def get_head(self, conv_id: str) -> ChatNode:
+        return self.heads[conv_id]
+
+    def get_messages(self, conv_id: str) -> List[dict]:
+        node = self.heads[conv_id]
+        return [] if node is None else node.to_messages()
+
+    def release(self, conv_ids: Iterable[str]):
+        for conv_id in conv_ids:
+            self.heads.pop(conv_id, None)
+
+    def conv_ids(self) -> List[str]:
+        return list(self.heads.keys())
+
+    def count_nodes(self) -> int:
+        """
+        Number of distinct message nodes reachable from the conversations.
+        """
+        seen = set()
+        for node in self.heads.values():
+            while node is not None and id(node) not in seen:
+                seen.add(id(node))
+                node = node.parent
+        return len(seen)
+
+
+@dataclass
+class HistoryPolicy:
+    """
+    Which part of a conversation is sent to the model. The first n_prefix_messages (e.g. the system message and the
+    initial prompt) and the last keep_last_turns turns (assistant reply and user follow-up) before the current user
+    message are always sent. Older turns are
+        full: sent as they are.
+        window: replaced by a short note.
+        summary: collapsed into a compact summary made of the code of each reply and the start of each follow-up.
+    The full conversation is still kept in the conversation tree and the chat log.
+    """
+    mode: str = 'full'
+    keep_last_turns: int = 1
+    n_prefix_messages: int = 2
+    max_feedback_chars: int = 300
+
+    MODES = ('full', 'window', 'summary')
+    OMITTED_NOTE = "(Earlier attempts are omitted, the latest state is given in the next message.)"
+
+    def __post_init__(self):
+        assert self.mode in self.MODES, f"Unknown history policy: {self.mode}"
+
+    def apply(self, messages: List[dict]) -> List[dict]:
+        # The dropped span starts with an assistant reply and ends with one, so that roles keep alternating once it
+        # is replaced by a single assistant message
+        n_kept_suffix = 2 * self.keep_last_turns + 1
+        if self.mode == 'full' or len(messages) <= self.n_prefix_messages + n_kept_suffix + 1:
+            return messages
+        dropped = messages[self.n_prefix_messages:-n_kept_suffix]
+        if self.mode == 'window':
+            content = self.OMITTED_NOTE
+        else:
+            content = self._summarize(dropped)
+        return messages[:self.n_prefix_messages] + [{'role': 'assistant', 'content': content}] + \
+            messages[-n_kept_suffix:]
+
+    def _summarize(self, messages: List[dict]) -> str:
+        lines = ["Summary of my earlier attempts:"]
+        attempt = 0
+        for message in messages:
+            if message['role'] == 'assistant':
+                attempt += 1
+                code_blocks = re.findall(r"```(?:python)?\n(.*?)```", message['content'], re.DOTALL)
+                code = code_blocks[-1].strip() if len(code_blocks) > 0 else "(no code)"
+                lines.append(f"Attempt {attempt}:\n```python\n{code}\n```")
+            else:
+                feedback = message['content'].split("```")[0].strip()
+                if len(feedback) > self.max_feedback_chars:
+                    feedback = feedback[:self.max_feedback_chars] + "..."
+                lines.append(f"Feedback: {feedback}")
+        return "\n".join(lines)
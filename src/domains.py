@@ -6,11 +6,14 @@
 #
 
 import os
+import threading
 import numpy as np
 
+from concurrency import get_rng, run_subprocess
+from grounding import ground_problems, GroundedTask
+from resource_scheduler import acquire_resources
 from pddl_utils import get_problem_pddl_empty_goal, extract_atom_arguments
 from utils import postprocess, safe_function_execute
-import subprocess
 from utils import get_random_temp_file_name, read_and_remove_file, as_file
 import logging
 from typing import List
@@ -109,47 +112,123 @@ class Domain:
         return self.get_task(i)[2]
 
 
+_PDDL_ENVS = {}
+_PDDL_ENVS_LOCK = threading.Lock()
+
+
+def get_pddl_env(**env_args) -> 'PDDLEnv':
+    """
+    Process-wide PDDLEnv per configuration, so that the runs of one process (see experiment_grid.py) share its SAS
+    cache.
+    """
+    key = tuple(sorted(env_args.items()))
+    with _PDDL_ENVS_LOCK:
+        if key not in _PDDL_ENVS:
+            _PDDL_ENVS[key] = PDDLEnv(**env_args)
+        return _PDDL_ENVS[key]
+
+
 class PDDLEnv:
     OPTIMAL_ALIAS = "seq-opt-fdss-1"
     SUB_OPTIMAL_ALIAS = "lama-first"
+    MAX_SAS_CACHE_SIZE = 256
+    # Memory reserved from the resource scheduler by each planner search (when it has no memory limit), each plan
+    # validation and each random walk or grounding process
+    SEARCH_MEMORY_MB = 4096
+    VALIDATE_MEMORY_MB = 256
+    SUBPROCESS_MEMORY_MB = 512
+    # Exit codes of fast downward when the search ran out of memory, or of memory and time
+    FD_OUT_OF_MEMORY_EXIT_CODES = (22, 24)
 
     def __init__(
-            self, fd_py_path: str, val_bin_path: str, fd_search_time_limit: int, fd_alias: str = SUB_OPTIMAL_ALIAS
+            self, fd_py_path: str, val_bin_path: str, fd_search_time_limit: int, fd_alias: str = SUB_OPTIMAL_ALIAS,
+            fd_search_memory_limit_mb: int = 0
     ) -> None:
         self.fd_py_path = fd_py_path
         self.fd_search_time_limit = fd_search_time_limit
+        self.fd_search_memory_limit_mb = fd_search_memory_limit_mb
         self.val_bin_path = val_bin_path
         self.fd_alias = fd_alias
+        self.sas_cache = {}
+        self._sas_cache_lock = threading.Lock()  # Tasks are evaluated from several threads
+
+    def get_config_key(self) -> tuple:
+        """
+        The settings that affect the plans found and the walks executed, e.g. to key memoized ratings.
+        """
+        return (
+            self.fd_py_path, self.val_bin_path, self.fd_search_time_limit, self.fd_alias,
+            self.fd_search_memory_limit_mb
+        )
+
+    def ground_tasks(self, domain_pddl: str, problem_pddls: List[str], n_workers: int = None) -> List[GroundedTask]:
+        """
+        Grounds all problems against the domain at once (in parallel) and caches the SAS translations of their
+        empty-goal variants, which are used by the random walks and plan execution.
+        """
+        n_workers = os.cpu_count() if n_workers is None else n_workers
+        empty_goal_problem_pddls = [get_problem_pddl_empty_goal(problem_pddl) for problem_pddl in problem_pddls]
+        # Looked up once, since other threads may evict cached tasks at any time
+        with self._sas_cache_lock:
+            grounded_tasks = {
+                problem_pddl: self.sas_cache.get((domain_pddl, problem_pddl))
+                for problem_pddl in empty_goal_problem_pddls
+            }
+        missing_problem_pddls = [problem_pddl for problem_pddl, task in grounded_tasks.items() if task is None]
+        if len(missing_problem_pddls) > 0:
+            n_workers = max(1, min(n_workers, len(missing_problem_pddls)))
+            with acquire_resources(cores=n_workers, memory_mb=n_workers * self.SUBPROCESS_MEMORY_MB):
+                for grounded_task in ground_problems(domain_pddl, missing_problem_pddls, n_workers=n_workers):
+                    self._cache_sas(domain_pddl, grounded_task)
+                    grounded_tasks[grounded_task.problem_pddl] = grounded_task
+        return [grounded_tasks[problem_pddl] for problem_pddl in empty_goal_problem_pddls]
+
+    def _get_sas(self, domain_pddl: str, empty_goal_problem_pddl: str):
+        key = (domain_pddl, empty_goal_problem_pddl)
+        grounded_task = self.sas_cache.get(key)
+        if grounded_task is None:
+            with acquire_resources(cores=1, memory_mb=self.SUBPROCESS_MEMORY_MB):
+                grounded_task, = ground_problems(domain_pddl, [empty_goal_problem_pddl])
+            self._cache_sas(domain_pddl, grounded_task)
+        return grounded_task.sas
+
+    def _cache_sas(self, domain_pddl: str, grounded_task: GroundedTask):
+        with self._sas_cache_lock:
+            if len(self.sas_cache) >= self.MAX_SAS_CACHE_SIZE:
+                self.sas_cache.pop(next(iter(self.sas_cache)), None)
+            self.sas_cache[(domain_pddl, grounded_task.problem_pddl)] = grounded_task
 
     def search_plan(self, domain_pddl: str, problem_pddl: str):
         domain_pddl_path = as_file(domain_pddl)
         problem_pddl_path = as_file(problem_pddl)
         temp_plan_path = get_random_temp_file_name()
         temp_sas_path = get_random_temp_file_name()
-        output = subprocess.run(
-            [
-                "python3",
-                self.fd_py_path,
-                "--alias",
-                self.fd_alias,
-                "--search-time-limit",
-                f"{self.fd_search_time_limit}",
-                "--plan-file",
-                temp_plan_path,
-                "--sas-file",
-                temp_sas_path,
-                domain_pddl_path,
-                problem_pddl_path
-            ],
-            capture_output=True,
-            text=True,
-            universal_newlines=True,
-        )
+        memory_limit_args = []
+        if self.fd_search_memory_limit_mb > 0:
+            memory_limit_args = ["--search-memory-limit", f"{self.fd_search_memory_limit_mb}M"]
+        try:
+            with acquire_resources(cores=1, memory_mb=self.fd_search_memory_limit_mb or self.SEARCH_MEMORY_MB):
+                output = run_subprocess([
+                    "python3",
+                    self.fd_py_path,
+                    "--alias",
+                    self.fd_alias,
+                    "--search-time-limit",
+                    f"{self.fd_search_time_limit}",
+                    *memory_limit_args,
+                    "--plan-file",
+                    temp_plan_path,
+                    "--sas-file",
+                    temp_sas_path,
+                    domain_pddl_path,
+                    problem_pddl_path
+                ])
+        finally:
+            read_and_remove_file(domain_pddl_path)
+            read_and_remove_file(problem_pddl_path)
 
         search_output = output.stdout
         search_error = output.stderr
-        read_and_remove_file(domain_pddl_path)
-        read_and_remove_file(problem_pddl_path)
         if "Solution found." in search_output:
             plan = postprocess(read_and_remove_file(temp_plan_path))
             return plan, True, "Solution found."
@@ -157,6 +236,8 @@ class PDDLEnv:
             return None, True, "Generated PDDL domain is valid, but plan search stopped without finding a solution."
         elif "Time limit has been reached." in search_output:
             return None, True, "Generated PDDL domain is valid, but search Time limit has been reached."
+        elif output.returncode in self.FD_OUT_OF_MEMORY_EXIT_CODES:
+            return None, True, "Generated PDDL domain is valid, but search memory limit has been reached."
         else:
             return None, False, search_error
 
@@ -164,42 +245,45 @@ class PDDLEnv:
         domain_pddl_path = as_file(domain_pddl)
         problem_pddl_path = as_file(problem_pddl)
         plan_file = as_file(plan)
-        val_output = subprocess.run(
-            [
-                self.val_bin_path,
-                "-v",
-                domain_pddl_path,
-                problem_pddl_path,
-                plan_file
-            ],
-            capture_output=True,
-            text=True,
-            universal_newlines=True,
-        )
-        read_and_remove_file(domain_pddl_path)
-        read_and_remove_file(problem_pddl_path)
+        try:
+            with acquire_resources(cores=1, memory_mb=self.VALIDATE_MEMORY_MB):
+                val_output = run_subprocess([
+                    self.val_bin_path,
+                    "-v",
+                    domain_pddl_path,
+                    problem_pddl_path,
+                    plan_file
+                ])
+        finally:
+            read_and_remove_file(domain_pddl_path)
+            read_and_remove_file(problem_pddl_path)
         is_valid, val_message = self._parse_val_output(val_output.stdout)
         return is_valid, val_message
 
     def get_random_walk_plan(
             self, domain_pddl: str, problem_pddl: str, predicate_descriptor_fn, max_steps: int
     ):
-        seed = np.random.randint(2 ** 32 - 1)
+        seed = get_rng().randint(2 ** 32 - 1)
+        # Parse and ground the problem once here, instead of in every walk subprocess
+        problem_pddl = get_problem_pddl_empty_goal(problem_pddl)
+        sas = self._get_sas(domain_pddl, problem_pddl)
         while True:
-            func_result = safe_function_execute(
-                self._get_random_walk_plan, domain_pddl, problem_pddl, predicate_descriptor_fn, max_steps, seed
-            )
+            with acquire_resources(cores=1, memory_mb=self.SUBPROCESS_MEMORY_MB):
+                func_result = safe_function_execute(
+                    self._get_random_walk_plan, domain_pddl, problem_pddl, predicate_descriptor_fn, max_steps, seed,
+                    sas
+                )
             if func_result is not None:
                 plan, state_descs = func_result
                 return plan, state_descs
 
     def _get_random_walk_plan(
-            self, domain_pddl: str, problem_pddl: str, predicate_descriptor_fn, max_steps: int, seed
+            self, domain_pddl: str, problem_pddl: str, predicate_descriptor_fn, max_steps: int, seed, sas=None
     ):
         rng = np.random.default_rng(seed)
-        problem_pddl = get_problem_pddl_empty_goal(problem_pddl)
         lib = fast_downward.load_lib()
-        task, sas = fast_downward.pddl2sas(domain_pddl, problem_pddl)
+        if sas is None:
+            task, sas = fast_downward.pddl2sas(domain_pddl, problem_pddl)
         lib.load_sas(sas.encode('utf-8'))
 
         plan, state_descs = [], []
@@ -223,20 +307,25 @@ class PDDLEnv:
             self, domain_pddl: str, problem_pddl: str, plan: List[str], state_descs,
             predicate_descriptor_fn
     ):
+        problem_pddl = get_problem_pddl_empty_goal(problem_pddl)
+        sas = self._get_sas(domain_pddl, problem_pddl)
         while True:
-            feedback = safe_function_execute(
-                self._get_plan_execution_feedback, domain_pddl, problem_pddl, plan, state_descs, predicate_descriptor_fn
-            )
+            with acquire_resources(cores=1, memory_mb=self.SUBPROCESS_MEMORY_MB):
+                feedback = safe_function_execute(
+                    self._get_plan_execution_feedback, domain_pddl, problem_pddl, plan, state_descs,
+                    predicate_descriptor_fn, sas
+                )
             if feedback is not None:
                 return feedback
 
     def _get_plan_execution_feedback(
-            self, domain_pddl: str, problem_pddl: str, plan: List[str], state_descs: List[str], predicate_descriptor_fn
+            self, domain_pddl: str, problem_pddl: str, plan: List[str], state_descs: List[str], predicate_descriptor_fn,
+            sas=None
     ):
         assert state_descs is not None or predicate_descriptor_fn is not None, "Either state_descs or predicate_descriptor_fn must be provided."
-        problem_pddl = get_problem_pddl_empty_goal(problem_pddl)
         lib = fast_downward.load_lib()
-        task, sas = fast_downward.pddl2sas(domain_pddl, problem_pddl)
+        if sas is None:
+            task, sas = fast_downward.pddl2sas(domain_pddl, problem_pddl)
         lib.load_sas(sas.encode('utf-8'))
         plan_so_far = []
         feedback = "The plan is executable."
@@ -5,16 +5,23 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import hashlib
+import json
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import Union
+from typing import List, Union
 
 from ml_collections import config_dict
 from tqdm import tqdm
 
+from concurrency import OperationCancelled, cancel_scope, new_child_token, raise_if_cancelled, rng_scope, \
+    submit_in_context
 from domains import PDDLEnv
 import error_messages
-from pddl_utils import PDDLObj
+from pddl_utils import PDDLObj, canonical_domain_str
 from utils import extract_code, get_function_from_code, harmonic_mean
 
 
@@ -36,11 +43,57 @@ class PlanningEvaluation:
     solution_found: bool = False
 
 
+class RatingMemo:
+    """
+    Memo of domain ratings shared by the evaluators of a run, so that duplicate best-of-n completions, or the same
+    domain reappearing in later turns or candidates, are rated once. The least recently used ratings are evicted
+    beyond max_size.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._ratings = OrderedDict()
+        self._lock = threading.Lock()  # Domains are rated from several threads
+
+    def get(self, key):
+        with self._lock:
+            value = self._ratings.get(key)
+            if value is not None:
+                self._ratings.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._ratings[key] = value
+            self._ratings.move_to_end(key)
+            while len(self._ratings) > self.max_size:
+                self._ratings.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ratings)
+
+
+_SHARED_RATING_MEMO = None
+_SHARED_RATING_MEMO_LOCK = threading.Lock()
+
+
+def get_shared_rating_memo(max_size: int = 4096) -> RatingMemo:
+    """
+    Process-wide memo, for the runs of an experiment grid worker that opt into reusing each other's ratings.
+    """
+    global _SHARED_RATING_MEMO
+    with _SHARED_RATING_MEMO_LOCK:
+        if _SHARED_RATING_MEMO is None:
+            _SHARED_RATING_MEMO = RatingMemo(max_size)
+        return _SHARED_RATING_MEMO
+
+
 class PlanningEvaluator:
     def __init__(
             self, env: PDDLEnv, target_domain_pddl: str, target_problem_pddl: str, target_gen_problem_pddl: str,
             rw_feedback: bool, predicate_descriptor_py: str, exp_flags: config_dict.ConfigDict,
-            bi_rw_feedback: bool = True,
+            bi_rw_feedback: bool = True, rating_memo: Union[RatingMemo, None] = None, seed: int = 0,
     ):
         self.env = env
         self.rw_feedback = rw_feedback
@@ -50,20 +103,134 @@ class PlanningEvaluator:
         self.target_gen_problem_pddl = target_gen_problem_pddl
         self.exp_flags = exp_flags
         self.predicate_descriptor_fn = get_function_from_code(predicate_descriptor_py, 'describe_predicate')
+        self.rating_memo = RatingMemo() if rating_memo is None else rating_memo
+        self.seed = seed
 
     def rate_domain_modification(self, cur_pddl_obj: PDDLObj, gpt_output: str) -> PlanningEvaluation:
+        new_pddl_obj, planning_evaluation = self._apply_domain_modification(cur_pddl_obj, gpt_output)
+        if planning_evaluation is not None:
+            return planning_evaluation
+        return self.rate_domain(new_pddl_obj)
+
+    def rate_domain_modifications(
+            self, cur_pddl_obj: Union[PDDLObj, List[PDDLObj]], gpt_outputs: List[str], n_workers: int = 1,
+            stop_at_solution: bool = False, on_evaluation=None
+    ) -> List[Union[PlanningEvaluation, None]]:
+        """
+        Rates several completions, with up to n_workers domains rated concurrently. The completions modify
+        cur_pddl_obj, or each the domain at its index if it is a list. The modifications are applied first, so
+        completions that result in the same domain are rated once. With stop_at_solution, once a completion is rated
+        SOLUTION_FOUND, the completions after it are not rated (or their ratings are cancelled), and their evaluations
+        are None. on_evaluation(i, evaluation) is called in the calling thread as soon as each evaluation is known.
+        """
+        n = len(gpt_outputs)
+        cur_pddl_objs = cur_pddl_obj if isinstance(cur_pddl_obj, list) else [cur_pddl_obj] * n
+        assert len(cur_pddl_objs) == n
+        evaluations = [None] * n
+        if n_workers <= 1:
+            for i in range(n):
+                evaluations[i] = self.rate_domain_modification(cur_pddl_objs[i], gpt_outputs[i])
+                if on_evaluation is not None:
+                    on_evaluation(i, evaluations[i])
+                if stop_at_solution and evaluations[i].solution_found:
+                    break
+            return evaluations
+
+        # Group the completions to rate by their resulting domain, in order of first occurrence
+        new_pddl_objs, indices_by_key = [None] * n, {}
+        for i in range(n):
+            new_pddl_objs[i], evaluations[i] = self._apply_domain_modification(cur_pddl_objs[i], gpt_outputs[i])
+            if evaluations[i] is None:
+                indices_by_key.setdefault(self._get_memo_key(new_pddl_objs[i].to_str()), []).append(i)
+            elif on_evaluation is not None:
+                on_evaluation(i, evaluations[i])
+        group_indices = list(indices_by_key.values())
+        cancel_tokens = [new_child_token() for _ in group_indices]
+        first_solved_idx = n
+
+        def rate_group(g):
+            with cancel_scope(cancel_tokens[g]):
+                return self.rate_domain(new_pddl_objs[group_indices[g][0]])
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {submit_in_context(executor, rate_group, g): g for g in range(len(group_indices))}
+            for future in as_completed(futures):
+                g = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    group_evaluation = future.result()
+                except OperationCancelled:
+                    continue
+                except Exception:
+                    for cancel_token in cancel_tokens:
+                        cancel_token.cancel()
+                    raise
+                for i in group_indices[g]:
+                    evaluations[i] = PlanningEvaluation(
+                        group_evaluation.rating, group_evaluation.error_msg, new_pddl_objs[i],
+                        solution_found=group_evaluation.solution_found
+                    )
+                if stop_at_solution and group_evaluation.solution_found and group_indices[g][0] < first_solved_idx:
+                    first_solved_idx = group_indices[g][0]
+                    for other_future, other_g in futures.items():
+                        if group_indices[other_g][0] > first_solved_idx:
+                            cancel_tokens[other_g].cancel()
+                            other_future.cancel()
+                if on_evaluation is not None:
+                    for i in group_indices[g]:
+                        if i <= first_solved_idx:
+                            on_evaluation(i, evaluations[i])
+        raise_if_cancelled()
+        # Completions after the first solution are dropped whether or not their rating finished in time
+        return evaluations[:first_solved_idx + 1] + [None] * (n - first_solved_idx - 1)
+
+    def _apply_domain_modification(self, cur_pddl_obj: PDDLObj, gpt_output: str):
+        """
+        Returns the modified domain, and its evaluation if the modification failed (None otherwise).
+        """
         new_pddl_obj = cur_pddl_obj.copy_object()
         func_modification, err_msg = self._try_extracting_python_code(gpt_output)
         if err_msg is not None:
-            return PlanningEvaluation(rating=PlanRatings.EMPTY_CODE, error_msg=err_msg, new_pddl_obj=new_pddl_obj)
+            return new_pddl_obj, PlanningEvaluation(
+                rating=PlanRatings.EMPTY_CODE, error_msg=err_msg, new_pddl_obj=new_pddl_obj
+            )
         error_msg = new_pddl_obj.modify_domain(func_modification)
         if error_msg is not None:
-            return PlanningEvaluation(
+            return new_pddl_obj, PlanningEvaluation(
                 rating=PlanRatings.INVALID_MODIFICATION, error_msg=error_msg, new_pddl_obj=new_pddl_obj
             )
-        return self.rate_domain(new_pddl_obj)
+        return new_pddl_obj, None
 
     def rate_domain(self, pddl_obj) -> PlanningEvaluation:
+        """
+        Rates the domain with random walks drawn from a generator seeded by the memo key, so that the rating is the
+        same whether it is computed or found in the memo, and does not consume the caller's random numbers.
+        """
+        memo_key = self._get_memo_key(pddl_obj.to_str())
+        memo_value = self.rating_memo.get(memo_key)
+        if memo_value is not None:
+            rating, err_msg, solution_found = memo_value
+            logging.info(f"Found the domain rating in the memo: {rating}")
+            return PlanningEvaluation(rating, err_msg, pddl_obj, solution_found=solution_found)
+        key_hash = hashlib.sha256(json.dumps(memo_key).encode()).digest()
+        with rng_scope(int.from_bytes(key_hash[:4], 'little')):
+            planning_evaluation = self._rate_domain(pddl_obj)
+        self.rating_memo.put(memo_key, (
+            planning_evaluation.rating, planning_evaluation.error_msg, planning_evaluation.solution_found
+        ))
+        return planning_evaluation
+
+    def _get_memo_key(self, gen_pddl_str: str):
+        # Every input of the rating: the domain, the task, the planner and walk settings and the run seed
+        exp_flags = json.dumps(self.exp_flags.to_dict(), sort_keys=True) if self.exp_flags is not None else None
+        return (
+            canonical_domain_str(gen_pddl_str), self.target_gen_problem_pddl, self.target_domain_pddl,
+            self.target_problem_pddl, self.rw_feedback, self.bi_rw_feedback, self.env.get_config_key(), exp_flags,
+            self.seed
+        )
+
+    def _rate_domain(self, pddl_obj) -> PlanningEvaluation:
         err_msg = pddl_obj.sanity_check_domain()
         gen_pddl_str = pddl_obj.to_str()
         if err_msg is not None:
@@ -161,9 +328,11 @@ class PlanningEvaluator:
         return None
 
     def evaluate_generated_domain_with_random_walks(
-            self, domain_gen_pddl: str
+            self, domain_gen_pddl: str, is_domain_valid: bool = None
     ):
-        gen_plan, is_domain_valid, error_msg = self.env.search_plan(domain_gen_pddl, self.target_gen_problem_pddl)
+        # is_domain_valid can be passed by callers that already searched a plan for the generated problem
+        if is_domain_valid is None:
+            _, is_domain_valid, _ = self.env.search_plan(domain_gen_pddl, self.target_gen_problem_pddl)
         if not is_domain_valid:
             return PlanRatings.INVALID_DOMAIN, 0, 0
         exec_cnt, all_cnt = 0, 0
@@ -0,0 +1,190 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Runs a grid of experiments (e.g. domains x seeds x method variants) in a few long-lived worker processes instead of
+one process per run. The runs of a worker share the imports, the PDDLEnv SAS caches and the LLM response cache, and
+each run writes its summary_logs.json exactly as a standalone run does. With --share_rating_memo, the runs of a worker
+also reuse the ratings of earlier runs with the same domain, task, planner settings and seed.
+
+A grid spec is a JSON file:
+{
+    "base": {"gpt_args.model_name": "gpt-4-1106-preview", "env_args.fd_py_path": "..."},
+    "axes": {"target_domain_name": ["termes", "grippers"], "seed": [42, 43]},
+    "variants": [
+        {"script": "main", "log_prefix": "paper_table_2/{target_domain_name}/gpt4-old-top1-trans1"},
+        {"script": "intrinsic_planning", "log_prefix": "paper_table_2/{target_domain_name}/intrinsic-gpt4"}
+    ]
+}
+Each run applies the base, then one value of each axis, then one variant, as dotted overrides of the get_config()
+of its script ("main" by default). String values are formatted with the axis values.
+
+OPENAI_API_KEY=<key> python src/experiment_grid.py --grid grid.json --workers 2
+
+Unless gpt_args.api_key is overridden, the runs read the API key from the OPENAI_API_KEY environment variable.
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import traceback
+from typing import List, Tuple
+
+from ml_collections import ConfigDict
+
+from resource_scheduler import get_machine_capacities
+
+SCRIPTS = ('main', 'intrinsic_planning')
+
+
+def expand_grid(grid: dict) -> List[Tuple[str, dict]]:
+    """
+    Returns the (script, overrides) of each run of the grid, in the order of the axes, then of the variants.
+    """
+    axes = grid.get('axes', {})
+    runs = []
+    for axis_values in itertools.product(*axes.values()):
+        axis_overrides = dict(zip(axes.keys(), axis_values))
+        for variant in grid.get('variants', [{}]):
+            overrides = {**grid.get('base', {}), **axis_overrides, **variant}
+            script = overrides.pop('script', 'main')
+            if script not in SCRIPTS:
+                raise ValueError(f"Unknown script {script}, expected one of {SCRIPTS}")
+            overrides = {
+                key: value.format(**axis_overrides) if isinstance(value, str) else value
+                for key, value in overrides.items()
+            }
+            runs.append((script, overrides))
+    return runs
+
+
+def build_config(script: str, overrides: dict) -> ConfigDict:
+    cfg = importlib.import_module(script).get_config()
+    for key, value in overrides.items():
+        node = cfg
+        *parent_keys, leaf_key = key.split('.')
+        for parent_key in parent_keys:
+            node = node[parent_key]
+        if leaf_key not in node:
+            raise KeyError(f"Unknown config key {key} for {script}")
+        node[leaf_key] = value
+    return cfg
+
+
+def parse_overrides(assignments: List[str]) -> dict:
+    """
+    Parses key=value assignments, where values are read as JSON if possible and as strings otherwise.
+    """
+    overrides = {}
+    for assignment in assignments:
+        key, value = assignment.split('=', 1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+def split_machine_capacities(overrides: dict, n_processes: int, cores: int = 0):
+    """
+    Sets the scheduler capacities of a run to its share of the machine, shared by n_processes runs, unless they are
+    overridden. cores overrides the number of cores of the machine.
+    """
+    capacities = get_machine_capacities(n_processes)
+    if cores > 0:
+        capacities['cores'] = max(1, cores // n_processes)
+    for resource, capacity in capacities.items():
+        overrides.setdefault(f'scheduler_args.{resource}', capacity)
+
+
+def run_one(script: str, overrides: dict, share_rating_memo: bool = False):
+    """
+    Runs one experiment in the current process. Returns the error traceback if it failed, None otherwise.
+    """
+    try:
+        cfg = build_config(script, overrides)
+        if 'gpt_args.api_key' not in overrides and os.environ.get('OPENAI_API_KEY'):
+            # Read on the worker, so that the key is not stored with the grid or the queued jobs
+            cfg.gpt_args.api_key = os.environ['OPENAI_API_KEY']
+        if share_rating_memo and 'share_rating_memo' in cfg:
+            cfg.share_rating_memo = True
+        importlib.import_module(script).run(cfg)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def _run_one_star(args):
+    return args[0], run_one(*args[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of experiments in long-lived worker processes.")
+    parser.add_argument('--grid', required=True, help="JSON grid spec, see the module docstring.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of runs in parallel, one per process.")
+    parser.add_argument('--set', action='append', default=[], help="key=value override applied to all runs.")
+    parser.add_argument(
+        '--llm_concurrency', type=int, default=0,
+        help="Total concurrent LLM requests, split between the workers (0 keeps the per-run setting)."
+    )
+    parser.add_argument(
+        '--cores', type=int, default=0,
+        help="Total cores, split between the workers for plan evaluation and their schedulers (0: the scheduler gets "
+             "a share of the machine's cores and the per-run eval_workers is kept)."
+    )
+    parser.add_argument(
+        '--share_rating_memo', action=argparse.BooleanOptionalAction, default=False,
+        help="Reuse the domain ratings of earlier runs of the same worker."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.grid, 'r') as f:
+        grid = json.load(f)
+    runs = expand_grid(grid)
+    global_overrides = parse_overrides(args.set)
+    if args.llm_concurrency > 0:
+        global_overrides['gpt_args.max_concurrency'] = max(1, args.llm_concurrency // args.workers)
+    for i, (script, overrides) in enumerate(runs):
+        overrides.update(global_overrides)
+        if args.cores > 0 and script == 'main':
+            overrides['eval_workers'] = max(1, args.cores // args.workers)
+        split_machine_capacities(overrides, args.workers, args.cores)
+        # Fail on unknown keys before starting any run
+        build_config(script, overrides)
+    logging.info(f"Running {len(runs)} experiments with {args.workers} workers")
+
+    jobs = [(i, (script, overrides, args.share_rating_memo)) for i, (script, overrides) in enumerate(runs)]
+    if args.workers <= 1:
+        results = map(_run_one_star, jobs)
+    else:
+        # Fresh interpreters, since the parent may already hold threads (e.g. of an LLM client)
+        pool = multiprocessing.get_context('spawn').Pool(processes=args.workers)
+        results = pool.imap_unordered(_run_one_star, jobs)
+    failed = []
+    for n_done, (i, error) in enumerate(results, start=1):
+        script, overrides = runs[i]
+        name = f"{script} {overrides.get('log_prefix', '')} seed={overrides.get('seed', '')}"
+        if error is None:
+            logging.info(f"[{n_done}/{len(runs)}] Finished {name}")
+        else:
+            failed.append(name)
+            logging.error(f"[{n_done}/{len(runs)}] Failed {name}:\n{error}")
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    if len(failed) > 0:
+        logging.error(f"{len(failed)} runs failed: {failed}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Compares the prompt tokens and the latency of the full and diff domain feedback modes (planning_strategy_args.
+feedback_mode) on recorded planning chats. Each recorded conversation is rewritten with diff feedback messages, and
+both versions are replayed turn by turn against the mock backend, which serves the recorded replies.
+
+python src/feedback_benchmark.py --chats ./experiments/<log_prefix>/seed_<seed>/chats.jsonl.gz
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+import numpy as np
+
+from chat_log import load_chats
+from gpt_client import GPTClient, GPTConfig
+from pddl_utils import PDDLObj
+from planning import _build_feedback_message
+
+TEMPLATE_RE = re.compile(r"Target PDDL Template:\n```pddl\n(.*?)\n```", re.DOTALL)
+FEEDBACK_RE = re.compile(
+    r"^Incorrect\. (?:The environment returned the following error:\n\n(.*?)\n\n)?Please reason about the issue "
+    r"with your generated code\. The current domain pddl is as follows:\n\n```pddl\n(.*?)\n```", re.DOTALL
+)
+
+
+def rewrite_with_diff_feedback(chat):
+    """
+    Returns the chat with each full-domain feedback message replaced by its diff feedback message, or None if the
+    chat is not a planning chat.
+    """
+    if len(chat) < 2 or TEMPLATE_RE.search(chat[1]['content']) is None:
+        return None
+    template_pddl = TEMPLATE_RE.search(chat[1]['content']).group(1)
+    shown_pddl_obj, shown_step = PDDLObj.from_pddl_str(template_pddl, template_pddl), 0
+    new_chat, n_attempts = chat[:2], 0
+    for message in chat[2:]:
+        match = FEEDBACK_RE.match(message['content']) if message['role'] == 'user' else None
+        if message['role'] == 'assistant':
+            n_attempts += 1
+        if match is None:
+            new_chat.append(message)
+            continue
+        err_msg, domain_pddl = match.groups()
+        new_pddl_obj = PDDLObj.from_pddl_str(domain_pddl, template_pddl)
+        new_chat.append({'role': 'user', 'content': _build_feedback_message(
+            err_msg, new_pddl_obj, shown_pddl_obj, shown_step
+        )})
+        shown_pddl_obj, shown_step = new_pddl_obj, n_attempts
+    return new_chat
+
+
+def replay_chats(chats, latency: str):
+    """
+    Replays the user turns of the chats against the mock backend. Returns the prompt tokens and the per-call latencies.
+    """
+    with tempfile.TemporaryDirectory() as chats_dir:
+        for i, chat in enumerate(chats):
+            with open(os.path.join(chats_dir, f"chat_{i}.json"), 'w') as f:
+                json.dump(chat, f)
+        gpt_client = GPTClient(GPTConfig(
+            api_key='', backend='mock', mock_replay_chats_dir=chats_dir, mock_latency=latency
+        ))
+    latencies = []
+    for chat in chats:
+        conv_id, _ = gpt_client.make_new_chat(chat[0]['content'])
+        for i in range(1, len(chat) - 1):
+            if chat[i]['role'] != 'user' or chat[i + 1]['role'] != 'assistant':
+                continue
+            start_time = time.time()
+            conv_id, _, _ = gpt_client.complete_one_chat(conv_id, chat[i]['content'])
+            latencies.append(time.time() - start_time)
+    return gpt_client.used_prompt_tokens, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full vs diff domain feedback on recorded chats.")
+    parser.add_argument('--chats', required=True, help="Chat log, or directory of chat_<id>.json files.")
+    parser.add_argument('--latency', default='constant:0.5+0.02,0.0002', help="Latency spec, see LatencyModel.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    full_chats, diff_chats = [], []
+    for chat in load_chats(args.chats).values():
+        diff_chat = rewrite_with_diff_feedback(chat)
+        # Only complete conversations are replayed, the others are prefixes of them
+        if diff_chat is not None and chat[-1]['role'] == 'assistant':
+            full_chats.append(chat)
+            diff_chats.append(diff_chat)
+    print(f"Replaying {len(full_chats)} planning chats")
+    results = {}
+    for mode, chats in [('full', full_chats), ('diff', diff_chats)]:
+        prompt_tokens, latencies = replay_chats(chats, args.latency)
+        results[mode] = {
+            'prompt_tokens': prompt_tokens,
+            'total_latency_seconds': float(np.sum(latencies)),
+            'mean_latency_seconds': float(np.mean(latencies)) if len(latencies) > 0 else 0.0,
+            'n_calls': len(latencies),
+        }
+    for key in ['prompt_tokens', 'total_latency_seconds']:
+        reduction = 1 - results['diff'][key] / max(1e-9, results['full'][key])
+        results[f'{key}_reduction'] = reduction
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
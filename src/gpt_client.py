@@ -7,15 +7,28 @@
 
 import os
 import json
+import asyncio
+import queue
+import threading
+import time
 
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dataclasses import dataclass
 import uuid
 import logging
-from copy import deepcopy
 import backoff
 
+from chat_log import ChatLogWriter
+from concurrency import OperationCancelled, is_cancelled, wait_for_future
+from conversation_tree import ConversationTree, HistoryPolicy
+from latency_histogram import LatencyHistogram
+from mock_llm import FakeAsyncOpenAI, MockResponder
+from rate_limiter import get_rate_limiter
+from resource_scheduler import acquire_resources_async, get_priority, with_priority
+from response_cache import ResponseCache, CacheMissError
+from utils import find_code_block_end, estimate_tokens
+
 
 @dataclass
 class GPTConfig:
@@ -24,6 +37,23 @@ class GPTConfig:
     max_tokens: int = 4000
     frequency_penalty: float = 0.0
     presence_penalty: float = 0.0
+    max_concurrency: int = 8  # Maximum number of in-flight completion requests
+    cache_mode: str = 'off'  # One of ResponseCache.MODES
+    cache_path: str = './experiments/llm_cache.sqlite'
+    cache_max_size_mb: float = 1024
+    backend: str = 'openai'  # 'openai' or 'mock' (in-process fake, see mock_llm.py)
+    base_url: str = ''  # OpenAI-compatible endpoint, e.g. a local mock_llm.py server. Empty for the OpenAI API.
+    mock_scripted_responses_path: str = ''
+    mock_replay_chats_dir: str = ''
+    mock_latency: str = 'constant:0'
+    rpm_limit: float = 0  # Client-side requests-per-minute budget, shared by all clients of the model (0 disables)
+    tpm_limit: float = 0  # Client-side tokens-per-minute budget (0 disables)
+    rate_limit_state_path: str = ''  # Lock file that shares the budgets across processes. Empty for this process only.
+    chat_log_path: str = ''  # Compressed chat log (see chat_log.py), appended as completions return. Empty disables.
+    request_timeout_seconds: float = 0  # Deadline of each request attempt, after which it is retried (0 disables)
+    hedge_quantile: float = 0  # Send a duplicate request once this latency quantile (e.g. 0.95) is exceeded (0 disables)
+    hedge_min_samples: int = 20  # Number of recorded latencies needed before hedging starts
+    max_n_per_request: int = 0  # Split requests for more samples into parallel smaller ones (0 disables)
 
 
 class GPTClient:
@@ -41,48 +71,368 @@ class GPTClient:
         'gpt-4-0125-preview': 10,
         'gpt-4-turbo-2024-04-09': 10,
     }
+    # Usage counters saved in run checkpoints
+    COUNTERS = (
+        'used_prompt_tokens', 'used_completion_tokens', 'gpt_calls', 'prompt_tokens_saved', 'rate_limit_wait_seconds',
+        'n_hedged_requests', 'n_hedge_wins', 'hedge_loser_prompt_tokens', 'hedge_loser_completion_tokens',
+        'n_speculative_misses', 'speculative_missed_prompt_tokens',
+        'speculative_missed_completion_tokens',
+    )
     MAX_CALLS = 400
 
     def __init__(self, config: GPTConfig) -> None:
         self.config = config
-        if config.model_name in self.OPENAI_MODELS:
-            self.client = OpenAI(api_key=config.api_key)
+        if config.backend == 'mock':
+            self.client = FakeAsyncOpenAI(MockResponder(
+                config.mock_scripted_responses_path, config.mock_replay_chats_dir, config.mock_latency
+            ))
+        elif config.backend != 'openai':
+            raise ValueError(f"Unsupported backend: {config.backend}")
+        elif config.base_url:
+            self.client = AsyncOpenAI(api_key=config.api_key, base_url=config.base_url)
+        elif config.model_name in self.OPENAI_MODELS:
+            self.client = AsyncOpenAI(api_key=config.api_key)
         else:
             raise ValueError(f"Unsupported model name: {config.model_name}")
         self.used_prompt_tokens = 0
         self.used_completion_tokens = 0
         self.gpt_calls = 0
-        self.conv_cache = {}
+        self.prompt_tokens_saved = 0  # Estimated prompt tokens not sent thanks to the history policies
+        # Speculative requests count towards the calls and tokens above only once they are used (see submit_n_chats),
+        # the unused ones are counted separately
+        self._speculative_usage = {}  # Copy conv id -> (input tokens, output tokens), None while in flight
+        self.n_speculative_misses = 0
+        self.speculative_missed_prompt_tokens = 0
+        self.speculative_missed_completion_tokens = 0
+        # Conversations share their common prefix, so forking a chat into n completions does not copy its history
+        self.conv_tree = ConversationTree()
+        # Guards the counters and conv_tree, which are shared by all in-flight completions
+        self._lock = threading.RLock()
+        # All requests run on one event loop owned by the client, so the sync wrappers can be called from any thread
+        self._loop = None
+        self._semaphore = None
+        self.response_cache = None
+        if config.cache_mode != 'off':
+            self.response_cache = ResponseCache(config.cache_path, config.cache_mode, config.cache_max_size_mb)
+        self.chat_log = ChatLogWriter(config.chat_log_path) if config.chat_log_path else None
+        self.rate_limiter = None
+        self.rate_limit_wait_seconds = 0.0
+        # Latencies of the non-streamed requests, per number of samples n, used to pick the hedging delays
+        self.latency_histograms = {}
+        self.n_hedged_requests = 0
+        self.n_hedge_wins = 0
+        # Tokens of the losing requests of hedges, not part of the used tokens. They are estimated for losers that were
+        # cancelled before answering (and so report no usage).
+        self.hedge_loser_prompt_tokens = 0
+        self.hedge_loser_completion_tokens = 0
+        if config.rpm_limit > 0 or config.tpm_limit > 0:
+            self.rate_limiter = get_rate_limiter(
+                config.model_name, config.rpm_limit, config.tpm_limit, config.rate_limit_state_path
+            )
 
-    def complete_one_chat(self, conv_id, user_input, temp=0.0):
-        conv_ids, gpt_outputs, aux = self.complete_n_chats(conv_id, user_input, n_completions=1, temp=temp)
-        return conv_ids[0], gpt_outputs[0], aux
+    def complete_one_chat(self, conv_id, user_input, temp=0.0, history_policy: HistoryPolicy = None):
+        return self._run_sync(self.acomplete_one_chat(conv_id, user_input, temp=temp, history_policy=history_policy))
+
+    def complete_n_chats(self, conv_id, user_input, n_completions: int, temp: float,
+                         history_policy: HistoryPolicy = None):
+        return self._run_sync(self.acomplete_n_chats(conv_id, user_input, n_completions, temp, history_policy))
 
-    def complete_n_chats(self, conv_id, user_input, n_completions: int, temp: float):
-        if self.gpt_calls >= self.MAX_CALLS:
+    def submit_n_chats(self, conv_id, user_input, n_completions: int, temp: float,
+                       history_policy: HistoryPolicy = None):
+        """
+        Starts n completions of a copy of the conversation without waiting for them, to request a turn
+        speculatively, and leaves the conversation unchanged. Returns the id of the copy and a future of the
+        complete_n_chats result; cancelling the future cancels the request. The request counts towards gpt_calls,
+        MAX_CALLS and the used tokens only after settle_speculation(copy_conv_id, used=True).
+        """
+        with self._lock:
+            copy_conv_id, = self._fork_chat(conv_id, 1)
+            self._speculative_usage[copy_conv_id] = None
+        future = asyncio.run_coroutine_threadsafe(
+            with_priority(self._run_on_client_loop(self._acomplete_n_chats(
+                copy_conv_id, user_input, n_completions, temp, history_policy, speculative=True
+            )), get_priority()),
+            self._get_loop()
+        )
+        return copy_conv_id, future
+
+    def settle_speculation(self, copy_conv_id, used: bool):
+        """
+        Counts the usage of a speculative request of submit_n_chats as a regular call if it is used, or as a miss
+        otherwise (also if it completes later). Raises a ValueError if using it exceeds MAX_CALLS.
+        """
+        with self._lock:
+            if copy_conv_id not in self._speculative_usage:
+                return
+            # Without usage, the request is still in flight or failed, and its tokens are counted when it completes
+            usage = self._speculative_usage.pop(copy_conv_id) or (0, 0)
+            if used and self.gpt_calls < self.MAX_CALLS:
+                self.gpt_calls += 1
+                self.used_prompt_tokens += usage[0]
+                self.used_completion_tokens += usage[1]
+                return
+            self.n_speculative_misses += 1
+            self.speculative_missed_prompt_tokens += usage[0]
+            self.speculative_missed_completion_tokens += usage[1]
+        if used:
             raise ValueError(f"Exceeded the maximum number of GPT calls: {self.MAX_CALLS}")
-        self.add_chat_messages(conv_id, [{'role': 'user', 'content': user_input}])
-        cur_chat = self.conv_cache[conv_id]
-        conv_ids, chats = self._copy_chat(conv_id, n_completions)
-        response_messages, (used_input_tokens, used_output_tokens), aux = self._complete_client_chat(
-            messages=cur_chat, temperature=temp, n=n_completions, max_tokens=self.config.max_tokens
+
+    async def acomplete_one_chat(self, conv_id, user_input, temp=0.0, history_policy: HistoryPolicy = None):
+        conv_ids, gpt_outputs, aux = await self.acomplete_n_chats(
+            conv_id, user_input, n_completions=1, temp=temp, history_policy=history_policy
         )
-        self.used_prompt_tokens += used_input_tokens
-        self.used_completion_tokens += used_output_tokens
-        self.gpt_calls += 1
+        return conv_ids[0], gpt_outputs[0], aux
+
+    async def acomplete_n_chats(self, conv_id, user_input, n_completions: int, temp: float,
+                                history_policy: HistoryPolicy = None):
+        return await self._run_on_client_loop(
+            self._acomplete_n_chats(conv_id, user_input, n_completions, temp, history_policy)
+        )
+
+    async def _acomplete_n_chats(self, conv_id, user_input, n_completions: int, temp: float,
+                                 history_policy: HistoryPolicy = None, speculative: bool = False):
+        with self._lock:
+            if not speculative:
+                if self.gpt_calls >= self.MAX_CALLS:
+                    raise ValueError(f"Exceeded the maximum number of GPT calls: {self.MAX_CALLS}")
+                # Reserve the call up front, so that concurrent callers cannot overshoot MAX_CALLS
+                self.gpt_calls += 1
+            self.add_chat_messages(conv_id, [{'role': 'user', 'content': user_input}])
+            cur_chat = self._get_messages_to_send(conv_id, history_policy)
+            conv_ids = self._fork_chat(conv_id, n_completions)
+        try:
+            async with self._get_semaphore():
+                response_messages, (used_input_tokens, used_output_tokens), aux = await self._complete_client_chat(
+                    messages=cur_chat, temperature=temp, n=n_completions, max_tokens=self.config.max_tokens
+                )
+        except BaseException:
+            with self._lock:
+                if not speculative:
+                    self.gpt_calls -= 1
+                # The forks were not returned to the caller, who cannot release them
+                self.conv_tree.release(conv_ids)
+            raise
         gpt_outputs = []
-        for i in range(n_completions):
-            msg_content = response_messages[i]
-            gpt_outputs.append(msg_content)
-            self.add_chat_messages(
-                conv_ids[i], [{'role': 'assistant', 'content': msg_content}]
-            )
+        with self._lock:
+            if not speculative:
+                self.used_prompt_tokens += used_input_tokens
+                self.used_completion_tokens += used_output_tokens
+            elif conv_id in self._speculative_usage:
+                self._speculative_usage[conv_id] = (used_input_tokens, used_output_tokens)
+            else:
+                # Settled as a miss before it completed
+                self.speculative_missed_prompt_tokens += used_input_tokens
+                self.speculative_missed_completion_tokens += used_output_tokens
+            for i in range(n_completions):
+                msg_content = response_messages[i]
+                gpt_outputs.append(msg_content)
+                self.add_chat_messages(
+                    conv_ids[i], [{'role': 'assistant', 'content': msg_content}]
+                )
         return conv_ids, gpt_outputs, aux
 
-    def _complete_client_chat(self, messages, temperature, n, max_tokens):
+    def stream_n_chats(self, conv_id, user_input, n_completions: int, temp: float, code_lang: str = None,
+                       stop_at_code_end: bool = False, history_policy: HistoryPolicy = None):
+        """
+        Streams n completions and yields (choice index, conv id, content, is_final) events as they arrive: once a
+        choice is finished, and, if code_lang is given, as soon as the first complete code block of a choice has
+        arrived (with the content cut right after that block). With stop_at_code_end, a choice is finished (and
+        truncated) at the end of its first code block, and generation stops once all choices are finished.
+        """
+        events = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._astream_n_chats(
+                events, conv_id, user_input, n_completions, temp, code_lang, stop_at_code_end, history_policy
+            ),
+            self._get_loop()
+        )
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=0.1)
+                except queue.Empty:
+                    if is_cancelled():
+                        raise OperationCancelled()
+                    continue
+                if event is None:
+                    break
+                yield event
+            future.result()
+        finally:
+            if not future.done():
+                future.cancel()
+
+    async def _astream_n_chats(self, events, conv_id, user_input, n_completions, temp, code_lang, stop_at_code_end,
+                               history_policy):
+        try:
+            with self._lock:
+                if self.gpt_calls >= self.MAX_CALLS:
+                    raise ValueError(f"Exceeded the maximum number of GPT calls: {self.MAX_CALLS}")
+                self.gpt_calls += 1
+                self.add_chat_messages(conv_id, [{'role': 'user', 'content': user_input}])
+                cur_chat = self._get_messages_to_send(conv_id, history_policy)
+                conv_ids = self._fork_chat(conv_id, n_completions)
+            try:
+                async with self._get_semaphore():
+                    used_input_tokens, used_output_tokens = await self._stream_client_chat(
+                        events, conv_ids, cur_chat, temp, n_completions, code_lang, stop_at_code_end
+                    )
+            except BaseException:
+                with self._lock:
+                    self.gpt_calls -= 1
+                    # The call failed, so the caller does not keep the forks of the choices streamed so far
+                    self.conv_tree.release(conv_ids)
+                raise
+            with self._lock:
+                self.used_prompt_tokens += used_input_tokens
+                self.used_completion_tokens += used_output_tokens
+        finally:
+            events.put(None)
+
+    async def _stream_client_chat(self, events, conv_ids, messages, temperature, n, code_lang, stop_at_code_end):
+        contents, code_sent, finished = [''] * n, [False] * n, [False] * n
+        n_completion_tokens, logprob_sums = [0] * n, [0.0] * n
+
+        def finish_choice(i):
+            finished[i] = True
+            self.add_chat_messages(conv_ids[i], [{'role': 'assistant', 'content': contents[i]}])
+            events.put((i, conv_ids[i], contents[i], True))
+
+        cache = self.response_cache
+        keys = cache.make_keys(self.config.model_name, messages, temperature, n, self.config.max_tokens) \
+            if cache is not None else None
+        if cache is not None and cache.reads_enabled:
+            samples = await self._run_in_executor(cache.get_many, keys)
+            if all(sample is not None for sample in samples):
+                for i, sample in enumerate(samples):
+                    contents[i] = sample['content']
+                    finish_choice(i)
+                return 0, 0
+            if cache.mode == 'replay':
+                raise CacheMissError("Streamed samples are missing from the response cache.")
+
+        truncated = [False] * n
+
+        async def consume_stream():
+            stream = await self.openai_completion_with_backoff(
+                model=self.config.model_name,
+                messages=messages,
+                temperature=temperature,
+                n=n,
+                logprobs=True,
+                max_tokens=self.config.max_tokens,
+                stream=True,
+            )
+            try:
+                async for chunk in stream:
+                    for choice in chunk.choices:
+                        i = choice.index
+                        if finished[i]:
+                            continue
+                        if choice.delta is not None and choice.delta.content:
+                            contents[i] += choice.delta.content
+                        if choice.logprobs is not None and choice.logprobs.content:
+                            n_completion_tokens[i] += len(choice.logprobs.content)
+                            logprob_sums[i] += sum(lp.logprob for lp in choice.logprobs.content)
+                        if code_lang is not None and not code_sent[i]:
+                            code_end = find_code_block_end(contents[i], code_lang)
+                            if code_end is not None:
+                                code_sent[i] = True
+                                if stop_at_code_end:
+                                    truncated[i] = code_end < len(contents[i]) or choice.finish_reason is None
+                                    contents[i] = contents[i][:code_end]
+                                    finish_choice(i)
+                                    continue
+                                events.put((i, conv_ids[i], contents[i][:code_end], False))
+                        if choice.finish_reason is not None:
+                            finish_choice(i)
+                    if all(finished):
+                        break
+            finally:
+                await stream.response.aclose()
+
+        # The llm slot and the request deadline cover the whole stream, not only the request that opens it
+        async with acquire_resources_async(llm_slots=1):
+            if self.config.request_timeout_seconds > 0:
+                await asyncio.wait_for(consume_stream(), timeout=self.config.request_timeout_seconds)
+            else:
+                await consume_stream()
+        for i in range(n):
+            if not finished[i]:
+                finish_choice(i)
+        if cache is not None and cache.writes_enabled:
+            complete_indices = [i for i in range(n) if not truncated[i]]
+            await self._run_in_executor(
+                cache.put_many,
+                [keys[i] for i in complete_indices],
+                [
+                    {'content': contents[i], 'logprob_mean': logprob_sums[i] / max(1, n_completion_tokens[i])}
+                    for i in complete_indices
+                ]
+            )
+        # The streaming API does not report usage, so the prompt tokens are estimated
+        used_input_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        return used_input_tokens, sum(n_completion_tokens)
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="gpt-client-loop", daemon=True).start()
+            return self._loop
+
+    def _get_semaphore(self):
+        # Only called from the client loop, so no locking is needed
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.config.max_concurrency)
+        return self._semaphore
+
+    def _run_sync(self, coro):
+        # Cancelling the caller's job cancels the request on the client loop, which runs with the caller's priority
+        return wait_for_future(asyncio.run_coroutine_threadsafe(
+            with_priority(coro, get_priority()), self._get_loop()
+        ))
+
+    async def _run_on_client_loop(self, coro):
+        loop = self._get_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(with_priority(coro, get_priority()), loop))
+
+    async def _complete_client_chat(self, messages, temperature, n, max_tokens):
+        cache = self.response_cache
+        if cache is None:
+            return await self._request_client_chat(messages, temperature, n, max_tokens)
+        keys = cache.make_keys(self.config.model_name, messages, temperature, n, max_tokens)
+        samples = await self._run_in_executor(cache.get_many, keys) if cache.reads_enabled else [None] * n
+        missing_indices = [i for i in range(n) if samples[i] is None]
+        used_input_tokens, used_output_tokens = 0, 0
+        if len(missing_indices) > 0:
+            if cache.mode == 'replay':
+                raise CacheMissError(f"{len(missing_indices)}/{n} samples are missing from the response cache.")
+            response_messages, (used_input_tokens, used_output_tokens), request_aux = await self._request_client_chat(
+                messages, temperature, len(missing_indices), max_tokens
+            )
+            new_samples = [
+                {'content': content, 'logprob_mean': logprob_mean}
+                for content, logprob_mean in zip(response_messages, request_aux['logprob_means'])
+            ]
+            for i, sample in zip(missing_indices, new_samples):
+                samples[i] = sample
+            await self._run_in_executor(cache.put_many, [keys[i] for i in missing_indices], new_samples)
+        aux = {
+            'logprob_means': [sample['logprob_mean'] for sample in samples],
+            'cache_hits': n - len(missing_indices),
+        }
+        return [sample['content'] for sample in samples], (used_input_tokens, used_output_tokens), aux
+
+    async def _request_client_chat(self, messages, temperature, n, max_tokens):
+        max_n = self.config.max_n_per_request
+        if 0 < max_n < n:
+            return await self._request_split_client_chat(messages, temperature, n, max_tokens, max_n)
         aux = {}
-        if self.config.model_name in self.OPENAI_MODELS:
-            completions = self.openai_completion_with_backoff(
+        if self.is_openai_model():
+            completions = await self._hedged_completion(
                 model=self.config.model_name,
                 messages=messages,
                 temperature=temperature,
@@ -103,38 +453,172 @@ class GPTClient:
             raise ValueError(f"Unsupported model name: {self.config.model_name}")
         return response_messages, (used_input_tokens, used_output_tokens), aux
 
+    async def _request_split_client_chat(self, messages, temperature, n, max_tokens, max_n):
+        chunk_ns = [min(max_n, n - start) for start in range(0, n, max_n)]
+        results = await asyncio.gather(*[
+            self._request_client_chat(messages, temperature, chunk_n, max_tokens) for chunk_n in chunk_ns
+        ])
+        response_messages, logprob_means = [], []
+        used_input_tokens, used_output_tokens = 0, 0
+        for chunk_messages, (chunk_input_tokens, chunk_output_tokens), chunk_aux in results:
+            response_messages.extend(chunk_messages)
+            logprob_means.extend(chunk_aux['logprob_means'])
+            used_input_tokens += chunk_input_tokens
+            used_output_tokens += chunk_output_tokens
+        return response_messages, (used_input_tokens, used_output_tokens), {'logprob_means': logprob_means}
+
+    async def _hedged_completion(self, **kwargs):
+        """
+        Sends the request, and a duplicate one if the first has not answered within the hedge_quantile latency of
+        previous requests. Returns the first successful response and cancels the other request, whose tokens are counted
+        in hedge_loser_prompt_tokens and hedge_loser_completion_tokens.
+        """
+        hedge_delay = None
+        histogram = self.latency_histograms.get(kwargs['n'])
+        if self.config.hedge_quantile > 0 and histogram is not None and \
+                histogram.count >= self.config.hedge_min_samples:
+            hedge_delay = histogram.quantile(self.config.hedge_quantile)
+        first_start_time = time.time()
+        first = asyncio.ensure_future(self.openai_completion_with_backoff(**kwargs))
+        if hedge_delay is None:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if len(done) > 0:
+            return first.result()
+        with self._lock:
+            self.n_hedged_requests += 1
+        second = asyncio.ensure_future(self.openai_completion_with_backoff(**kwargs))
+        start_times = {first: first_start_time, second: time.time()}
+        pending = {first, second}
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            with self._lock:
+                                self.n_hedge_wins += 1
+                        loser = second if task is first else first
+                        self._count_hedge_loser(task.result(), loser, start_times[task], start_times[loser])
+                        return task.result()
+            # Both requests failed
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _count_hedge_loser(self, response, loser: asyncio.Future, winner_start_time: float, loser_start_time: float):
+        if loser.done() and not loser.cancelled() and loser.exception() is None:
+            loser_usage = loser.result().usage
+            prompt_tokens, completion_tokens = loser_usage.prompt_tokens, loser_usage.completion_tokens
+        elif loser.done():
+            return  # Failed without being billed for a response
+        else:
+            # Same prompt as the winner, and as many completion tokens as it had produced at the winner's pace
+            now = time.time()
+            progress = min(1.0, (now - loser_start_time) / max(1e-6, now - winner_start_time))
+            prompt_tokens = response.usage.prompt_tokens
+            completion_tokens = int(progress * response.usage.completion_tokens)
+        with self._lock:
+            self.hedge_loser_prompt_tokens += prompt_tokens
+            self.hedge_loser_completion_tokens += completion_tokens
+
+    def get_latency_stats(self) -> dict:
+        return {
+            'histograms': {f"n={n}": histogram.to_dict() for n, histogram in sorted(self.latency_histograms.items())},
+            'n_hedged_requests': self.n_hedged_requests,
+            'n_hedge_wins': self.n_hedge_wins,
+            'hedge_loser_prompt_tokens': self.hedge_loser_prompt_tokens,
+            'hedge_loser_completion_tokens': self.hedge_loser_completion_tokens,
+        }
+
     def make_new_chat(self, system_message):
         conv_id = str(uuid.uuid4())
         chat = [
             {'role': 'system', 'content': system_message},
         ]
-        self.conv_cache[conv_id] = chat
+        with self._lock:
+            self.conv_tree.new_conversation(conv_id, chat)
+            self._log_chat(conv_id)
         return conv_id, chat
 
+    def restore_chat(self, conv_id, messages):
+        """
+        Recreates a conversation under its former id, e.g. when resuming a run from a checkpoint.
+        """
+        with self._lock:
+            self.conv_tree.new_conversation(conv_id, messages)
+            self._log_chat(conv_id)
+
     def add_chat_messages(self, conv_id, messages):
-        self.conv_cache[conv_id].extend(messages)
+        with self._lock:
+            self.conv_tree.extend(conv_id, messages)
+            self._log_chat(conv_id)
+
+    def _log_chat(self, conv_id):
+        if self.chat_log is not None:
+            self.chat_log.log_head(conv_id, self.conv_tree.get_head(conv_id))
+
+    def close_chat_log(self):
+        if self.chat_log is not None:
+            self.chat_log.close()
+
+    def close(self):
+        """
+        Closes the chat log and the response cache, and stops the client loop. The client cannot be used afterwards.
+        """
+        self.close_chat_log()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
 
     def get_chat_messages(self, conv_id):
-        return self.conv_cache[conv_id]
+        with self._lock:
+            return self.conv_tree.get_messages(conv_id)
+
+    def _get_messages_to_send(self, conv_id, history_policy: HistoryPolicy = None):
+        messages = self.get_chat_messages(conv_id)
+        if history_policy is None:
+            return messages
+        sent_messages = history_policy.apply(messages)
+        if len(sent_messages) != len(messages):
+            self.prompt_tokens_saved += \
+                sum(estimate_tokens(m['content']) for m in messages) - \
+                sum(estimate_tokens(m['content']) for m in sent_messages)
+        return sent_messages
+
+    def release_chats(self, conv_ids):
+        """
+        Forgets the given conversations. Their messages are freed unless they are shared with a kept conversation.
+        Released conversations are not saved by save_chats.
+        """
+        with self._lock:
+            self.conv_tree.release(conv_ids)
 
-    def _copy_chat(self, conv_id, n_times):
+    def _fork_chat(self, conv_id, n_times):
         conv_ids = [str(uuid.uuid4()) for _ in range(n_times)]
-        chats = []
-        for new_conv_id in conv_ids:
-            self.conv_cache[new_conv_id] = deepcopy(self.conv_cache[conv_id])
-            chats.append(self.conv_cache[new_conv_id])
-        return conv_ids, chats
+        self.conv_tree.fork(conv_id, conv_ids)
+        return conv_ids
 
     def save_chats(self, save_dir):
         os.makedirs(save_dir, exist_ok=True)
-        for conv_id, chat in self.conv_cache.items():
+        with self._lock:
+            conv_items = [(conv_id, self.conv_tree.get_messages(conv_id)) for conv_id in self.conv_tree.conv_ids()]
+        for conv_id, chat in conv_items:
             f_name = os.path.join(save_dir, f"chat_{conv_id}.json")
             logging.info(f"Saving the chat history with GPT model to {f_name}")
             with open(f_name, 'w') as f:
                 json.dump(chat, f)
 
     def is_openai_model(self):
-        return self.config.model_name in self.OPENAI_MODELS
+        # Mock and OpenAI-compatible backends serve responses in the OpenAI format, including logprobs
+        return (
+                self.config.model_name in self.OPENAI_MODELS or self.config.backend == 'mock'
+                or bool(self.config.base_url)
+        )
 
     @property
     def used_tokens(self):
@@ -142,16 +626,76 @@ class GPTClient:
         return f"{self.used_prompt_tokens} prompt tokens, {self.used_completion_tokens} completion tokens, " \
                f"costing ${cost:.3f}"
 
-    def get_cost(self):
+    def get_counters(self) -> dict:
+        with self._lock:
+            return {name: getattr(self, name) for name in self.COUNTERS}
+
+    def restore_counters(self, counters: dict):
+        with self._lock:
+            for name, value in counters.items():
+                if name in self.COUNTERS:
+                    setattr(self, name, value)
+
+    def get_cost(self, prompt_tokens: int = None, completion_tokens: int = None):
+        """
+        Cost in dollars of the given tokens, by default of the used tokens.
+        """
+        prompt_tokens = self.used_prompt_tokens if prompt_tokens is None else prompt_tokens
+        completion_tokens = self.used_completion_tokens if completion_tokens is None else completion_tokens
         try:
             base_price = self.PRICE_PER_M[self.config.model_name]
             output_factor = 3 if self.config.model_name in self.OPENAI_MODELS else 5
-            return base_price * (self.used_prompt_tokens + output_factor * self.used_completion_tokens) / 1e6
+            return base_price * (prompt_tokens + output_factor * completion_tokens) / 1e6
         except:
             print("Error in getting cost")
             return -1
 
 
-    @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=5)
-    def openai_completion_with_backoff(self, **kwargs):
-        return self.client.chat.completions.create(**kwargs)
+    @staticmethod
+    async def _run_in_executor(fn, *args):
+        # Blocking calls, e.g. to sqlite or file locks, run in a worker thread so that they do not stall the client loop
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _adjust_rate_limit_tokens(self, n_tokens: int):
+        # In a worker thread, as the limiter may wait for the state file lock. It is not awaited, so that it also
+        # runs for cancelled requests.
+        asyncio.get_running_loop().run_in_executor(None, self.rate_limiter.adjust_tokens, n_tokens)
+
+    @backoff.on_exception(backoff.expo, (openai.RateLimitError, asyncio.TimeoutError), max_tries=5)
+    async def openai_completion_with_backoff(self, **kwargs):
+        if self.rate_limiter is not None:
+            # The API counts the prompt and the maximum number of completion tokens of all samples against the TPM
+            n_tokens = sum(estimate_tokens(m['content']) for m in kwargs['messages']) + \
+                kwargs.get('n', 1) * kwargs['max_tokens']
+            wait_seconds = await self.rate_limiter.acquire(n_tokens)
+            with self._lock:
+                self.rate_limit_wait_seconds += wait_seconds
+        try:
+            if kwargs.get('stream', False):
+                # The caller holds the llm slot and the deadline until the stream is consumed
+                response = await self.client.chat.completions.create(**kwargs)
+            else:
+                async with acquire_resources_async(llm_slots=1):
+                    start_time = time.time()
+                    request = self.client.chat.completions.create(**kwargs)
+                    if self.config.request_timeout_seconds > 0:
+                        response = await asyncio.wait_for(request, timeout=self.config.request_timeout_seconds)
+                    else:
+                        response = await request
+        except BaseException:
+            # Cancelled (e.g. a hedged loser), timed out or retried requests give their tokens back
+            if self.rate_limiter is not None:
+                self._adjust_rate_limit_tokens(n_tokens)
+            raise
+        usage = getattr(response, 'usage', None)
+        if self.rate_limiter is not None and usage is not None:
+            # Streamed responses report no usage, their reservation is kept
+            self._adjust_rate_limit_tokens(n_tokens - usage.prompt_tokens - usage.completion_tokens)
+        if not kwargs.get('stream', False):
+            # Streamed responses return once their headers arrive, so only full responses are timed
+            with self._lock:
+                if kwargs['n'] not in self.latency_histograms:
+                    self.latency_histograms[kwargs['n']] = LatencyHistogram()
+                histogram = self.latency_histograms[kwargs['n']]
+            histogram.record(time.time() - start_time)
+        return response
@@ -0,0 +1,143 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import copy
+import functools
+import io
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import List, Union
+
+from concurrency import wait_for_future
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+@dataclass
+class GroundedTask:
+    problem_pddl: str
+    sas: Union[str, None]
+    error_msg: Union[str, None] = None
+
+
+def ground_problems(domain_pddl: str, problem_pddls: List[str], n_workers: int = 1) -> List[GroundedTask]:
+    """
+    Grounds several problems against one domain. The problems are split into n_workers batches, each of which parses
+    the domain once (and a worker keeps the parsed domain for later calls), and each problem is then normalized and
+    translated to SAS. Grounding always runs in worker processes, as the translator may crash or exit on malformed
+    input.
+    """
+    if len(problem_pddls) == 0:
+        return []
+    n_workers = max(1, min(n_workers, len(problem_pddls)))
+    batches = [list(range(len(problem_pddls)))[i::n_workers] for i in range(n_workers)]
+    pool = _get_pool()
+    futures = [
+        pool.submit(_ground_problem_batch, domain_pddl, [problem_pddls[i] for i in batch]) for batch in batches
+    ]
+    results = [None] * len(problem_pddls)
+    for batch, future in zip(batches, futures):
+        try:
+            batch_results = wait_for_future(future)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. the translator crashed), which fails the other pending batches as well
+            _discard_pool(pool)
+            batch_results = [(None, f"{type(e).__name__}: {e}")] * len(batch)
+        for i, result in zip(batch, batch_results):
+            results[i] = result
+    grounded_tasks = []
+    for problem_pddl, (sas, error_msg) in zip(problem_pddls, results):
+        if error_msg is not None:
+            logging.info(f"Could not ground the problem: {error_msg}")
+        grounded_tasks.append(GroundedTask(problem_pddl=problem_pddl, sas=sas, error_msg=error_msg))
+    return grounded_tasks
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # Spawned, since the caller already runs several threads, and kept alive across calls so that the workers
+            # keep their imports and parsed domains
+            _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+        return _POOL
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_domain(domain_pddl: str) -> tuple:
+    from fast_downward.translate.pddl_parser import lisp_parser, parsing_functions
+    return tuple(parsing_functions.parse_domain_pddl(lisp_parser.parse_nested_list(domain_pddl.split("\n"))))
+
+
+def _parse_task(domain_pddl: str, problem_pddl: str):
+    # Mirrors parsing_functions.parse_task, on a copy of the cached domain since normalization modifies the task
+    from fast_downward.translate import pddl
+    from fast_downward.translate.pddl_parser import lisp_parser, parsing_functions
+
+    domain_name, domain_requirements, types, type_dict, constants, predicates, predicate_dict, functions, actions, \
+        axioms = copy.deepcopy(_parse_domain(domain_pddl))
+    task_name, task_domain_name, task_requirements, objects, init, goal, use_metric = \
+        parsing_functions.parse_task_pddl(lisp_parser.parse_nested_list(problem_pddl.split("\n")), type_dict,
+                                          predicate_dict)
+    assert domain_name == task_domain_name
+    requirements = pddl.Requirements(sorted(set(domain_requirements.requirements + task_requirements.requirements)))
+    objects = constants + objects
+    parsing_functions.check_for_duplicates(
+        [o.name for o in objects],
+        errmsg="error: duplicate object %r",
+        finalmsg="please check :constants and :objects definitions")
+    init += [pddl.Atom("=", (obj.name, obj.name)) for obj in objects]
+    return pddl.Task(
+        domain_name, task_name, requirements, types, objects, predicates, functions, init, goal, actions, axioms,
+        use_metric
+    )
+
+
+def _ground_problem_batch(domain_pddl: str, problem_pddls: List[str]):
+    return [_ground_problem(domain_pddl, problem_pddl) for problem_pddl in problem_pddls]
+
+
+def _ground_problem(domain_pddl: str, problem_pddl: str):
+    # Mirrors fast_downward.pddl2sas (without optimizations), but reuses the parsed domain across problems
+    sys.argv = ["translate.py", "domain", "task"]
+    from fast_downward.translate import options, normalize, translate
+
+    options.filter_unimportant_vars = False
+    options.filter_unreachable_facts = False
+    options.use_partial_encoding = False
+    options.skip_variable_reordering = True
+    options.add_implied_preconditions = False
+    options.invariant_generation_max_candidates = 0
+
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        task = _parse_task(domain_pddl, problem_pddl)
+        normalize.normalize(task)
+        sas_task = translate.pddl_to_sas(task)
+        sas_io = io.StringIO()
+        sas_task.output(sas_io)
+        return sas_io.getvalue(), None
+    except BaseException as e:  # The translator calls sys.exit on some errors
+        return None, f"{type(e).__name__}: {e}"
+    finally:
+        sys.stdout = stdout
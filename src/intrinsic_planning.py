@@ -14,31 +14,57 @@ from ml_collections import config_flags
 import uuid
 import logging
 from gpt_client import GPTClient, GPTConfig
-from domains import Domain, PDDLEnv
+from resource_scheduler import configure_scheduler, get_machine_capacities
+from domains import Domain, get_pddl_env
 import coloredlogs
 import json
 import wandb
 
 from utils import wrap_code, extract_code
 
-_CONFIG = config_flags.DEFINE_config_dict(
-    'cfg',
-    ConfigDict(dict(
+
+def get_config():
+    """
+    Default configuration of a run, overridden by the --cfg.* flags or by the experiment grid.
+    """
+    return ConfigDict(dict(
         run_id=str(uuid.uuid4())[:8],
         debug=False,
         data_path='./data',
         exp_path='./experiments',
         log_prefix="test",
         seed=42,
+        save_chats=False,  # Also export the chats to <run_exp_dir>/chats/chat_<id>.json at the end of the run
         use_cot=False,
         gpt_args=dict(
             api_key="your-openai-api-key",
             model_name='gpt-4-1106-preview',
+            cache_mode='off',  # 'off', 'record', 'replay' or 'read-through'
+            cache_path='./experiments/llm_cache.sqlite',
+            backend='openai',  # 'openai' or 'mock' for offline benchmarks
+            base_url='',  # OpenAI-compatible endpoint, e.g. a local mock_llm.py server
+            mock_scripted_responses_path='',
+            mock_replay_chats_dir='',
+            mock_latency='constant:0',
+            rpm_limit=0,  # Client-side requests-per-minute budget (0 disables)
+            tpm_limit=0,  # Client-side tokens-per-minute budget (0 disables)
+            rate_limit_state_path='',  # Lock file to share the budgets between concurrent runs
+            chat_log_path='',  # Compressed chat log, defaults to <run_exp_dir>/chats.jsonl.gz
+            request_timeout_seconds=0,  # Deadline of each LLM request attempt before it is retried (0 disables)
+            hedge_quantile=0,  # Duplicate requests slower than this latency quantile, e.g. 0.95 (0 disables)
+            max_n_per_request=0,  # Split best-of-n requests into parallel requests of at most this many samples
+            max_concurrency=8,  # Maximum number of in-flight LLM requests of the run
         ),
         env_args=dict(
             fd_py_path='/path/to/planning/library.py',
             fd_search_time_limit=300,
             val_bin_path='/path/to/VAL/bin/Validate',
+            fd_search_memory_limit_mb=0,  # Memory limit of each planner search (0: none)
+        ),
+        scheduler_args=dict(  # Process-wide admission control of planner, walk and LLM work (0: unlimited)
+            # The whole machine by default; experiment_grid.py and work_queue.py split it between their workers
+            **get_machine_capacities(),
+            llm_slots=0,
         ),
         wandb_args=dict(
             project="llm-planning",
@@ -48,7 +74,7 @@ _CONFIG = config_flags.DEFINE_config_dict(
         context_domain_name='blocksworld',
         target_domain_name='grippers',
     ))
-)
+
 
 SYSTEM_MESSAGE = """You are a helpful assistant, skilled in producing Planning Domain Definition Language (PDDL) plans given a natural language description of a planning domain. You always wrap your code in the appropriate markdown or PDDL syntax."""
 BLOCKSWORLD_COT_PLAN = """; Initial state:
@@ -253,12 +279,27 @@ def run(cfg):
         logging.warning(
             f"Summary log path already exists: {summary_log_path}, either delete it or change the prefix or seed"
         )
-        exit(0)
+        return
     wandb_run = _config_wandb(cfg)
-
-    gpt_client = GPTClient(GPTConfig(**cfg.gpt_args))
+    gpt_client = None
+    # A failed run must not leave its client loop, cache, chat log or wandb run behind, see main.run
+    try:
+        gpt_args = cfg.gpt_args.to_dict()
+        gpt_args['chat_log_path'] = gpt_args['chat_log_path'] or os.path.join(run_exp_dir, "chats.jsonl.gz")
+        gpt_client = GPTClient(GPTConfig(**gpt_args))
+        _run_experiment(cfg, run_exp_dir, summary_log_path, wandb_run, gpt_client)
+    except BaseException:
+        wandb_run.finish(exit_code=1)
+        raise
+    finally:
+        if gpt_client is not None:
+            gpt_client.close()
+
+
+def _run_experiment(cfg, run_exp_dir: str, summary_log_path: str, wandb_run, gpt_client: GPTClient):
     target_domain = Domain(os.path.join(cfg.data_path, 'domains'), cfg.target_domain_name)
-    pddl_env = PDDLEnv(**cfg.env_args)
+    resource_scheduler = configure_scheduler(**cfg.scheduler_args)
+    pddl_env = get_pddl_env(**cfg.env_args)
 
     aux = {}
     task_results = []
@@ -277,18 +318,30 @@ def run(cfg):
         'used_prompt_tokens': gpt_client.used_prompt_tokens,
         'used_completion_tokens': gpt_client.used_completion_tokens,
         'cost_dollars': gpt_client.get_cost(),
+        'llm_rate_limit_wait_seconds': gpt_client.rate_limit_wait_seconds,
+        'prompt_tokens_saved': gpt_client.prompt_tokens_saved,
+        'llm_hedged_requests': gpt_client.n_hedged_requests,
+        # Tokens of the losing hedged requests (partly estimated), not part of the used tokens and cost above
+        'llm_hedge_loser_cost_dollars': gpt_client.get_cost(
+            gpt_client.hedge_loser_prompt_tokens, gpt_client.hedge_loser_completion_tokens
+        ),
     }
     wandb_run.summary.update(summary_metrics)
-    gpt_client.save_chats(save_dir=os.path.join(run_exp_dir, "chats"))
+    if cfg.save_chats:
+        gpt_client.save_chats(save_dir=os.path.join(run_exp_dir, "chats"))
+    gpt_client.close()
     file_logger = get_file_logger(os.path.join(run_exp_dir, f"run.log"))
     # Save aux as file
     summary_log_dict = {
         'aux': aux, 'cfg': cfg.to_dict(), 'summary_metrics': summary_metrics,
+        'llm_latency_stats': gpt_client.get_latency_stats(),
+        'resource_scheduler': resource_scheduler.get_metrics() if resource_scheduler is not None else None,
     }
     with open(summary_log_path, 'w') as f:
         json.dump(summary_log_dict, f, indent=2)
     wandb_run.save(summary_log_path)
     file_logger.info(f"Used tokens: {gpt_client.used_tokens}")
+    wandb_run.finish()
 
 
 def main(_):
@@ -324,4 +377,6 @@ def _config_wandb(cfg):
 
 
 if __name__ == '__main__':
+    # The flag is only defined when run as a script, so that experiment_grid.py can import several entry points
+    _CONFIG = config_flags.DEFINE_config_dict('cfg', get_config())
     app.run(main)
@@ -0,0 +1,55 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import threading
+from collections import deque
+
+import numpy as np
+
+# Log-spaced bucket upper bounds in seconds, the last bucket collects everything above 300 seconds
+DEFAULT_BUCKET_BOUNDS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+
+
+class LatencyHistogram:
+    """
+    Latencies of calls, kept both as bucket counts over the whole run (for reporting) and as a window of the most
+    recent samples (for quantiles, e.g. to pick hedging delays).
+    """
+
+    def __init__(self, bucket_bounds=DEFAULT_BUCKET_BOUNDS, window_size: int = 1000):
+        self.bucket_bounds = list(bucket_bounds)
+        self.bucket_counts = [0] * (len(self.bucket_bounds) + 1)
+        self.recent = deque(maxlen=window_size)
+        self.count = 0
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.bucket_counts[int(np.searchsorted(self.bucket_bounds, seconds))] += 1
+            self.recent.append(seconds)
+            self.count += 1
+            self.total_seconds += seconds
+
+    def quantile(self, q: float):
+        with self._lock:
+            if len(self.recent) == 0:
+                return None
+            return float(np.quantile(list(self.recent), q))
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            labels = [f"<={bound}s" for bound in self.bucket_bounds] + [f">{self.bucket_bounds[-1]}s"]
+            recent = list(self.recent)
+        stats = {
+            'count': self.count,
+            'mean_seconds': self.total_seconds / max(1, self.count),
+            'buckets': dict(zip(labels, self.bucket_counts)),
+        }
+        for q in (0.5, 0.95, 0.99):
+            stats[f'p{int(q * 100)}_seconds'] = float(np.quantile(recent, q)) if len(recent) > 0 else None
+        return stats
@@ -6,6 +6,9 @@
 #
 
 import copy
+import dataclasses
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
 import os
 import numpy as np
 import random
@@ -14,38 +17,79 @@ from ml_collections.config_dict import ConfigDict
 from ml_collections import config_flags
 import uuid
 import logging
+from checkpoint import RunCheckpoint
 from gpt_client import GPTClient, GPTConfig
-from domains import Domain, PDDLEnv
+from resource_scheduler import configure_scheduler, get_machine_capacities
+from domains import Domain, get_pddl_env
+from evaluation import RatingMemo, get_shared_rating_memo
 from planning import evaluate_action_level_planning, PlanningStrategy, evaluate_planning_on_problem_candidates, \
-    evaluate_all_tasks
+    evaluate_all_tasks, TaskResult, aggregate_speculation_stats
 import coloredlogs
 import json
 import wandb
 
-from problem_domain_translation import translate_problems_given_one_task, \
+from problem_domain_translation import submit_problem_translations, \
     generate_exact_n_problem_translation_candidates
 
-_CONFIG = config_flags.DEFINE_config_dict(
-    'cfg',
-    ConfigDict(dict(
+
+def get_config():
+    """
+    Default configuration of a run, overridden by the --cfg.* flags or by the experiment grid.
+    """
+    return ConfigDict(dict(
         run_id=str(uuid.uuid4())[:8],
         debug=False,
         data_path='./data',
         exp_path='./experiments',
         log_prefix="test",
         seed=42,
+        save_chats=False,  # Also export the chats to <run_exp_dir>/chats/chat_<id>.json at the end of the run
         gpt_args=dict(
             api_key="your-openai-api-key",
             model_name='gpt-4-1106-preview',
+            cache_mode='off',  # 'off', 'record', 'replay' or 'read-through'
+            cache_path='./experiments/llm_cache.sqlite',
+            backend='openai',  # 'openai' or 'mock' for offline benchmarks
+            base_url='',  # OpenAI-compatible endpoint, e.g. a local mock_llm.py server
+            mock_scripted_responses_path='',
+            mock_replay_chats_dir='',
+            mock_latency='constant:0',
+            rpm_limit=0,  # Client-side requests-per-minute budget (0 disables)
+            tpm_limit=0,  # Client-side tokens-per-minute budget (0 disables)
+            rate_limit_state_path='',  # Lock file to share the budgets between concurrent runs
+            chat_log_path='',  # Compressed chat log, defaults to <run_exp_dir>/chats.jsonl.gz
+            request_timeout_seconds=0,  # Deadline of each LLM request attempt before it is retried (0 disables)
+            hedge_quantile=0,  # Duplicate requests slower than this latency quantile, e.g. 0.95 (0 disables)
+            max_n_per_request=0,  # Split best-of-n requests into parallel requests of at most this many samples
+            max_concurrency=8,  # Maximum number of in-flight LLM requests of the run
         ),
         env_args=dict(
             fd_py_path='/path/to/downward/fast-downward.py',
             fd_search_time_limit=300,
             val_bin_path='/path/to/VAL/build/linux64/Release/bin/Validate',
+            fd_search_memory_limit_mb=0,  # Memory limit of each planner search (0: none)
+        ),
+        scheduler_args=dict(  # Process-wide admission control of planner, walk and LLM work (0: unlimited)
+            # The whole machine by default; experiment_grid.py and work_queue.py split it between their workers
+            **get_machine_capacities(),
+            llm_slots=0,
         ),
         planning_strategy_args=dict(
             turns=4,  # How many turns to use for the conversation with LLM
             best_of_n=1,  # How many samples to generate from LLM and choose the best one
+            stream_completions=False,  # Rate each completion as soon as its code block has been streamed
+            stop_at_code_end=False,  # With streaming, stop generating a completion once its code block is complete
+            release_unselected_chats=False,  # Free the chats of unselected completions (they are not saved then)
+            history_policy='full',  # Earlier turns to resend: 'full', 'window' (drop them) or 'summary' (compact them)
+            history_window_turns=1,  # Most recent turns always resent with 'window' and 'summary'
+            feedback_mode='full',  # 'full' resends the whole domain each turn, 'diff' only its changed parts
+            candidate_workers=1,  # Problem candidates refined in parallel (0: bounded by LLM concurrency and cores)
+            rating_workers=1,  # Best-of-n completions rated in parallel (0: one per core)
+            stop_rating_at_solution=False,  # Cancel the ratings of the completions after one that finds a solution
+            search='chain',  # 'chain' continues from the best completion of each turn, 'beam' from the best states
+            beam_width=1,  # With beam search, states kept after each turn, each expanded with best_of_n completions
+            expansion_budget=0,  # With beam search, maximum number of expanded states per candidate (0: no limit)
+            speculative_next_turn=False,  # Request the next turn of the best completion so far while others are rated
         ),
         problem_translation_args=dict(
             active=True,  # Whether to generate problem translation candidates, or use the target problem
@@ -55,8 +99,13 @@ _CONFIG = config_flags.DEFINE_config_dict(
             # Whether to use logprob for selecting the best candidate among logprob_candidates candidates
             logprob_candidates=0,
             add_domain_proposal=False,  # Whether to add a domain proposal before the problem translation candidates
+            translation_workers=1,  # Tasks translated concurrently while evaluating (0: bounded by LLM concurrency)
         ),
         max_tasks=10,  # Maximum number of tasks to evaluate
+        resume=False,  # Continue an interrupted run with the same log prefix and seed from its checkpoint
+        eval_workers=1,  # Tasks evaluated in parallel with the best generated domain (0: one per core)
+        rating_memo_size=4096,  # Domain ratings kept in the memo of the run (least recently used evicted first)
+        share_rating_memo=False,  # Reuse the ratings of earlier runs of the same process (see experiment_grid.py)
         context_domain_name='blocksworld', # This is strict, all the prompts are based on blocksworld
         target_domain_name='grippers',
         wandb_args=dict(
@@ -66,7 +115,6 @@ _CONFIG = config_flags.DEFINE_config_dict(
         exp_flags=dict(
         ),
     ))
-)
 
 
 def run(cfg):
@@ -83,31 +131,60 @@ def run(cfg):
         logging.warning(
             f"Summary log path already exists: {summary_log_path}, either delete it or change the prefix or seed"
         )
-        exit(0)
+        return
     wandb_run = _config_wandb(cfg)
+    gpt_client, translation_executor = None, None
+    # The run may be one of many in a long-lived worker (see experiment_grid.py), so a failed or cancelled run must not
+    # leave its client loop, cache, chat log or wandb run behind for the next ones
+    try:
+        gpt_args = cfg.gpt_args.to_dict()
+        gpt_args['chat_log_path'] = gpt_args['chat_log_path'] or os.path.join(run_exp_dir, "chats.jsonl.gz")
+        gpt_client = GPTClient(GPTConfig(**gpt_args))
+        translation_workers = cfg.problem_translation_args.translation_workers or gpt_client.config.max_concurrency
+        translation_executor = ThreadPoolExecutor(max_workers=translation_workers)
+        _run_experiment(cfg, run_exp_dir, summary_log_path, wandb_run, gpt_client, translation_executor)
+    except BaseException:
+        wandb_run.finish(exit_code=1)
+        raise
+    finally:
+        if translation_executor is not None:
+            translation_executor.shutdown(cancel_futures=True)
+        if gpt_client is not None:
+            gpt_client.close()
+
 
-    gpt_client = GPTClient(GPTConfig(**cfg.gpt_args))
+def _run_experiment(cfg, run_exp_dir: str, summary_log_path: str, wandb_run, gpt_client: GPTClient,
+                    translation_executor: ThreadPoolExecutor):
     context_domain = Domain(os.path.join(cfg.data_path, 'domains'), cfg.context_domain_name)
     target_domain = Domain(os.path.join(cfg.data_path, 'domains'), cfg.target_domain_name)
-    pddl_env = PDDLEnv(**cfg.env_args)
+    resource_scheduler = configure_scheduler(**cfg.scheduler_args)
+    pddl_env = get_pddl_env(**cfg.env_args)
+    checkpoint = RunCheckpoint(os.path.join(run_exp_dir, "checkpoint.json"), gpt_client, resume=cfg.resume)
     planning_strategy = PlanningStrategy(**cfg.planning_strategy_args)
+    if cfg.share_rating_memo:
+        rating_memo = get_shared_rating_memo(cfg.rating_memo_size)
+    else:
+        rating_memo = RatingMemo(cfg.rating_memo_size)
     first_task_index = 0
 
     # Generate problem translation candidates without any ground truth
     target_problem_list = [target_domain.get_task_pddl(i) for i in range(cfg.max_tasks)]
     if cfg.problem_translation_args.active:
-        problem_translation_candidates = generate_exact_n_problem_translation_candidates(
-            n_candidates=cfg.problem_translation_args.n_candidates,
-            gpt_client=gpt_client,
-            context_domain=context_domain,
-            target_domain=target_domain,
-            task_index=first_task_index,
-            logprob_selection=cfg.problem_translation_args.logprob_selection,
-            logprob_candidates=cfg.problem_translation_args.logprob_candidates,
-            add_domain_proposal=cfg.problem_translation_args.add_domain_proposal,
-            one_domain_per_candidate=cfg.problem_translation_args.one_domain_per_candidate,
-            exp_flags=cfg.exp_flags
-        )
+        problem_translation_candidates = checkpoint.get('problem_translation_candidates')
+        if problem_translation_candidates is None:
+            problem_translation_candidates = generate_exact_n_problem_translation_candidates(
+                n_candidates=cfg.problem_translation_args.n_candidates,
+                gpt_client=gpt_client,
+                context_domain=context_domain,
+                target_domain=target_domain,
+                task_index=first_task_index,
+                logprob_selection=cfg.problem_translation_args.logprob_selection,
+                logprob_candidates=cfg.problem_translation_args.logprob_candidates,
+                add_domain_proposal=cfg.problem_translation_args.add_domain_proposal,
+                one_domain_per_candidate=cfg.problem_translation_args.one_domain_per_candidate,
+                exp_flags=cfg.exp_flags
+            )
+            checkpoint.update('problem_translation_candidates', problem_translation_candidates)
         logging.info(f"Generated {len(problem_translation_candidates)} problem translation candidates.")
         all_ratings, (
             best_rating, best_generated_pddl, best_generated_problem_pddl
@@ -119,18 +196,29 @@ def run(cfg):
             pddl_env=pddl_env,
             planning_strategy=planning_strategy,
             task_index=first_task_index,
-            exp_flags=cfg.exp_flags
+            exp_flags=cfg.exp_flags,
+            checkpoint=checkpoint,
+            rating_memo=rating_memo,
+            rating_seed=cfg.seed,
         )
-        other_task_nls = [target_domain.get_task_nl(i) for i in range(1, cfg.max_tasks)]
-        other_task_templates = [target_domain.get_task_template(i) for i in range(1, cfg.max_tasks)]
-        gen_problem_list = [best_generated_problem_pddl] + translate_problems_given_one_task(
-            gpt_client=gpt_client, domain_pddl=best_generated_pddl, domain_nl=target_domain.get_domain_nl(),
+        # The other tasks are translated in the background, and each is evaluated as soon as it is translated
+        saved_gen_problem_list = checkpoint.get('gen_problem_list', [None] * cfg.max_tasks)
+        gen_problem_list = [best_generated_problem_pddl] + saved_gen_problem_list[1:]
+        untranslated_task_indices = [i for i in range(1, cfg.max_tasks) if gen_problem_list[i] is None]
+        translation_futures = submit_problem_translations(
+            translation_executor, gpt_client=gpt_client, domain_pddl=best_generated_pddl,
+            domain_nl=target_domain.get_domain_nl(),
             context_problem_pddl=best_generated_problem_pddl,
             context_problem_nl=target_domain.get_task_nl(first_task_index),
             context_problem_template_pddl=target_domain.get_task_template(first_task_index),
-            target_problem_nls=other_task_nls,
-            target_problem_templates=other_task_templates
+            target_problem_nls=[target_domain.get_task_nl(i) for i in untranslated_task_indices],
+            target_problem_templates=[target_domain.get_task_template(i) for i in untranslated_task_indices]
         )
+        for task_index, translation_future in zip(untranslated_task_indices, translation_futures):
+            gen_problem_list[task_index] = translation_future
+            translation_future.add_done_callback(
+                functools.partial(_checkpoint_translation, checkpoint, task_index, cfg.max_tasks)
+            )
         logging.info(f"All ratings: {all_ratings}")
     # Assume the target problem is given
     else:
@@ -144,19 +232,37 @@ def run(cfg):
             pddl_env=pddl_env,
             planning_strategy=planning_strategy,
             task_index=first_task_index,
-            exp_flags=cfg.exp_flags
+            exp_flags=cfg.exp_flags,
+            checkpoint=checkpoint,
+            checkpoint_key='target_problem',
+            rating_memo=rating_memo,
+            rating_seed=cfg.seed,
         )
         gen_problem_list = copy.deepcopy(target_problem_list)
 
     logging.info(f"Best generated domain: {best_generated_pddl}")
-    correct_tasks_frac, (correct_tasks_rw_score, rw_t_to_gen_frac, rw_gen_to_t_frac) = evaluate_all_tasks(
-        pddl_env=pddl_env,
-        target_domain_pddl=target_domain.get_domain_pddl(),
-        target_domain_problem_pddls=target_problem_list,
-        target_gen_domain_pddl=best_generated_pddl,
-        target_gen_problem_pddls=gen_problem_list,
-        exp_flags=cfg.exp_flags,
-    )
+    task_results = checkpoint.get('task_results', [None] * len(target_problem_list))
+
+    def log_task_result(task_index, task_result):
+        task_results[task_index] = dataclasses.asdict(task_result)
+        checkpoint.update_item('task_results', task_index, task_results[task_index], len(task_results))
+        wandb_run.log({'task_index': task_index, **task_results[task_index]})
+
+    try:
+        correct_tasks_frac, (correct_tasks_rw_score, rw_t_to_gen_frac, rw_gen_to_t_frac) = evaluate_all_tasks(
+            pddl_env=pddl_env,
+            target_domain_pddl=target_domain.get_domain_pddl(),
+            target_domain_problem_pddls=target_problem_list,
+            target_gen_domain_pddl=best_generated_pddl,
+            target_gen_problem_pddls=gen_problem_list,
+            exp_flags=cfg.exp_flags,
+            n_workers=cfg.eval_workers,
+            on_task_result=log_task_result,
+            known_task_results=[TaskResult(**result) if result is not None else None for result in task_results],
+        )
+    finally:
+        translation_executor.shutdown(cancel_futures=True)
+    gen_problem_list = [problem.result() if isinstance(problem, Future) else problem for problem in gen_problem_list]
 
     # Save and log the results
     summary_metrics = {
@@ -167,16 +273,41 @@ def run(cfg):
         'used_prompt_tokens': gpt_client.used_prompt_tokens,
         'used_completion_tokens': gpt_client.used_completion_tokens,
         'cost_dollars': gpt_client.get_cost(),
+        'llm_rate_limit_wait_seconds': gpt_client.rate_limit_wait_seconds,
+        'prompt_tokens_saved': gpt_client.prompt_tokens_saved,
+        'llm_hedged_requests': gpt_client.n_hedged_requests,
+        # Tokens of the losing hedged requests (partly estimated), not part of the used tokens and cost above
+        'llm_hedge_loser_cost_dollars': gpt_client.get_cost(
+            gpt_client.hedge_loser_prompt_tokens, gpt_client.hedge_loser_completion_tokens
+        ),
     }
+    speculation_stats = aggregate_speculation_stats(
+        aux['problem_candidates_aux'] if cfg.problem_translation_args.active else [aux]
+    )
+    if speculation_stats is not None:
+        summary_metrics['llm_speculation_hit_rate'] = speculation_stats['hit_rate']
+        summary_metrics['llm_speculation_seconds_saved'] = speculation_stats['seconds_saved']
+        # Unused speculative requests are not part of the used tokens and cost above
+        summary_metrics['llm_speculative_missed_calls'] = gpt_client.n_speculative_misses
+        summary_metrics['llm_speculative_missed_prompt_tokens'] = gpt_client.speculative_missed_prompt_tokens
+        summary_metrics['llm_speculative_missed_completion_tokens'] = gpt_client.speculative_missed_completion_tokens
+        summary_metrics['llm_speculative_missed_cost_dollars'] = gpt_client.get_cost(
+            gpt_client.speculative_missed_prompt_tokens, gpt_client.speculative_missed_completion_tokens
+        )
     wandb_run.summary.update(summary_metrics)
-    gpt_client.save_chats(save_dir=os.path.join(run_exp_dir, "chats"))
+    if cfg.save_chats:
+        gpt_client.save_chats(save_dir=os.path.join(run_exp_dir, "chats"))
+    gpt_client.close()
     file_logger = get_file_logger(os.path.join(run_exp_dir, f"run.log"))
     # Save aux as file
     summary_log_dict = {
         'aux': aux,
         'cfg': cfg.to_dict(),
         'summary_metrics': summary_metrics,
+        'llm_latency_stats': gpt_client.get_latency_stats(),
+        'resource_scheduler': resource_scheduler.get_metrics() if resource_scheduler is not None else None,
         'gen_problem_list': gen_problem_list,
+        'task_results': task_results,
         'task_0_problem_translation_candidates': problem_translation_candidates,
         'best_gen_domain_pddl': best_generated_pddl,
 
@@ -185,6 +316,7 @@ def run(cfg):
         json.dump(summary_log_dict, f, indent=2)
     wandb_run.save(summary_log_path)
     file_logger.info(f"Used tokens: {gpt_client.used_tokens}")
+    wandb_run.finish()
 
 
 def main(_):
@@ -192,6 +324,11 @@ def main(_):
     run(cfg)
 
 
+def _checkpoint_translation(checkpoint: RunCheckpoint, task_index: int, n_tasks: int, future: Future):
+    if not future.cancelled() and future.exception() is None:
+        checkpoint.update_item('gen_problem_list', task_index, future.result(), n_tasks)
+
+
 def get_file_logger(log_path):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -220,4 +357,6 @@ def _config_wandb(cfg):
 
 
 if __name__ == '__main__':
+    # The flag is only defined when run as a script, so that experiment_grid.py can import several entry points
+    _CONFIG = config_flags.DEFINE_config_dict('cfg', get_config())
     app.run(main)
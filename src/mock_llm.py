@@ -0,0 +1,273 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Offline stand-in for the OpenAI chat completions API, used for load and latency benchmarks of the pipeline.
+It can run in-process (FakeAsyncOpenAI, selected with gpt_args.backend='mock') or as a local OpenAI-compatible
+server (python src/mock_llm.py --port 8000, selected with gpt_args.base_url='http://localhost:8000/v1').
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from chat_log import load_chats
+from utils import estimate_tokens
+
+DEFAULT_RESPONSE = "```python\n```"
+
+
+class LatencyModel:
+    """
+    Latency distribution of a mock completion, parsed from a spec string:
+        'constant:<seconds>', 'uniform:<low>,<high>', 'normal:<mean>,<std>' or 'lognormal:<median>,<sigma>'
+    An optional '+<seconds per completion token>[,<seconds per prompt token>]' suffix adds a per-token generation
+    (and prompt processing) time, e.g. 'lognormal:1,0.5+0.02' or 'constant:0.5+0.02,0.0002'.
+    """
+
+    def __init__(self, spec: str = 'constant:0', seed: int = 0):
+        dist_spec, _, per_token = spec.partition('+')
+        self.distribution, _, params = dist_spec.partition(':')
+        self.params = [float(x) for x in params.split(',') if len(x) > 0]
+        per_token_params = [float(x) for x in per_token.split(',') if len(x) > 0]
+        self.per_token_seconds = per_token_params[0] if len(per_token_params) > 0 else 0.0
+        self.per_prompt_token_seconds = per_token_params[1] if len(per_token_params) > 1 else 0.0
+        assert self.distribution in ('constant', 'uniform', 'normal', 'lognormal'), f"Unknown latency: {spec}"
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, completion_tokens: int = 0, prompt_tokens: int = 0) -> float:
+        with self._lock:
+            if self.distribution == 'constant':
+                base = self.params[0] if len(self.params) > 0 else 0.0
+            elif self.distribution == 'uniform':
+                base = self.rng.uniform(self.params[0], self.params[1])
+            elif self.distribution == 'normal':
+                base = self.rng.normal(self.params[0], self.params[1])
+            else:
+                base = self.params[0] * np.exp(self.rng.normal(0.0, self.params[1]))
+        return max(0.0, float(base)) + self.per_token_seconds * completion_tokens + \
+            self.per_prompt_token_seconds * prompt_tokens
+
+
+class MockResponder:
+    """
+    Produces chat completion responses. Replayed responses (from saved chat_<id>.json files, or from a chat log) are
+    used when the conversation prefix matches a recorded one, otherwise scripted responses are served in a round-robin
+    fashion.
+    """
+
+    def __init__(self, scripted_responses_path: str = '', replay_chats_dir: str = '', latency: str = 'constant:0',
+                 seed: int = 0):
+        self.scripted_responses = [DEFAULT_RESPONSE]
+        if scripted_responses_path:
+            with open(scripted_responses_path, 'r') as f:
+                self.scripted_responses = json.load(f)
+        self.replayed_responses = {}
+        if replay_chats_dir:
+            self._load_replayed_responses(replay_chats_dir)
+        self.latency_model = LatencyModel(latency, seed=seed)
+        self._next_scripted = 0
+        self._lock = threading.Lock()
+
+    def _load_replayed_responses(self, chats_path: str):
+        for chat in load_chats(chats_path).values():
+            for i, message in enumerate(chat):
+                if message['role'] == 'assistant':
+                    responses = self.replayed_responses.setdefault(self._prefix_key(chat[:i]), [])
+                    if message['content'] not in responses:
+                        responses.append(message['content'])
+        logging.info(f"Loaded replayed responses for {len(self.replayed_responses)} conversation prefixes.")
+
+    @staticmethod
+    def _prefix_key(messages) -> str:
+        prefix = [{'role': m['role'], 'content': m['content']} for m in messages]
+        return hashlib.sha256(json.dumps(prefix).encode('utf-8')).hexdigest()
+
+    def get_contents(self, messages, n: int):
+        replayed = self.replayed_responses.get(self._prefix_key(messages))
+        if replayed is not None:
+            return [replayed[i % len(replayed)] for i in range(n)]
+        with self._lock:
+            contents = [
+                self.scripted_responses[(self._next_scripted + i) % len(self.scripted_responses)] for i in range(n)
+            ]
+            self._next_scripted += n
+        return contents
+
+    def make_completion(self, model: str, messages, n: int = 1, logprobs: bool = False, **kwargs):
+        """
+        Returns the completion (as a dict in the OpenAI response format) and the simulated latency in seconds.
+        """
+        contents = self.get_contents(messages, n)
+        prompt_tokens = sum(estimate_tokens(m['content']) for m in messages)
+        completion_tokens = [estimate_tokens(content) for content in contents]
+        choices = []
+        for i, content in enumerate(contents):
+            choice = {
+                'index': i, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content},
+                'logprobs': None,
+            }
+            if logprobs:
+                choice['logprobs'] = {'content': [
+                    {'token': 'tok', 'logprob': -0.05, 'bytes': None, 'top_logprobs': []}
+                    for _ in range(completion_tokens[i])
+                ]}
+            choices.append(choice)
+        completion = {
+            'id': f"chatcmpl-mock-{uuid.uuid4().hex[:12]}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': choices,
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': sum(completion_tokens),
+                'total_tokens': prompt_tokens + sum(completion_tokens),
+            },
+        }
+        return completion, self.latency_model.sample(max(completion_tokens), prompt_tokens)
+
+
+def make_completion_chunks(completion: dict, chars_per_chunk: int = 4):
+    """
+    Splits a completion dict into streamed chunk dicts, interleaving the choices as the API does.
+    """
+    pieces = []
+    for choice in completion['choices']:
+        content = choice['message']['content']
+        pieces.append([content[j:j + chars_per_chunk] for j in range(0, len(content), chars_per_chunk)])
+    chunks = []
+    for step in range(max(len(p) for p in pieces) + 1):
+        for i, choice in enumerate(completion['choices']):
+            if step > len(pieces[i]):
+                continue
+            is_last = step == len(pieces[i])
+            chunk_choice = {
+                'index': i, 'finish_reason': 'stop' if is_last else None,
+                'delta': {} if is_last else {'role': 'assistant', 'content': pieces[i][step]}, 'logprobs': None,
+            }
+            if choice['logprobs'] is not None and not is_last:
+                chunk_choice['logprobs'] = {'content': [
+                    {'token': pieces[i][step], 'logprob': -0.05, 'bytes': None, 'top_logprobs': []}
+                ]}
+            chunks.append({
+                'id': completion['id'], 'object': 'chat.completion.chunk', 'created': completion['created'],
+                'model': completion['model'], 'choices': [chunk_choice],
+            })
+    return chunks
+
+
+class _FakeStream:
+    def __init__(self, chunks, latency: float):
+        self.chunks = chunks
+        self.chunk_latency = latency / max(1, len(chunks))
+        self.response = SimpleNamespace(aclose=self._aclose)
+        self._closed = False
+
+    async def _aclose(self):
+        self._closed = True
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            if self._closed:
+                return
+            await asyncio.sleep(self.chunk_latency)
+            yield ChatCompletionChunk.model_validate(chunk)
+
+
+class _FakeCompletions:
+    def __init__(self, responder: MockResponder):
+        self.responder = responder
+
+    async def create(self, stream: bool = False, **kwargs):
+        completion, latency = self.responder.make_completion(**kwargs)
+        if stream:
+            return _FakeStream(make_completion_chunks(completion), latency)
+        await asyncio.sleep(latency)
+        return ChatCompletion.model_validate(completion)
+
+
+class FakeAsyncOpenAI:
+    """
+    In-process replacement for openai.AsyncOpenAI, exposing client.chat.completions.create.
+    """
+
+    def __init__(self, responder: MockResponder):
+        self.chat = SimpleNamespace(completions=_FakeCompletions(responder))
+
+
+def serve(responder: MockResponder, host: str, port: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            stream = request.pop('stream', False)
+            completion, latency = responder.make_completion(**request)
+            if stream:
+                self._write_stream(make_completion_chunks(completion), latency)
+                return
+            time.sleep(latency)
+            body = json.dumps(completion).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_stream(self, chunks, latency):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    time.sleep(latency / max(1, len(chunks)))
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # The client stopped the stream early
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logging.info(f"Serving mock OpenAI-compatible completions on http://{host}:{port}/v1")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock LLM server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--scripted_responses_path', default='', help="JSON list of responses to serve in order.")
+    parser.add_argument('--replay_chats_dir', default='', help="Chat log, or directory of saved chat_<id>.json files, to replay.")
+    parser.add_argument('--latency', default='constant:0', help="Latency spec, see LatencyModel.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    responder = MockResponder(args.scripted_responses_path, args.replay_chats_dir, args.latency, args.seed)
+    serve(responder, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
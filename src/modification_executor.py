@@ -0,0 +1,172 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import ast
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import time
+
+from concurrency import POLL_INTERVAL_SECONDS, raise_if_cancelled
+from resource_scheduler import acquire_resources
+
+ALLOWED_CALLS = ('add_or_update_predicates', 'modify_action')
+ALLOWED_IMPORT_MODULES = ('typing',)
+MODIFICATION_TIMEOUT_SECONDS = 30
+MODIFICATION_MEMORY_LIMIT_MB = 2048
+
+
+class UnsupportedCodeError(Exception):
+    pass
+
+
+def execute_modification(pddl_obj, func_modification: str, timeout: float = MODIFICATION_TIMEOUT_SECONDS,
+                         memory_limit_mb: int = MODIFICATION_MEMORY_LIMIT_MB):
+    """
+    Applies the LLM-generated modification code to pddl_obj in place and returns an error message (None on success).
+    Code made only of allow-listed calls with literal arguments is interpreted directly. Anything else is executed
+    in a subprocess with a memory limit and a wall-clock deadline.
+    """
+    try:
+        calls = parse_modification_calls(func_modification)
+    except SyntaxError as e:
+        logging.info(f"Exception while modifying the domain: {e}")
+        return f"Error while executing your code: {e}"
+    except UnsupportedCodeError as e:
+        logging.info(f"Falling back to sandboxed execution of the modification code: {e}")
+        with acquire_resources(cores=1, memory_mb=memory_limit_mb):
+            return _execute_in_subprocess(pddl_obj, func_modification, timeout, memory_limit_mb)
+    try:
+        for fn_name, args, kwargs in calls:
+            getattr(pddl_obj, fn_name)(*args, **kwargs)
+    except Exception as e:
+        logging.info(f"Exception while modifying the domain: {e}")
+        return f"Error while executing your code: {e}"
+    return None
+
+
+def parse_modification_calls(code: str):
+    """
+    Parses the code into a list of (function name, args, kwargs) calls. Only allow-listed calls with literal arguments,
+    assignments of literals to names, typing imports and docstrings are supported.
+    """
+    tree = ast.parse(code)
+    bindings = {}
+    calls = []
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call):
+            calls.append(_parse_call(stmt.value, bindings))
+        elif isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant):
+            continue  # docstring
+        elif isinstance(stmt, ast.Assign) and all(isinstance(t, ast.Name) for t in stmt.targets):
+            value = _eval_literal(stmt.value, bindings)
+            for target in stmt.targets:
+                bindings[target.id] = value
+        elif isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            module_names = [stmt.module] if isinstance(stmt, ast.ImportFrom) else [a.name for a in stmt.names]
+            if not all(name in ALLOWED_IMPORT_MODULES for name in module_names):
+                raise UnsupportedCodeError(f"Unsupported import: {module_names}")
+        elif isinstance(stmt, ast.Pass):
+            continue
+        else:
+            raise UnsupportedCodeError(f"Unsupported statement: {type(stmt).__name__}")
+    return calls
+
+
+def _parse_call(call: ast.Call, bindings: dict):
+    if not isinstance(call.func, ast.Name) or call.func.id not in ALLOWED_CALLS:
+        raise UnsupportedCodeError(f"Unsupported call: {ast.unparse(call.func)}")
+    args = [_eval_literal(arg, bindings) for arg in call.args]
+    kwargs = {kw.arg: _eval_literal(kw.value, bindings) for kw in call.keywords if kw.arg is not None}
+    if len(kwargs) != len(call.keywords):
+        raise UnsupportedCodeError("Unsupported **kwargs in call.")
+    return call.func.id, args, kwargs
+
+
+def _eval_literal(node: ast.AST, bindings: dict):
+    if isinstance(node, ast.Name):
+        if node.id not in bindings:
+            raise UnsupportedCodeError(f"Unknown name: {node.id}")
+        return bindings[node.id]
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [_eval_literal(x, bindings) for x in node.elts]
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _eval_literal(node.left, bindings) + _eval_literal(node.right, bindings)
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise UnsupportedCodeError(f"Unsupported expression: {ast.unparse(node)}")
+
+
+def _execute_in_subprocess(pddl_obj, func_modification: str, timeout: float, memory_limit_mb: int):
+    # A fresh interpreter rather than a fork, which would inherit the threads and the address space of the caller
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(
+        target=_exec_modification, args=(result_queue, pddl_obj, func_modification, memory_limit_mb)
+    )
+    process.start()
+    new_domain_pddl_str, error_msg = None, None
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            raise_if_cancelled()
+            try:
+                new_domain_pddl_str, error_msg = result_queue.get(timeout=POLL_INTERVAL_SECONDS)
+                break
+            except queue.Empty:
+                pass
+            if not process.is_alive():
+                # The process may have put its result right before exiting, otherwise it died (e.g. out of memory)
+                try:
+                    new_domain_pddl_str, error_msg = result_queue.get(timeout=POLL_INTERVAL_SECONDS)
+                except queue.Empty:
+                    logging.info(f"Modification code process died with exit code {process.exitcode}.")
+                break
+    finally:
+        process.join(timeout=1.0)
+        if process.is_alive():
+            process.kill()
+            process.join()
+    if new_domain_pddl_str is None and error_msg is None:
+        logging.info(f"Modification code did not finish within {timeout} seconds or ran out of memory.")
+        return f"Error while executing your code: the code did not finish within {timeout} seconds " \
+               f"or exceeded the memory limit."
+    if new_domain_pddl_str is not None:
+        pddl_obj.update_from_pddl_str(new_domain_pddl_str)
+    return error_msg
+
+
+def _get_address_space_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def _exec_modification(q, pddl_obj, func_modification, memory_limit_mb):
+    # The limit is on top of the address space the interpreter already uses
+    memory_limit = _get_address_space_bytes() + memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    add_or_update_predicates = pddl_obj.add_or_update_predicates
+    modify_action = pddl_obj.modify_action
+    error_msg = None
+    try:
+        exec(func_modification, {
+            'add_or_update_predicates': add_or_update_predicates, 'modify_action': modify_action,
+        })
+    except MemoryError:
+        error_msg = "Error while executing your code: the code exceeded the memory limit."
+    except Exception as e:
+        error_msg = f"Error while executing your code: {e}"
+    try:
+        q.put((pddl_obj.to_str(), error_msg))
+    except MemoryError:
+        q.put((None, "Error while executing your code: the code exceeded the memory limit."))
@@ -5,17 +5,22 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import copy
+import functools
 import logging
+from collections import Counter
 from typing import List
 
 from pddl.logic import Predicate
+from pddl.logic.terms import Variable
 from pddl.logic.base import Or, And
 from pddl.parser.domain import DomainParser
-from pddl.formatter import domain_to_string, problem_to_string
-import functools
+from pddl.formatter import domain_to_string, problem_to_string, _print_predicates_with_types
 
 from pddl.parser.problem import ProblemParser
 
+from modification_executor import execute_modification
+
 
 class PDDLObj:
     def __init__(self, domain_pddl, domain_template_pddl):
@@ -49,15 +54,10 @@ class PDDLObj:
         self._assert_declared_predicates()
 
     def modify_domain(self, func_modification: str):
-        add_or_update_predicates = functools.partial(self.add_or_update_predicates)
-        modify_action = functools.partial(self.modify_action)
-        error_msg = None
-        try:
-            exec(func_modification)
-        except Exception as e:
-            logging.info(f"Exception while modifying the domain: {e}")
-            error_msg = f"Error while executing your code: {e}"
-        return error_msg
+        return execute_modification(self, func_modification)
+
+    def update_from_pddl_str(self, domain_pddl_str: str):
+        self.domain_pddl = PDDLObj.from_pddl_str(domain_pddl_str, self.domain_pddl_template).domain_pddl
 
     def sanity_check_domain(self):
         empty_effect_actions = []
@@ -96,9 +96,9 @@ class PDDLObj:
         return set(PDDLObj.from_pddl_str(template_predicates, self.domain_pddl_template).domain_pddl.predicates)
 
     def _assert_no_duplicate_predicates(self, predicate_list):
-        predicate_names = [predicate.name for predicate in predicate_list]
+        predicate_name_counts = Counter(predicate.name for predicate in predicate_list)
         # More than one occurrence of a predicate name is not allowed
-        duplicate_predicate_names = {name for name in predicate_names if predicate_names.count(name) > 1}
+        duplicate_predicate_names = {name for name, count in predicate_name_counts.items() if count > 1}
         assert len(duplicate_predicate_names) == 0, f"Duplicate predicate names found: {duplicate_predicate_names}."
 
     def _add_existing_predicates(self, new_predicates):
@@ -110,6 +110,26 @@ class PDDLObj:
                 new_updated_predicates.add(predicate)
         return new_updated_predicates
 
+    def get_action_clause_ids(self, action_name, interner):
+        """
+        Returns the interned ids of the top-level precondition and effect clauses of an action. Ids are only comparable
+        between the domains interned with the same interner.
+        """
+        action = self.get_action_by_name(action_name)
+        return (
+            frozenset(interner.intern_all(get_formula_operands(action.precondition))),
+            frozenset(interner.intern_all(get_formula_operands(action.effect))),
+        )
+
+    def get_predicate_strs(self) -> dict:
+        return {
+            predicate.name: _print_predicates_with_types([predicate]) for predicate in self.domain_pddl.predicates
+            if predicate.name != 'dummy-predicate'
+        }
+
+    def get_action_strs(self) -> dict:
+        return {action.name: str(action).replace('(or )', '()') for action in self.domain_pddl.actions}
+
     def get_action_by_name(self, action_name):
         for action in self.domain_pddl.actions:
             if action.name == action_name:
@@ -174,9 +194,63 @@ class PDDLObj:
         return predicate_names
 
 
+class FormulaInterner:
+    """
+    Hash-consing table for PDDL formulas. Every structurally unique atom, literal or compound formula gets a shared
+    integer id, so that equality checks, clause diffs and duplicate detection become integer set operations. The table
+    only grows, so an interner is meant for one comparison or analysis, not for the lifetime of the process.
+    """
+    COMMUTATIVE_OPS = ('And', 'Or', 'AndEffect')
+
+    def __init__(self):
+        self._ids = {}
+        self._formulas = []
+
+    def __len__(self):
+        return len(self._formulas)
+
+    def intern(self, formula) -> int:
+        key = self._get_key(formula)
+        formula_id = self._ids.get(key)
+        if formula_id is None:
+            formula_id = len(self._formulas)
+            self._ids[key] = formula_id
+            self._formulas.append(formula)
+        return formula_id
+
+    def intern_all(self, formulas) -> List[int]:
+        return [self.intern(formula) for formula in formulas]
+
+    def to_formula(self, formula_id: int):
+        return self._formulas[formula_id]
+
+    def _get_key(self, formula):
+        if isinstance(formula, Predicate):
+            return 'atom', formula.name, tuple(
+                (f"?{term.name}" if isinstance(term, Variable) else term.name, tuple(sorted(term.type_tags)))
+                for term in formula.terms
+            )
+        op_name = type(formula).__name__
+        if hasattr(formula, 'operands'):
+            operand_ids = self.intern_all(formula.operands)
+            if op_name in self.COMMUTATIVE_OPS:
+                operand_ids = sorted(operand_ids)
+            return op_name, tuple(operand_ids)
+        if hasattr(formula, 'argument'):
+            return op_name, (self.intern(formula.argument),)
+        return 'formula', str(formula)
+
+
+def get_formula_operands(formula):
+    if hasattr(formula, 'operands') and type(formula).__name__ in FormulaInterner.COMMUTATIVE_OPS:
+        return list(formula.operands)
+    return [formula]
+
+
 class ProblemPDDLObj:
     def __init__(self, problem_pddl):
         self.problem_pddl = problem_pddl
+        self._derived_pddl_strs = {}
 
     @staticmethod
     def from_pddl_str(problem_pddl):
@@ -188,26 +262,152 @@ class ProblemPDDLObj:
     def init_count(self):
         return len(self.problem_pddl.init)
 
+    def empty_goal_str(self):
+        return self._get_derived_pddl_str('empty_goal', empty_goal=True, empty_init=False)
+
+    def empty_goal_and_init_str(self):
+        return self._get_derived_pddl_str('empty_goal_and_init', empty_goal=True, empty_init=True)
+
+    def _get_derived_pddl_str(self, variant: str, empty_goal: bool, empty_init: bool):
+        if variant not in self._derived_pddl_strs:
+            problem_parsed = copy.copy(self.problem_pddl)
+            if empty_goal:
+                problem_parsed._goal = And()
+            if empty_init:
+                problem_parsed._init = set()
+            self._derived_pddl_strs[variant] = problem_to_string(problem_parsed)
+        return self._derived_pddl_strs[variant]
+
+
+@functools.lru_cache(maxsize=256)
+def get_problem_pddl_obj(problem_pddl: str) -> ProblemPDDLObj:
+    """
+    Parses a problem PDDL string once per process. The returned object is shared and must not be mutated.
+    """
+    return ProblemPDDLObj.from_pddl_str(problem_pddl)
+
 
 def get_problem_pddl_empty_goal(problem_pddl: str):
-    problem_parsed = ProblemParser()(problem_pddl)
-    problem_parsed._goal = And()
-    return problem_to_string(problem_parsed)
+    return get_problem_pddl_obj(problem_pddl).empty_goal_str()
 
 
 def get_problem_pddl_empty_goal_and_init(problem_pddl: str):
-    problem_parsed = ProblemParser()(problem_pddl)
-    problem_parsed._goal = And()
-    problem_parsed._init = set()
-    problem_str = problem_to_string(problem_parsed)
-    return problem_str
+    return get_problem_pddl_obj(problem_pddl).empty_goal_and_init_str()
+
+
+def get_domain_diff(old_pddl_obj: PDDLObj, new_pddl_obj: PDDLObj) -> dict:
+    """
+    Predicates and actions that differ between two versions of a domain, as printed PDDL strings.
+    """
+    old_predicates, new_predicates = old_pddl_obj.get_predicate_strs(), new_pddl_obj.get_predicate_strs()
+    old_actions, new_actions = old_pddl_obj.get_action_strs(), new_pddl_obj.get_action_strs()
+    return {
+        'new_predicates': [
+            new_predicates[name] for name in sorted(new_predicates)
+            if old_predicates.get(name) != new_predicates[name]
+        ],
+        'removed_predicates': [old_predicates[name] for name in sorted(old_predicates) if name not in new_predicates],
+        'changed_actions': [
+            new_actions[name] for name in sorted(new_actions) if old_actions.get(name) != new_actions[name]
+        ],
+        'removed_actions': [name for name in sorted(old_actions) if name not in new_actions],
+    }
 
 
 def validate_problem_pddl(problem_pddl):
-    ProblemParser()(problem_pddl)
+    # Through the cache, so that the walks and plan checks of a validated problem do not parse it again
+    get_problem_pddl_obj(problem_pddl)
     return True
 
 
+def canonical_domain_str(domain_pddl: str) -> str:
+    """
+    Canonical form of a domain PDDL string. Two domains that only differ in whitespace, predicate order, action
+    order, the order of conjunct operands, or the spelling of their variables map to the same string.
+    """
+    try:
+        # Round-trip through the formatter first, so that type declarations and typed lists are printed uniformly
+        formatted_pddl = domain_to_string(DomainParser()(PDDLObj.maybe_add_dummy_predicate(domain_pddl)))
+        define_expr = _parse_sexpr(formatted_pddl)
+    except Exception:
+        logging.warning("Could not canonicalize the domain PDDL, falling back to the raw string.")
+        return domain_pddl.strip()
+    header, predicates, actions = [], [], []
+    for section in define_expr:
+        if not isinstance(section, list) or len(section) == 0:
+            header.append(section)
+        elif section[0] == ':predicates':
+            predicates = [_canonical_expr(_rename_variables(pred, {})) for pred in section[1:]]
+        elif section[0] == ':action':
+            actions.append(_canonical_action(section))
+        elif section[0] == ':requirements':
+            header.append([section[0]] + sorted(section[1:]))
+        else:
+            header.append(section)
+    canonical_sections = [_sexpr_to_str(x) for x in header]
+    canonical_sections.append(_sexpr_to_str([':predicates'] + sorted(predicates)))
+    canonical_sections.extend(sorted(actions))
+    return "\n".join(canonical_sections)
+
+
+def _canonical_action(action_expr):
+    var_map = {}
+    canonical_parts = []
+    for i, part in enumerate(action_expr):
+        # Parameters come first, so their order fixes the renaming of the action variables
+        if i > 0 and action_expr[i - 1] in (':parameters', ':precondition', ':effect'):
+            canonical_parts.append(_canonical_expr(_rename_variables(part, var_map)))
+        else:
+            canonical_parts.append(_sexpr_to_str(part))
+    return "(" + " ".join(canonical_parts) + ")"
+
+
+def _rename_variables(expr, var_map):
+    if isinstance(expr, list):
+        return [_rename_variables(x, var_map) for x in expr]
+    if expr.startswith('?'):
+        if expr not in var_map:
+            var_map[expr] = f"?x{len(var_map)}"
+        return var_map[expr]
+    return expr
+
+
+def _canonical_expr(expr) -> str:
+    if not isinstance(expr, list):
+        return expr
+    operands = [_canonical_expr(x) for x in expr]
+    if len(operands) > 0 and operands[0] in ('and', 'or'):
+        operands = [operands[0]] + sorted(set(operands[1:]))
+        if len(operands) == 2:  # (and X) is equivalent to X
+            return operands[1]
+    return "(" + " ".join(operands) + ")"
+
+
+def _sexpr_to_str(expr) -> str:
+    if isinstance(expr, list):
+        return "(" + " ".join(_sexpr_to_str(x) for x in expr) + ")"
+    return expr
+
+
+def _parse_sexpr(pddl_str: str):
+    lines = [line.split(';')[0] for line in pddl_str.lower().split('\n')]
+    tokens = " ".join(lines).replace('(', ' ( ').replace(')', ' ) ').split()
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) == 1:
+                raise ValueError("Unbalanced parentheses in PDDL string.")
+            expr = stack.pop()
+            stack[-1].append(expr)
+        else:
+            stack[-1].append(token)
+    if len(stack) != 1 or len(stack[0]) != 1 or not isinstance(stack[0][0], list):
+        raise ValueError("PDDL string must contain exactly one top-level expression.")
+    return stack[0][0]
+
+
 def extract_atom_arguments(atom_str):
     """
     not contains(shot3, ingredient1)
@@ -5,15 +5,23 @@
 # LICENSE file in the root directory of this source tree.
 #
 
-from typing import List
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import List, Union
 
 from ml_collections import ConfigDict
 
 from domains import Domain, PDDLEnv
-from evaluation import PlanningEvaluator, PlanRatings
+from evaluation import PlanningEvaluator, PlanRatings, RatingMemo
+from concurrency import POLL_INTERVAL_SECONDS, OperationCancelled, cancel_scope, new_child_token, raise_if_cancelled, \
+    rng_scope, spawn_seeds, submit_in_context, wait_for_future
+from checkpoint import RunCheckpoint, get_rng_state, set_rng_state
+from conversation_tree import HistoryPolicy
 from gpt_client import GPTClient
-from pddl_utils import PDDLObj
-from utils import wrap_code, mean, harmonic_mean
+from pddl_utils import PDDLObj, canonical_domain_str, get_domain_diff
+from resource_scheduler import priority_scope
+from utils import wrap_code, mean, harmonic_mean, extract_code
 import prompts
 from dataclasses import dataclass
 import logging
@@ -25,6 +33,19 @@ class PlanningStrategy:
     best_of_n: int = 1
     rw_feedback: bool = True
     bi_rw_feedback: bool = True
+    stream_completions: bool = False  # Rate each completion as soon as its python code block has been streamed
+    stop_at_code_end: bool = False  # With streaming, stop generating a completion once its code block is complete
+    release_unselected_chats: bool = False  # Forget the chats of the completions that were not selected
+    history_policy: str = 'full'  # Which earlier turns to resend: 'full', 'window' or 'summary' (see HistoryPolicy)
+    history_window_turns: int = 1  # Number of most recent turns always resent with 'window' and 'summary'
+    feedback_mode: str = 'full'  # 'full' resends the whole domain, 'diff' only the changed predicates and actions
+    candidate_workers: int = 1  # Problem candidates refined in parallel (0: bounded by LLM concurrency and cores)
+    rating_workers: int = 1  # Best-of-n completions rated in parallel (0: one per core)
+    stop_rating_at_solution: bool = False  # Skip the ratings of the completions after one that finds a solution
+    search: str = 'chain'  # 'chain' continues from the best completion of each turn, 'beam' from the best states
+    beam_width: int = 1  # With beam search, states kept after each turn, each expanded with best_of_n completions
+    expansion_budget: int = 0  # With beam search, maximum number of expanded states, i.e. LLM requests (0: no limit)
+    speculative_next_turn: bool = False  # Request the next turn of the best completion so far while others are rated
 
 
 STOCHASTIC_TEMPERATURE = 0.7
@@ -48,28 +69,50 @@ def evaluate_planning_on_problem_candidates(
         pddl_env: PDDLEnv,
         planning_strategy: PlanningStrategy,
         task_index: int,
-        exp_flags: ConfigDict
+        exp_flags: ConfigDict,
+        checkpoint: RunCheckpoint = None,
+        rating_memo: RatingMemo = None,
+        rating_seed: int = 0,
 ):
-    all_ratings = []
-    best_best_rating, return_params = float('-inf'), None
-    all_aux = {'problem_candidates_aux': [], 'best_candidate_idx': -1}
-    for i, candidate in enumerate(problem_translation_candidates):
-        logging.info(f"Evaluating candidate {i + 1}/{len(problem_translation_candidates)}")
-        best_rating, best_generated_pddl, aux = evaluate_action_level_planning(
+    n_candidates = len(problem_translation_candidates)
+    # The candidates share the ratings of their domains (they are only reused for identical candidates)
+    rating_memo = RatingMemo() if rating_memo is None else rating_memo
+    n_workers = planning_strategy.candidate_workers
+    if n_workers == 0:
+        n_workers = min(n_candidates, gpt_client.config.max_concurrency, os.cpu_count())
+
+    def evaluate_candidate(i):
+        logging.info(f"Evaluating candidate {i + 1}/{n_candidates}")
+        return evaluate_action_level_planning(
             context_domain=context_domain,
             target_domain=target_domain,
-            target_gen_problem_pddl=candidate,
+            target_gen_problem_pddl=problem_translation_candidates[i],
             gpt_client=gpt_client,
             pddl_env=pddl_env,
             planning_strategy=planning_strategy,
             task_index=task_index,
-            exp_flags=exp_flags
+            exp_flags=exp_flags,
+            rating_memo=rating_memo,
+            rating_seed=rating_seed,
+            checkpoint=checkpoint,
+            checkpoint_key=f"candidate_{i}",
         )
+
+    if n_workers > 1:
+        candidate_results = _evaluate_candidates_concurrently(evaluate_candidate, n_candidates, n_workers)
+    else:
+        candidate_results = (evaluate_candidate(i) for i in range(n_candidates))
+
+    all_ratings = []
+    best_best_rating, return_params = float('-inf'), None
+    all_aux = {'problem_candidates_aux': [], 'best_candidate_idx': -1}
+    for i, (best_rating, best_generated_pddl, aux) in enumerate(candidate_results):
+        candidate = problem_translation_candidates[i]
         aux['gen_problem_pddl'] = candidate
-        logging.info(f"Best rating for candidate {i + 1}/{len(problem_translation_candidates)}: {best_rating}")
-        logging.info(f"Candidate {i + 1}/{len(problem_translation_candidates)}: {candidate}")
+        logging.info(f"Best rating for candidate {i + 1}/{n_candidates}: {best_rating}")
+        logging.info(f"Candidate {i + 1}/{n_candidates}: {candidate}")
         logging.info(
-            f"Best generated PDDL for candidate {i + 1}/{len(problem_translation_candidates)}: {best_generated_pddl}")
+            f"Best generated PDDL for candidate {i + 1}/{n_candidates}: {best_generated_pddl}")
         if best_rating > best_best_rating:
             best_best_rating = best_rating
             return_params = (best_rating, best_generated_pddl, candidate)
@@ -78,12 +121,54 @@ def evaluate_planning_on_problem_candidates(
         all_aux['problem_candidates_aux'].append(aux)
         all_ratings.append(best_rating)
         if best_rating == PlanRatings.SOLUTION_FOUND:
-            logging.info(f"Solution found for candidate {i + 1}/{len(problem_translation_candidates)}")
+            logging.info(f"Solution found for candidate {i + 1}/{n_candidates}")
             logging.info(f"Stopping early since a solution was found.")
             break
     return all_ratings, return_params, all_aux
 
 
+def _evaluate_candidates_concurrently(evaluate_candidate, n_candidates: int, n_workers: int):
+    """
+    Runs the refinement loops of the candidates in parallel threads. Once a candidate finds a solution, the
+    candidates after it are cancelled, as the sequential loop would not have run them. Each candidate gets its own
+    random seed, and ratings do not depend on the memo (see PlanningEvaluator.rate_domain), so the results of the
+    candidates up to the first solved one are the same as if they ran alone.
+    """
+    seeds = spawn_seeds(n_candidates)
+    cancel_tokens = [new_child_token() for _ in range(n_candidates)]
+    results = [None] * n_candidates
+    first_solved_idx = n_candidates
+
+    def run_candidate(i):
+        with cancel_scope(cancel_tokens[i]), rng_scope(seeds[i]):
+            return evaluate_candidate(i)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {submit_in_context(executor, run_candidate, i): i for i in range(n_candidates)}
+        for future in as_completed(futures):
+            i = futures[future]
+            if i > first_solved_idx or future.cancelled():
+                continue
+            try:
+                results[i] = future.result()
+            except OperationCancelled:
+                continue
+            except Exception:
+                for cancel_token in cancel_tokens:
+                    cancel_token.cancel()
+                raise
+            if results[i][0] == PlanRatings.SOLUTION_FOUND:
+                logging.info(f"Solution found for candidate {i + 1}/{n_candidates}, cancelling the later candidates.")
+                first_solved_idx = i
+                for other_future, j in futures.items():
+                    if j > i:
+                        cancel_tokens[j].cancel()
+                        other_future.cancel()
+    # The candidates before the first solved one are only cancelled together with the caller
+    raise_if_cancelled()
+    return results[:first_solved_idx + 1]
+
+
 def evaluate_action_level_planning(
         context_domain: Domain,
         target_domain: Domain,
@@ -92,8 +177,22 @@ def evaluate_action_level_planning(
         pddl_env: PDDLEnv,
         planning_strategy: PlanningStrategy,
         task_index: int,
-        exp_flags: ConfigDict
+        exp_flags: ConfigDict,
+        rating_memo: RatingMemo = None,
+        checkpoint: RunCheckpoint = None,
+        checkpoint_key: str = None,
+        rating_seed: int = 0,
 ):
+    """
+    Refines the domain over the turns of one conversation, or of a beam of conversations with the 'beam' search. With
+    a checkpoint, the state is saved under checkpoint_key after each turn, and a saved refinement is continued from
+    its last turn (or returned if it was complete).
+    """
+    turn_state = checkpoint.get(checkpoint_key) if checkpoint is not None else None
+    if turn_state is not None and turn_state['result'] is not None:
+        logging.info(f"Restored the result of {checkpoint_key} from the checkpoint")
+        set_rng_state(turn_state['rng_state'])
+        return tuple(turn_state['result'])
     target_domain_nl_wrapped = wrap_code(target_domain.get_domain_nl(), lang='markdown')
     target_domain_pddl = target_domain.get_domain_pddl()
     target_domain_template_pddl = target_domain.get_domain_template_pddl()
@@ -115,45 +214,451 @@ def evaluate_action_level_planning(
     planning_evaluator = PlanningEvaluator(
         pddl_env, target_domain_pddl, target_problem_pddl, target_gen_problem_pddl,
         planning_strategy.rw_feedback, target_domain.get_domain_predicate_descriptor(),
-        exp_flags=exp_flags, bi_rw_feedback=planning_strategy.bi_rw_feedback
+        exp_flags=exp_flags, bi_rw_feedback=planning_strategy.bi_rw_feedback, rating_memo=rating_memo,
+        seed=rating_seed
     )
     turns = planning_strategy.turns
     best_rating, best_generated_pddl, best_conv_id = float('-inf'), "", ""
     aux = {}
-    conv_id, _ = gpt_client.make_new_chat(system_message=SYSTEM_MESSAGE)
-    user_input = init_prompt
-    for step in range(1, turns + 1):
-        old_conv_id = conv_id
-        conv_id, planning_evaluation, response_aux = _get_best_of_n_responses(
-            gpt_client, planning_evaluator, pddl_obj, conv_id, user_input, planning_strategy.best_of_n
+    # The system message and the initial prompt are always resent
+    history_policy = HistoryPolicy(
+        planning_strategy.history_policy, keep_last_turns=planning_strategy.history_window_turns, n_prefix_messages=2
+    )
+    assert planning_strategy.feedback_mode in ('full', 'diff'), \
+        f"Unknown feedback mode: {planning_strategy.feedback_mode}"
+    # With diff feedback, the domain the model has last seen: the template, then the domain of each feedback message.
+    # If earlier turns may be dropped from the history, diffs are always taken against the template.
+    shown_pddl_obj, shown_step = pddl_obj, 0
+    rating_workers = planning_strategy.rating_workers if planning_strategy.rating_workers > 0 else os.cpu_count()
+    assert planning_strategy.search in ('chain', 'beam'), f"Unknown search: {planning_strategy.search}"
+    if planning_strategy.search == 'beam':
+        return _beam_search_refinement(
+            gpt_client, planning_evaluator, planning_strategy, pddl_obj, init_prompt, target_domain_template_pddl,
+            history_policy, rating_workers, checkpoint=checkpoint, checkpoint_key=checkpoint_key, turn_state=turn_state
+        )
+    first_step = 1
+    if turn_state is None:
+        conv_id, _ = gpt_client.make_new_chat(system_message=SYSTEM_MESSAGE)
+        user_input = init_prompt
+    else:
+        logging.info(f"Resuming {checkpoint_key} after turn {turn_state['step']} from the checkpoint")
+        conv_id, user_input = turn_state['conv_id'], turn_state['user_input']
+        gpt_client.restore_chat(conv_id, turn_state['messages'])
+        pddl_obj = PDDLObj.from_pddl_str(turn_state['domain_pddl'], domain_pddl_template=target_domain_template_pddl)
+        shown_pddl_obj = PDDLObj.from_pddl_str(
+            turn_state['shown_domain_pddl'], domain_pddl_template=target_domain_template_pddl
         )
-        pddl_obj = planning_evaluation.new_pddl_obj
-        new_domain_pddl = pddl_obj.to_str()
-        err_msg = planning_evaluation.error_msg
-        rating = planning_evaluation.rating
+        shown_step = turn_state['shown_step']
+        best_rating, best_generated_pddl, best_conv_id = turn_state['best']
+        set_rng_state(turn_state['rng_state'])
+        first_step = turn_state['step'] + 1
 
-        if err_msg is not None and len(err_msg) > 0:
-            maybe_error = f"The environment returned the following error:\n\n{err_msg}\n\n"
-        else:
-            maybe_error = ""
-        logging.info(f"Generated Domain Rating: {rating}")
-        if rating > best_rating:
-            best_rating = rating
-            best_generated_pddl = new_domain_pddl
-            best_conv_id = conv_id
-        if planning_evaluation.solution_found:
-            break
-        user_input = f"Incorrect. {maybe_error}Please reason about the issue with your generated code. The current domain pddl is as follows:\n\n{wrap_code(new_domain_pddl, lang='pddl')}\n\nIn your response, please generate a new code to fix the issue."
+    def save_turn_state(step, result=None):
+        if checkpoint is None:
+            return
+        checkpoint.update(checkpoint_key, {
+            'step': step, 'conv_id': conv_id, 'messages': gpt_client.get_chat_messages(conv_id),
+            'user_input': user_input, 'domain_pddl': pddl_obj.to_str(), 'shown_domain_pddl': shown_pddl_obj.to_str(),
+            'shown_step': shown_step, 'best': [best_rating, best_generated_pddl, best_conv_id],
+            'rng_state': get_rng_state(), 'result': result,
+        })
+
+    def get_next_turn_feedback(planning_evaluation, step):
+        """
+        The feedback on the domain of a completion, and the domain the model has last seen once it is sent.
+        """
+        new_pddl_obj = planning_evaluation.new_pddl_obj
+        if planning_strategy.feedback_mode == 'full':
+            return _build_feedback_message(planning_evaluation.error_msg, new_pddl_obj), shown_pddl_obj, shown_step
+        feedback = _build_feedback_message(planning_evaluation.error_msg, new_pddl_obj, shown_pddl_obj, shown_step)
+        if planning_strategy.history_policy == 'full':
+            return feedback, new_pddl_obj, step
+        return feedback, shown_pddl_obj, shown_step
 
+    speculation = None
+    if planning_strategy.speculative_next_turn and planning_strategy.best_of_n > 1 \
+            and not planning_strategy.stream_completions:
+        speculation = _NextTurnSpeculation(
+            gpt_client, planning_strategy.best_of_n, STOCHASTIC_TEMPERATURE, history_policy
+        )
+    try:
+        for step in range(first_step, turns + 1):
+            raise_if_cancelled()
+            old_conv_id = conv_id
+
+            def speculate_next_turn(best_conv_id_so_far, best_evaluation_so_far):
+                if step < turns and not best_evaluation_so_far.solution_found:
+                    speculation.speculate(
+                        best_conv_id_so_far, get_next_turn_feedback(best_evaluation_so_far, step)[0]
+                    )
+
+            # With a resource scheduler, the LLM requests and ratings of the refinements with the best domain so far
+            # (e.g. of the best problem candidate) are admitted first
+            with priority_scope(-best_rating if best_rating > float('-inf') else 0.0):
+                conv_id, planning_evaluation, response_aux = _get_best_of_n_responses(
+                    gpt_client, planning_evaluator, pddl_obj, conv_id, user_input, planning_strategy.best_of_n,
+                    stream=planning_strategy.stream_completions, stop_at_code_end=planning_strategy.stop_at_code_end,
+                    history_policy=history_policy, rating_workers=rating_workers,
+                    stop_rating_at_solution=planning_strategy.stop_rating_at_solution, speculation=speculation,
+                    on_best_so_far=speculate_next_turn if speculation is not None else None
+                )
+            if planning_strategy.release_unselected_chats:
+                gpt_client.release_chats(
+                    [old_conv_id] + [c_id for c_id in response_aux["all_conv_ids"] if c_id != conv_id]
+                )
+            pddl_obj = planning_evaluation.new_pddl_obj
+            new_domain_pddl = pddl_obj.to_str()
+            rating = planning_evaluation.rating
+            logging.info(f"Generated Domain Rating: {rating}")
+            if rating > best_rating:
+                best_rating = rating
+                best_generated_pddl = new_domain_pddl
+                best_conv_id = conv_id
+            if planning_evaluation.solution_found:
+                break
+            user_input, shown_pddl_obj, shown_step = get_next_turn_feedback(planning_evaluation, step)
+            save_turn_state(step)
+    finally:
+        if speculation is not None:
+            speculation.discard()
+
+    if speculation is not None:
+        aux["speculation_stats"] = speculation.get_stats()
     aux.update({
         "best_conv_id": best_conv_id,
         "best_rating": best_rating,
         "best_generated_domain_pddl": best_generated_pddl,
     })
     logging.info(f"Best rating: {best_rating} with conversation id: {best_conv_id}")
+    save_turn_state(turns, result=[best_rating, best_generated_pddl, aux])
     return best_rating, best_generated_pddl, aux
 
 
+@dataclass
+class _SearchState:
+    """
+    A state of the beam search: a conversation, the domain after its last completion and the feedback to send next.
+    """
+    conv_id: str
+    pddl_obj: PDDLObj
+    user_input: str
+    shown_pddl_obj: PDDLObj  # With diff feedback, the domain the model has last seen
+    shown_step: int
+    rating: float = float('-inf')
+
+    def to_json(self, gpt_client: GPTClient):
+        return {
+            'conv_id': self.conv_id, 'messages': gpt_client.get_chat_messages(self.conv_id),
+            'domain_pddl': self.pddl_obj.to_str(), 'user_input': self.user_input,
+            'shown_domain_pddl': self.shown_pddl_obj.to_str(), 'shown_step': self.shown_step, 'rating': self.rating,
+        }
+
+    @staticmethod
+    def from_json(state_json, gpt_client: GPTClient, domain_template_pddl: str):
+        gpt_client.restore_chat(state_json['conv_id'], state_json['messages'])
+        return _SearchState(
+            state_json['conv_id'],
+            PDDLObj.from_pddl_str(state_json['domain_pddl'], domain_pddl_template=domain_template_pddl),
+            state_json['user_input'],
+            PDDLObj.from_pddl_str(state_json['shown_domain_pddl'], domain_pddl_template=domain_template_pddl),
+            state_json['shown_step'], state_json['rating'],
+        )
+
+
+def _beam_search_refinement(
+        gpt_client: GPTClient, planning_evaluator: PlanningEvaluator, planning_strategy: PlanningStrategy,
+        pddl_obj: PDDLObj, init_prompt: str, domain_template_pddl: str, history_policy: HistoryPolicy,
+        rating_workers: int, checkpoint: RunCheckpoint = None, checkpoint_key: str = None, turn_state: dict = None,
+):
+    """
+    Beam search over refinement states, with the turns as its depth. At each turn, the states of the frontier are
+    expanded concurrently with best_of_n completions each, all the completions are rated together, and the
+    beam_width best resulting states become the next frontier. States are identified by their canonical domain and
+    feedback: a state that was already reached is rated from the memo and only kept if there are not enough new
+    states. The search stops at the first solution, or once expansion_budget states were expanded.
+    """
+    beam_width = planning_strategy.beam_width
+    assert beam_width >= 1, f"Invalid beam width: {beam_width}"
+    n_completions = planning_strategy.best_of_n
+    temp = DETERMINISTIC_TEMPERATURE if n_completions == 1 else STOCHASTIC_TEMPERATURE
+    expansion_budget = planning_strategy.expansion_budget
+    best_rating, best_generated_pddl, best_conv_id = float('-inf'), "", ""
+    stats = {'n_expansions': 0, 'n_completions': 0, 'n_repeated_states': 0}
+    first_step = 1
+    if turn_state is None:
+        conv_id, _ = gpt_client.make_new_chat(system_message=SYSTEM_MESSAGE)
+        frontier = [_SearchState(conv_id, pddl_obj, init_prompt, pddl_obj, 0)]
+        seen_keys = {(canonical_domain_str(pddl_obj.to_str()), None)}
+    else:
+        logging.info(f"Resuming the beam search of {checkpoint_key} after turn {turn_state['step']}")
+        frontier = [
+            _SearchState.from_json(state_json, gpt_client, domain_template_pddl)
+            for state_json in turn_state['frontier']
+        ]
+        seen_keys = {tuple(key) for key in turn_state['seen_keys']}
+        best_rating, best_generated_pddl, best_conv_id = turn_state['best']
+        stats = turn_state['stats']
+        set_rng_state(turn_state['rng_state'])
+        first_step = turn_state['step'] + 1
+
+    def save_turn_state(step, result=None):
+        if checkpoint is None:
+            return
+        checkpoint.update(checkpoint_key, {
+            'step': step, 'frontier': [state.to_json(gpt_client) for state in frontier],
+            'seen_keys': [list(key) for key in seen_keys], 'best': [best_rating, best_generated_pddl, best_conv_id],
+            'stats': stats, 'rng_state': get_rng_state(), 'result': result,
+        })
+
+    for step in range(first_step, planning_strategy.turns + 1):
+        raise_if_cancelled()
+        if expansion_budget > 0:
+            frontier = frontier[:expansion_budget - stats['n_expansions']]
+        if len(frontier) == 0:
+            logging.info(f"Expansion budget of {expansion_budget} states exhausted")
+            break
+        expansions = _expand_search_states(gpt_client, frontier, n_completions, temp, history_policy)
+        parents = [parent for parent, (conv_ids, _) in zip(frontier, expansions) for _ in conv_ids]
+        child_conv_ids = [c_id for conv_ids, _ in expansions for c_id in conv_ids]
+        gpt_outputs = [gpt_output for _, outputs in expansions for gpt_output in outputs]
+        stats['n_expansions'] += len(frontier)
+        stats['n_completions'] += len(child_conv_ids)
+        with priority_scope(-best_rating if best_rating > float('-inf') else 0.0):
+            evaluations = planning_evaluator.rate_domain_modifications(
+                [parent.pddl_obj for parent in parents], gpt_outputs,
+                n_workers=rating_workers, stop_at_solution=planning_strategy.stop_rating_at_solution
+            )
+
+        # Children in order of expansion, without the states reached earlier in this turn
+        children, child_keys, is_repeated = [], set(), []
+        for parent, child_conv_id, planning_evaluation in zip(parents, child_conv_ids, evaluations):
+            if planning_evaluation is None:  # Not rated, since an earlier completion found a solution
+                continue
+            new_pddl_obj = planning_evaluation.new_pddl_obj
+            rating = planning_evaluation.rating
+            if rating > best_rating:
+                best_rating = rating
+                best_generated_pddl = new_pddl_obj.to_str()
+                best_conv_id = child_conv_id
+            key = (canonical_domain_str(new_pddl_obj.to_str()), planning_evaluation.error_msg)
+            if key in child_keys:
+                stats['n_repeated_states'] += 1
+                continue
+            child_keys.add(key)
+            is_repeated.append(key in seen_keys)
+            stats['n_repeated_states'] += key in seen_keys
+            shown_pddl_obj, shown_step = parent.shown_pddl_obj, parent.shown_step
+            if planning_strategy.feedback_mode == 'diff':
+                user_input = _build_feedback_message(
+                    planning_evaluation.error_msg, new_pddl_obj, shown_pddl_obj, shown_step
+                )
+                if planning_strategy.history_policy == 'full':
+                    shown_pddl_obj, shown_step = new_pddl_obj, step
+            else:
+                user_input = _build_feedback_message(planning_evaluation.error_msg, new_pddl_obj)
+            children.append(_SearchState(child_conv_id, new_pddl_obj, user_input, shown_pddl_obj, shown_step, rating))
+        logging.info(f"Turn {step}: {len(children)} distinct states from {len(frontier)} expanded states, "
+                     f"ratings {[child.rating for child in children]}, best rating {best_rating}")
+        seen_keys.update(child_keys)
+        order = sorted(range(len(children)), key=lambda i: (is_repeated[i], -children[i].rating, i))
+        next_frontier = [children[i] for i in order[:beam_width]]
+        if planning_strategy.release_unselected_chats:
+            kept_conv_ids = {state.conv_id for state in next_frontier}
+            gpt_client.release_chats(
+                [state.conv_id for state in frontier] + [c_id for c_id in child_conv_ids if c_id not in kept_conv_ids]
+            )
+        frontier = next_frontier
+        if best_rating == PlanRatings.SOLUTION_FOUND:
+            break
+        save_turn_state(step)
+
+    aux = {
+        "best_conv_id": best_conv_id,
+        "best_rating": best_rating,
+        "best_generated_domain_pddl": best_generated_pddl,
+        "search_stats": stats,
+    }
+    logging.info(f"Best rating: {best_rating} with conversation id: {best_conv_id}, search stats: {stats}")
+    save_turn_state(planning_strategy.turns, result=[best_rating, best_generated_pddl, aux])
+    return best_rating, best_generated_pddl, aux
+
+
+def _expand_search_states(gpt_client: GPTClient, states: List[_SearchState], n_completions: int, temp: float,
+                          history_policy: HistoryPolicy):
+    """
+    Requests the completions of the states concurrently. Returns the conversation ids and outputs of each state.
+    """
+
+    def expand(state):
+        # With a resource scheduler, the LLM requests of the best states are admitted first
+        with priority_scope(-state.rating if state.rating > float('-inf') else 0.0):
+            conv_ids, gpt_outputs, _ = gpt_client.complete_n_chats(
+                state.conv_id, state.user_input, n_completions, temp=temp, history_policy=history_policy
+            )
+        return conv_ids, gpt_outputs
+
+    if len(states) == 1:
+        return [expand(states[0])]
+    cancel_token = new_child_token()
+    with cancel_scope(cancel_token), ThreadPoolExecutor(max_workers=len(states)) as executor:
+        futures = [submit_in_context(executor, expand, state) for state in states]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            cancel_token.cancel()
+            raise
+
+
+class _NextTurnSpeculation:
+    """
+    Request of the next turn for the best completion rated so far, made while the other completions of the turn are
+    still being rated (with best_of_n > 1 and without streaming). The next turn uses it if that completion ends up
+    best, and it is cancelled otherwise.
+    """
+
+    def __init__(self, gpt_client: GPTClient, n_completions: int, temp: float, history_policy: HistoryPolicy):
+        self.gpt_client = gpt_client
+        self.n_completions = n_completions
+        self.temp = temp
+        self.history_policy = history_policy
+        self.n_speculations = 0
+        self.n_hits = 0
+        self.seconds_saved = 0.0
+        self._request = None
+
+    def speculate(self, conv_id, user_input):
+        self.discard()
+        copy_conv_id, future = self.gpt_client.submit_n_chats(
+            conv_id, user_input, self.n_completions, self.temp, history_policy=self.history_policy
+        )
+        request = {
+            'conv_id': conv_id, 'user_input': user_input, 'copy_conv_id': copy_conv_id, 'future': future,
+            'start_time': time.time(), 'end_time': None,
+        }
+        future.add_done_callback(lambda _: request.update(end_time=time.time()))
+        self._request = request
+        self.n_speculations += 1
+
+    def take(self, conv_id, user_input):
+        """
+        Returns the result of the speculative request if it was made for this turn, or None after discarding it.
+        """
+        request = self._request
+        if request is None or (request['conv_id'], request['user_input']) != (conv_id, user_input):
+            self.discard()
+            return None
+        self._request = None
+        needed_time = time.time()
+        try:
+            result = wait_for_future(request['future'])
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            logging.warning(f"The speculative request failed, requesting the turn again: {e}")
+            self.gpt_client.settle_speculation(request['copy_conv_id'], used=False)
+            self.gpt_client.release_chats([request['copy_conv_id']])
+            return None
+        self.gpt_client.release_chats([request['copy_conv_id']])
+        try:
+            self.gpt_client.settle_speculation(request['copy_conv_id'], used=True)
+        except ValueError:
+            # Out of calls, so the regular request of the turn fails in the same way
+            self.gpt_client.release_chats(result[0])
+            return None
+        # Without speculation, the request would have started now and taken as long
+        latency = (request['end_time'] or time.time()) - request['start_time']
+        self.seconds_saved += min(latency, needed_time - request['start_time'])
+        self.n_hits += 1
+        return result
+
+    def discard(self):
+        request, self._request = self._request, None
+        if request is None:
+            return
+        future = request['future']
+        discarded_conv_ids = [request['copy_conv_id']]
+        # A request cancelled before it completed releases its completions itself
+        if not future.cancel() and future.exception() is None:
+            discarded_conv_ids += future.result()[0]
+        self.gpt_client.settle_speculation(request['copy_conv_id'], used=False)
+        self.gpt_client.release_chats(discarded_conv_ids)
+
+    def get_stats(self) -> dict:
+        return {
+            'n_speculations': self.n_speculations,
+            'n_hits': self.n_hits,
+            'hit_rate': self.n_hits / self.n_speculations if self.n_speculations > 0 else None,
+            'seconds_saved': self.seconds_saved,
+        }
+
+
+def aggregate_speculation_stats(auxes: List[dict]):
+    """
+    Speculation stats summed over the refinements (e.g. the problem candidates) of a run, or None without any.
+    """
+    all_stats = [aux['speculation_stats'] for aux in auxes if 'speculation_stats' in aux]
+    if len(all_stats) == 0:
+        return None
+    n_speculations = sum(stats['n_speculations'] for stats in all_stats)
+    n_hits = sum(stats['n_hits'] for stats in all_stats)
+    return {
+        'n_speculations': n_speculations,
+        'n_hits': n_hits,
+        'hit_rate': n_hits / n_speculations if n_speculations > 0 else None,
+        'seconds_saved': sum(stats['seconds_saved'] for stats in all_stats),
+    }
+
+
+def _build_feedback_message(err_msg, new_pddl_obj, shown_pddl_obj=None, shown_step=0):
+    """
+    Feedback on an incorrect domain. Given the domain the model has last seen, only the predicates and actions that
+    changed since then are sent, unless the whole domain is shorter.
+    """
+    if err_msg is not None and len(err_msg) > 0:
+        maybe_error = f"The environment returned the following error:\n\n{err_msg}\n\n"
+    else:
+        maybe_error = ""
+    new_domain_pddl = new_pddl_obj.to_str()
+    domain_msg = f"The current domain pddl is as follows:\n\n{wrap_code(new_domain_pddl, lang='pddl')}"
+    if shown_pddl_obj is not None:
+        diff_msg = _format_domain_diff(get_domain_diff(shown_pddl_obj, new_pddl_obj), shown_step)
+        if len(diff_msg) < len(domain_msg):
+            domain_msg = diff_msg
+    return f"Incorrect. {maybe_error}Please reason about the issue with your generated code. {domain_msg}\n\nIn your response, please generate a new code to fix the issue."
+
+
+def _format_domain_diff(domain_diff, shown_step):
+    if shown_step == 0:
+        reference = "the target PDDL template of the first message"
+    else:
+        reference = f"the domain pddl after your attempt {shown_step}"
+    if not any(len(x) > 0 for x in domain_diff.values()):
+        return f"The current domain pddl is the same as {reference}."
+    lines = [f"The current domain pddl differs from {reference} only in the following predicates and actions:"]
+    for key, title in [
+        ('new_predicates', "New or updated predicates"), ('removed_predicates', "Removed predicates"),
+        ('changed_actions', "Updated actions"),
+    ]:
+        if len(domain_diff[key]) > 0:
+            section_pddl = "\n".join(domain_diff[key])
+            lines.append(f"{title}:\n\n{wrap_code(section_pddl, lang='pddl')}")
+    if len(domain_diff['removed_actions']) > 0:
+        lines.append(f"Removed actions: {', '.join(domain_diff['removed_actions'])}")
+    lines.append("All other predicates and actions are unchanged.")
+    return "\n\n".join(lines)
+
+
+@dataclass
+class TaskResult:
+    """
+    Evaluation of the generated domain on one task. The random walk fractions are None if they were not computed.
+    """
+    is_domain_valid: bool
+    is_plan_valid: bool
+    t_to_gen_frac: float = None
+    gen_to_t_frac: float = None
+
+
 def evaluate_all_tasks(
         pddl_env: PDDLEnv,
         target_domain_pddl: str,
@@ -161,87 +666,258 @@ def evaluate_all_tasks(
         target_gen_domain_pddl: str,
         target_gen_problem_pddls: List[str],
         exp_flags: ConfigDict,
+        n_workers: int = 1,
+        on_task_result=None,
+        known_task_results: List[TaskResult] = None,
 ):
-    args = (
+    """
+    Returns the fraction of tasks whose generated plan is valid in the target domain, and the random walk scores.
+    The tasks are evaluated by up to n_workers parallel jobs (0: one per core), and on_task_result(task_index,
+    task_result) is called as each task completes. Tasks with a known result (e.g. from a checkpoint) are not rerun.
+    """
+    task_results = evaluate_tasks(
         pddl_env, target_domain_pddl, target_domain_problem_pddls, target_gen_domain_pddl, target_gen_problem_pddls,
-        exp_flags
+        exp_flags, n_workers=n_workers, on_task_result=on_task_result, known_task_results=known_task_results
     )
-    return _evaluate_all_tasks_plan_gen(*args), evaluate_all_tasks_random_walk(*args)
+    return aggregate_plan_gen_score(task_results), aggregate_random_walk_scores(task_results)
 
 
-def _evaluate_all_tasks_plan_gen(
+def evaluate_all_tasks_random_walk(
         pddl_env: PDDLEnv,
         target_domain_pddl: str,
         target_domain_problem_pddls: List[str],
         target_gen_domain_pddl: str,
         target_gen_problem_pddls: List[str],
         exp_flags: ConfigDict,
+        n_workers: int = 1,
 ):
-    assert len(target_domain_problem_pddls) == len(target_gen_problem_pddls)
-    n_valids = 0
-    for t_gen_p, t_gt_p in zip(target_gen_problem_pddls, target_domain_problem_pddls):
-        gen_plan, is_domain_valid, error_msg = pddl_env.search_plan(target_gen_domain_pddl, t_gen_p)
-        if gen_plan is not None:
-            is_plan_valid, _ = pddl_env.validate_plan(target_domain_pddl, t_gt_p, gen_plan)
-            if is_plan_valid:
-                n_valids += 1
-    return n_valids / len(target_domain_problem_pddls)
+    task_results = evaluate_tasks(
+        pddl_env, target_domain_pddl, target_domain_problem_pddls, target_gen_domain_pddl, target_gen_problem_pddls,
+        exp_flags, n_workers=n_workers, plan_gen=False
+    )
+    return aggregate_random_walk_scores(task_results)
 
 
-def evaluate_all_tasks_random_walk(
+def evaluate_tasks(
         pddl_env: PDDLEnv,
         target_domain_pddl: str,
         target_domain_problem_pddls: List[str],
         target_gen_domain_pddl: str,
-        target_gen_problem_pddls: List[str],
+        target_gen_problem_pddls: List[Union[str, Future]],
         exp_flags: ConfigDict,
-):
+        n_workers: int = 1,
+        on_task_result=None,
+        plan_gen: bool = True,
+        random_walks: bool = True,
+        known_task_results: List[TaskResult] = None,
+) -> List[TaskResult]:
+    """
+    Evaluates each task as one job (plan search, plan validation and random walks). Each task gets its own random
+    seed, drawn from the run generator in task order before any task starts, so the results are the same for any
+    number of workers. Generated problems can be given as futures (e.g. of their translations), in which case each task
+    is started as soon as its problem is ready.
+    """
     assert len(target_domain_problem_pddls) == len(target_gen_problem_pddls)
-    t_to_gen_scores, gen_to_t_score = [], []
-    dummy_pred_desc = """def describe_predicate(*args, **kwargs): return ("", "")"""
-    for t_gen_p, t_gt_p in zip(target_gen_problem_pddls, target_domain_problem_pddls):
+    n_tasks = len(target_domain_problem_pddls)
+    n_workers = min(n_tasks, n_workers if n_workers > 0 else os.cpu_count())
+    gen_problem_futures = [
+        problem if isinstance(problem, Future) else _completed_future(problem) for problem in target_gen_problem_pddls
+    ]
+    if random_walks:
+        # Parse each domain once and ground it against all tasks in parallel, instead of once per random walk. The
+        # problems that are not generated yet are grounded by their own task.
+        pddl_env.ground_tasks(target_domain_pddl, target_domain_problem_pddls)
+        pddl_env.ground_tasks(target_gen_domain_pddl, [
+            future.result() for future in gen_problem_futures if future.done() and future.exception() is None
+        ])
+    seeds = spawn_seeds(n_tasks)
+    task_results = [None] * n_tasks
+
+    def run_task(i, target_gen_problem_pddl):
+        with rng_scope(seeds[i]):
+            return evaluate_task(
+                pddl_env, target_domain_pddl, target_domain_problem_pddls[i], target_gen_domain_pddl,
+                target_gen_problem_pddl, exp_flags, plan_gen=plan_gen, random_walks=random_walks
+            )
+
+    def complete_task(i, task_result):
+        task_results[i] = task_result
+        logging.info(f"Task {i + 1}/{n_tasks} evaluated: {task_result}")
+        if on_task_result is not None:
+            on_task_result(i, task_result)
+
+    known_task_results = known_task_results or [None] * n_tasks
+    if n_workers <= 1:
+        for i in range(n_tasks):
+            task_result = known_task_results[i]
+            if task_result is None:
+                task_result = run_task(i, wait_for_future(gen_problem_futures[i]))
+            complete_task(i, task_result)
+        return task_results
+
+    for i in range(n_tasks):
+        if known_task_results[i] is not None:
+            complete_task(i, known_task_results[i])
+    cancel_token = new_child_token()
+    with cancel_scope(cancel_token), ThreadPoolExecutor(max_workers=n_workers) as executor:
+        waiting = {future: i for i, future in enumerate(gen_problem_futures) if known_task_results[i] is None}
+        running = {}
+        try:
+            while len(waiting) + len(running) > 0:
+                done, _ = wait(
+                    list(waiting) + list(running), timeout=POLL_INTERVAL_SECONDS, return_when=FIRST_COMPLETED
+                )
+                raise_if_cancelled()
+                # Tasks are started in order of their index among the ready ones, as in the sequential loop
+                for future in sorted(done, key=lambda f: waiting.get(f, running.get(f))):
+                    if future in waiting:
+                        i = waiting.pop(future)
+                        running[submit_in_context(executor, run_task, i, future.result())] = i
+                    else:
+                        complete_task(running.pop(future), future.result())
+        except BaseException:
+            cancel_token.cancel()
+            raise
+    return task_results
+
+
+def _completed_future(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def evaluate_task(
+        pddl_env: PDDLEnv,
+        target_domain_pddl: str,
+        target_problem_pddl: str,
+        target_gen_domain_pddl: str,
+        target_gen_problem_pddl: str,
+        exp_flags: ConfigDict,
+        plan_gen: bool = True,
+        random_walks: bool = True,
+) -> TaskResult:
+    # The plan search also tells whether the generated domain is valid, which the random walks need
+    gen_plan, is_domain_valid, _ = pddl_env.search_plan(target_gen_domain_pddl, target_gen_problem_pddl)
+    task_result = TaskResult(is_domain_valid=is_domain_valid, is_plan_valid=False)
+    if plan_gen and gen_plan is not None:
+        task_result.is_plan_valid, _ = pddl_env.validate_plan(target_domain_pddl, target_problem_pddl, gen_plan)
+    if random_walks:
+        dummy_pred_desc = """def describe_predicate(*args, **kwargs): return ("", "")"""
         task_evaluator = PlanningEvaluator(
-            env=pddl_env, target_domain_pddl=target_domain_pddl, target_problem_pddl=t_gt_p,
-            target_gen_problem_pddl=t_gen_p, rw_feedback=True, predicate_descriptor_py=dummy_pred_desc,
+            env=pddl_env, target_domain_pddl=target_domain_pddl, target_problem_pddl=target_problem_pddl,
+            target_gen_problem_pddl=target_gen_problem_pddl, rw_feedback=True, predicate_descriptor_py=dummy_pred_desc,
             exp_flags=exp_flags, bi_rw_feedback=True,
         )
-        _, t_to_gen_frac, gen_to_t_frac = task_evaluator.evaluate_generated_domain_with_random_walks(
-            target_gen_domain_pddl
-        )
-        t_to_gen_scores.append(t_to_gen_frac)
-        gen_to_t_score.append(gen_to_t_frac)
-    t_to_gen_frac = mean(t_to_gen_scores)
-    gen_to_t_frac = mean(gen_to_t_score)
+        _, task_result.t_to_gen_frac, task_result.gen_to_t_frac = \
+            task_evaluator.evaluate_generated_domain_with_random_walks(
+                target_gen_domain_pddl, is_domain_valid=is_domain_valid
+            )
+    return task_result
+
+
+def aggregate_plan_gen_score(task_results: List[TaskResult]):
+    return mean([float(task_result.is_plan_valid) for task_result in task_results])
+
+
+def aggregate_random_walk_scores(task_results: List[TaskResult]):
+    t_to_gen_frac = mean([task_result.t_to_gen_frac for task_result in task_results])
+    gen_to_t_frac = mean([task_result.gen_to_t_frac for task_result in task_results])
     final_score = harmonic_mean(t_to_gen_frac, gen_to_t_frac)
     logging.info(f"Random walk scores on all tasks: {final_score}")
 
     return final_score, t_to_gen_frac, gen_to_t_frac
 
 
-def _get_best_of_n_responses(gpt_client, planning_evaluator, pddl_obj, conv_id, user_input, n_completions):
+def _get_best_of_n_responses(
+        gpt_client, planning_evaluator, pddl_obj, conv_id, user_input, n_completions, stream=False,
+        stop_at_code_end=False, history_policy=None, rating_workers=1, stop_rating_at_solution=False,
+        speculation=None, on_best_so_far=None
+):
+    """
+    Samples n completions of the conversation and returns the best rated one. The completions may come from a
+    speculative request of the previous turn, and on_best_so_far(conv_id, evaluation) is called whenever a
+    completion becomes the best rated so far (the first one in case of ties), before the others are rated.
+    """
+    if stream:
+        return _get_best_of_n_streamed_responses(
+            gpt_client, planning_evaluator, pddl_obj, conv_id, user_input, n_completions, stop_at_code_end,
+            history_policy
+        )
     if n_completions == 1:
-        best_conv_id, gpt_output, _ = gpt_client.complete_one_chat(conv_id, user_input)
+        best_conv_id, gpt_output, _ = gpt_client.complete_one_chat(conv_id, user_input, history_policy=history_policy)
         planning_evaluation = planning_evaluator.rate_domain_modification(
             pddl_obj, gpt_output
         )
         return best_conv_id, planning_evaluation, {"all_conv_ids": [best_conv_id],
                                                    "all_ratings": [planning_evaluation.rating]}
     else:
-        conv_ids, gpt_outputs, _ = gpt_client.complete_n_chats(
-            conv_id, user_input, n_completions, temp=STOCHASTIC_TEMPERATURE
+        speculative_result = speculation.take(conv_id, user_input) if speculation is not None else None
+        if speculative_result is not None:
+            conv_ids, gpt_outputs, _ = speculative_result
+        else:
+            conv_ids, gpt_outputs, _ = gpt_client.complete_n_chats(
+                conv_id, user_input, n_completions, temp=STOCHASTIC_TEMPERATURE, history_policy=history_policy
+            )
+        rated_evaluations, best_rated_idx = {}, None
+
+        def on_evaluation(i, planning_evaluation):
+            nonlocal best_rated_idx
+            rated_evaluations[i] = planning_evaluation
+            best_rated = rated_evaluations.get(best_rated_idx)
+            if best_rated is None or (planning_evaluation.rating, -i) > (best_rated.rating, -best_rated_idx):
+                best_rated_idx = i
+                on_best_so_far(conv_ids[i], planning_evaluation)
+
+        all_evaluations = planning_evaluator.rate_domain_modifications(
+            pddl_obj, gpt_outputs, n_workers=rating_workers, stop_at_solution=stop_rating_at_solution,
+            on_evaluation=on_evaluation if on_best_so_far is not None else None
         )
-        all_evaluations = []
         best_evaluation = None
         best_conv_id = None
         for i in range(n_completions):
-            gpt_output = gpt_outputs[i]
-            planning_evaluation = planning_evaluator.rate_domain_modification(
-                pddl_obj, gpt_output
-            )
-            all_evaluations.append(planning_evaluation)
+            planning_evaluation = all_evaluations[i]
+            if planning_evaluation is None:  # Not rated, since an earlier completion found a solution
+                continue
             logging.info(f"Rating for completion {i}: {planning_evaluation.rating}")
             if best_evaluation is None or planning_evaluation.rating > best_evaluation.rating:
                 best_evaluation = planning_evaluation
                 best_conv_id = conv_ids[i]
         return best_conv_id, best_evaluation, {"all_conv_ids": conv_ids,
-                                               "all_ratings": [e.rating for e in all_evaluations]}
+                                               "all_ratings": [e.rating if e is not None else None
+                                                               for e in all_evaluations]}
+
+
+def _get_best_of_n_streamed_responses(
+        gpt_client, planning_evaluator, pddl_obj, conv_id, user_input, n_completions, stop_at_code_end,
+        history_policy=None
+):
+    """
+    Rates each completion as soon as its python code block has been streamed, so rating overlaps generation.
+    A completion is rated again when it finishes only if its final code differs from the code that was rated.
+    """
+    temp = DETERMINISTIC_TEMPERATURE if n_completions == 1 else STOCHASTIC_TEMPERATURE
+    conv_ids = [None] * n_completions
+    evaluations = [None] * n_completions
+    rated_codes = [None] * n_completions
+    for i, choice_conv_id, content, is_final in gpt_client.stream_n_chats(
+            conv_id, user_input, n_completions, temp=temp, code_lang='python', stop_at_code_end=stop_at_code_end,
+            history_policy=history_policy
+    ):
+        conv_ids[i] = choice_conv_id
+        code = _extract_code_or_none(content)
+        if evaluations[i] is not None and code == rated_codes[i]:
+            continue
+        evaluations[i] = planning_evaluator.rate_domain_modification(pddl_obj, content)
+        rated_codes[i] = code
+        logging.info(f"Rating for completion {i} (final: {is_final}): {evaluations[i].rating}")
+    best_idx = max(range(n_completions), key=lambda i: (evaluations[i].rating, -i))
+    return conv_ids[best_idx], evaluations[best_idx], {"all_conv_ids": conv_ids,
+                                                       "all_ratings": [e.rating for e in evaluations]}
+
+
+def _extract_code_or_none(content):
+    try:
+        return extract_code(content, lang='python')
+    except ValueError:
+        return None
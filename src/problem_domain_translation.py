@@ -6,11 +6,13 @@
 #
 
 import logging
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from typing import List
 
 from ml_collections import ConfigDict
 
 import prompts
+from concurrency import submit_in_context, wait_for_future
 from domains import Domain
 from gpt_client import GPTClient
 from pddl_utils import validate_problem_pddl
@@ -149,21 +151,59 @@ def translate_problems_given_one_task(
         context_problem_template_pddl: str,
         target_problem_nls: List[str],
         target_problem_templates: List[str],
+        n_workers: int = 1,
 ):
-    system_message = prompts.PROBLEM_TRANSLATION_SYSTEM_MESSAGE
-    results = []
-    for target_problem_nl, target_problem_template in zip(target_problem_nls, target_problem_templates):
-        prompt = prompts.ONE_SHOT_PROBLEM_TRANSLATION_PROMPT.format(
-            domain_nl=wrap_code(domain_nl, lang='markdown'),
-            domain_pddl=wrap_code(domain_pddl, lang='pddl'),
-            context_problem_nl=wrap_code(context_problem_nl, lang='markdown'),
-            context_problem_pddl=wrap_code(context_problem_pddl, lang='pddl'),
-            context_problem_template_pddl=wrap_code(context_problem_template_pddl, lang='pddl'),
-            target_problem_nl=wrap_code(target_problem_nl, lang='markdown'),
-            target_problem_template_pddl=wrap_code(target_problem_template, lang='pddl'),
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = submit_problem_translations(
+            executor, gpt_client, domain_pddl, domain_nl, context_problem_pddl, context_problem_nl,
+            context_problem_template_pddl, target_problem_nls, target_problem_templates
         )
-        conv_id, _ = gpt_client.make_new_chat(system_message=system_message)
-        conv_id, gpt_output, _ = gpt_client.complete_one_chat(conv_id, prompt)
-        generated_pddl = extract_code(gpt_output, lang='pddl')
-        results.append(generated_pddl)
-    return results
+        return [wait_for_future(future) for future in futures]
+
+
+def submit_problem_translations(
+        executor: Executor,
+        gpt_client: GPTClient,
+        domain_pddl: str,
+        domain_nl: str,
+        context_problem_pddl: str,
+        context_problem_nl,
+        context_problem_template_pddl: str,
+        target_problem_nls: List[str],
+        target_problem_templates: List[str],
+) -> List[Future]:
+    """
+    Submits the translation of each target problem to the executor, in order, and returns their futures, so that
+    the translated problems can be used (e.g. planned on) as soon as each one is ready.
+    """
+    return [
+        submit_in_context(
+            executor, translate_problem_given_one_task, gpt_client, domain_pddl, domain_nl, context_problem_pddl,
+            context_problem_nl, context_problem_template_pddl, target_problem_nl, target_problem_template
+        )
+        for target_problem_nl, target_problem_template in zip(target_problem_nls, target_problem_templates)
+    ]
+
+
+def translate_problem_given_one_task(
+        gpt_client: GPTClient,
+        domain_pddl: str,
+        domain_nl: str,
+        context_problem_pddl: str,
+        context_problem_nl,
+        context_problem_template_pddl: str,
+        target_problem_nl: str,
+        target_problem_template: str,
+) -> str:
+    prompt = prompts.ONE_SHOT_PROBLEM_TRANSLATION_PROMPT.format(
+        domain_nl=wrap_code(domain_nl, lang='markdown'),
+        domain_pddl=wrap_code(domain_pddl, lang='pddl'),
+        context_problem_nl=wrap_code(context_problem_nl, lang='markdown'),
+        context_problem_pddl=wrap_code(context_problem_pddl, lang='pddl'),
+        context_problem_template_pddl=wrap_code(context_problem_template_pddl, lang='pddl'),
+        target_problem_nl=wrap_code(target_problem_nl, lang='markdown'),
+        target_problem_template_pddl=wrap_code(target_problem_template, lang='pddl'),
+    )
+    conv_id, _ = gpt_client.make_new_chat(system_message=prompts.PROBLEM_TRANSLATION_SYSTEM_MESSAGE)
+    conv_id, gpt_output, _ = gpt_client.complete_one_chat(conv_id, prompt)
+    return extract_code(gpt_output, lang='pddl')
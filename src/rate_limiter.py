@@ -0,0 +1,132 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+class TokenBucketRateLimiter:
+    """
+    Proactive requests-per-minute (RPM) and tokens-per-minute (TPM) limiter. Each call reserves its capacity up
+    front, possibly driving a bucket into debt, and then waits until the debt has been refilled. Reservations are
+    therefore served in arrival order, and the buckets are kept close to fully utilized without exceeding the quota.
+    If state_path is given, the bucket levels are kept in that file under an exclusive lock, so that all processes
+    using the same file share one quota. Once the actual usage of a call is known, the difference with its
+    reservation is given back (or charged) with adjust_tokens.
+    """
+
+    def __init__(self, rpm: float, tpm: float, state_path: str = ''):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.state_path = state_path
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.n_acquired = 0
+        self._lock = threading.Lock()
+        self._state = {'requests': float(rpm), 'tokens': float(tpm), 'time': time.time()}
+
+    async def acquire(self, n_tokens: int) -> float:
+        """
+        Reserves one request and n_tokens tokens, and waits until they are available. Returns the waited seconds.
+        The reservation runs in a worker thread, so that waiting for the lock of a busy peer process does not stall
+        the other requests of the event loop.
+        """
+        wait_seconds = await asyncio.get_running_loop().run_in_executor(None, self.reserve, n_tokens)
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+    def acquire_sync(self, n_tokens: int) -> float:
+        wait_seconds = self.reserve(n_tokens)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    def reserve(self, n_tokens: int) -> float:
+        with self._lock:
+            wait_seconds = self._update_state(lambda state: self._reserve(state, n_tokens))
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            self.n_acquired += 1
+        return wait_seconds
+
+    def _reserve(self, state: dict, n_tokens: int):
+        now = time.time()
+        elapsed = max(0.0, now - state['time'])
+        new_state = {'time': now}
+        wait_seconds = 0.0
+        for bucket, capacity, amount in [('requests', self.rpm, 1), ('tokens', self.tpm, n_tokens)]:
+            if capacity <= 0:  # This limit is disabled
+                new_state[bucket] = state[bucket]
+                continue
+            refill_per_second = capacity / 60.0
+            level = min(capacity, state[bucket] + elapsed * refill_per_second)
+            level -= min(amount, capacity)  # A single call larger than the budget only has to wait for a full bucket
+            new_state[bucket] = level
+            if level < 0:
+                wait_seconds = max(wait_seconds, -level / refill_per_second)
+        return new_state, wait_seconds
+
+    def adjust_tokens(self, n_tokens: int):
+        """
+        Gives back n_tokens reserved tokens that a call did not use (e.g. it was cancelled, failed or produced fewer
+        tokens than its maximum), or charges more tokens if n_tokens is negative. Blocks on the state file lock, so
+        callers on an event loop should run it in an executor.
+        """
+        if self.tpm <= 0 or n_tokens == 0:
+            return
+        with self._lock:
+            self._update_state(lambda state: ({**state, 'tokens': min(self.tpm, state['tokens'] + n_tokens)}, None))
+
+    def _update_state(self, update_fn):
+        """
+        Applies update_fn(state) -> (new state, result) to the bucket levels, in the state file if there is one, and
+        returns the result. The caller holds self._lock.
+        """
+        if not self.state_path:
+            self._state, result = update_fn(self._state)
+            return result
+        with open(self.state_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                state = json.loads(content) if content.strip() else dict(self._state)
+                state, result = update_fn(state)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def get_metrics(self) -> dict:
+        return {
+            'rate_limit_acquired': self.n_acquired,
+            'rate_limit_total_wait_seconds': self.total_wait_seconds,
+            'rate_limit_mean_wait_seconds': self.total_wait_seconds / max(1, self.n_acquired),
+            'rate_limit_max_wait_seconds': self.max_wait_seconds,
+        }
+
+
+def get_rate_limiter(model_name: str, rpm: float, tpm: float, state_path: str = '') -> TokenBucketRateLimiter:
+    """
+    Returns the limiter shared by all clients of a model in this process (and across processes, via state_path).
+    """
+    key = (model_name, rpm, tpm, os.path.abspath(state_path) if state_path else '')
+    with _RATE_LIMITERS_LOCK:
+        if key not in _RATE_LIMITERS:
+            _RATE_LIMITERS[key] = TokenBucketRateLimiter(rpm, tpm, state_path)
+        return _RATE_LIMITERS[key]
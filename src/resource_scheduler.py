@@ -0,0 +1,242 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Process-wide admission control of the work that runs concurrently (problem candidates, best-of-n ratings, task
+evaluations and the runs of experiment_grid.py): planner searches, plan validations, random walk subprocesses and
+groundings reserve cores and memory in PDDLEnv, and LLM requests reserve a slot in GPTClient. Resources are only
+reserved by these leaf operations, never while holding another reservation, so the scheduler cannot deadlock.
+
+Waiting requests are admitted by priority (lower first, then in arrival order). A request is only overtaken by a
+lower-priority one that does not need any of the resources it is waiting for, so that e.g. LLM requests are not
+held up by planner searches waiting for memory. The priority of a job is carried by a context variable, like its
+cancel token (see concurrency.py): the refinement of the currently best problem candidate runs first.
+"""
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import itertools
+import os
+import threading
+import time
+
+from concurrency import POLL_INTERVAL_SECONDS, raise_if_cancelled
+
+RESOURCES = ('cores', 'memory_mb', 'llm_slots')
+
+_PRIORITY = contextvars.ContextVar('priority', default=0.0)
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_priority() -> float:
+    return _PRIORITY.get()
+
+
+@contextlib.contextmanager
+def priority_scope(priority: float):
+    reset_token = _PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(reset_token)
+
+
+async def with_priority(coro, priority: float):
+    """
+    Awaits the coroutine with the given priority, e.g. the caller's priority on the event loop of another thread.
+    """
+    with priority_scope(priority):
+        return await coro
+
+
+class _Request:
+    __slots__ = ('amounts', 'priority', 'seq', 'granted', 'event', 'waker', 'submit_time')
+
+    def __init__(self, amounts: dict, priority: float, seq: int, waker=None):
+        self.amounts = amounts
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+        self.event = threading.Event()
+        self.waker = waker
+        self.submit_time = time.time()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class ResourceScheduler:
+    """
+    Tracks the cores, memory (in MB) and LLM request slots in use. A capacity of 0 leaves the resource unlimited.
+    Requests for more than the capacity of a resource are reduced to the capacity, so that they can run alone.
+    """
+
+    def __init__(self, cores: int = 0, memory_mb: int = 0, llm_slots: int = 0):
+        self.capacities = {'cores': cores, 'memory_mb': memory_mb, 'llm_slots': llm_slots}
+        self.used = {resource: 0 for resource in RESOURCES}
+        self.peak_used = {resource: 0 for resource in RESOURCES}
+        self.wait_seconds = {resource: 0.0 for resource in RESOURCES}
+        self.n_requests = 0
+        self._waiting = []  # Sorted by (priority, seq)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def acquire(self, **amounts):
+        """
+        Reserves the resources for the duration of the block, waiting for them if needed. Raises OperationCancelled
+        if the current job is cancelled while waiting.
+        """
+        request = self._submit(amounts, get_priority())
+        try:
+            while not request.event.wait(POLL_INTERVAL_SECONDS):
+                raise_if_cancelled()
+            yield
+        finally:
+            self._release(request)
+
+    @contextlib.asynccontextmanager
+    async def acquire_async(self, **amounts):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        request = self._submit(amounts, get_priority(), waker=wake)
+        try:
+            await granted
+            yield
+        finally:
+            self._release(request)
+
+    def _submit(self, amounts: dict, priority: float, waker=None) -> _Request:
+        for resource in amounts:
+            assert resource in RESOURCES, f"Unknown resource: {resource}"
+        amounts = {
+            resource: min(amount, self.capacities[resource]) for resource, amount in amounts.items()
+            if amount > 0 and self.capacities[resource] > 0
+        }
+        request = _Request(amounts, priority, next(self._seq), waker)
+        with self._lock:
+            self.n_requests += 1
+            bisect.insort(self._waiting, request)
+            self._dispatch()
+        return request
+
+    def _release(self, request: _Request):
+        with self._lock:
+            if request.granted:
+                for resource, amount in request.amounts.items():
+                    self.used[resource] -= amount
+            else:
+                self._waiting.remove(request)
+            self._dispatch()
+
+    def _dispatch(self):
+        # Resources that a waiting request of higher priority could not get
+        blocked_resources = set()
+        still_waiting = []
+        for request in self._waiting:
+            fits = all(self.used[resource] + amount <= self.capacities[resource]
+                       for resource, amount in request.amounts.items())
+            if not fits or blocked_resources.intersection(request.amounts):
+                blocked_resources.update(request.amounts)
+                still_waiting.append(request)
+                continue
+            wait_seconds = time.time() - request.submit_time
+            for resource, amount in request.amounts.items():
+                self.used[resource] += amount
+                self.peak_used[resource] = max(self.peak_used[resource], self.used[resource])
+                self.wait_seconds[resource] += wait_seconds
+            request.granted = True
+            request.event.set()
+            if request.waker is not None:
+                request.waker()
+        self._waiting = still_waiting
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {
+                'capacities': dict(self.capacities),
+                'peak_used': dict(self.peak_used),
+                'wait_seconds': dict(self.wait_seconds),
+                'n_requests': self.n_requests,
+                'n_waiting': len(self._waiting),
+            }
+
+
+def get_available_memory_mb() -> int:
+    """
+    Memory available to new work on this machine (MemAvailable on Linux), or 0 if it cannot be read.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def get_machine_capacities(n_processes: int = 1) -> dict:
+    """
+    Share of this machine's cores and available memory for each of n_processes runs sharing it.
+    """
+    return {
+        'cores': max(1, (os.cpu_count() or 1) // n_processes),
+        'memory_mb': get_available_memory_mb() // n_processes,
+    }
+
+
+def configure_scheduler(cores: int = 0, memory_mb: int = 0, llm_slots: int = 0):
+    """
+    Sets the process-wide scheduler, or disables scheduling if all capacities are 0. The current scheduler is kept
+    if its capacities are the same, so that the runs of one process share it.
+    """
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        capacities = {'cores': cores, 'memory_mb': memory_mb, 'llm_slots': llm_slots}
+        if all(capacity == 0 for capacity in capacities.values()):
+            _SCHEDULER = None
+        elif _SCHEDULER is None or _SCHEDULER.capacities != capacities:
+            _SCHEDULER = ResourceScheduler(**capacities)
+        return _SCHEDULER
+
+
+def get_scheduler():
+    return _SCHEDULER
+
+
+@contextlib.contextmanager
+def acquire_resources(**amounts):
+    """
+    Reserves the resources from the process-wide scheduler, if any.
+    """
+    scheduler = _SCHEDULER
+    if scheduler is None:
+        yield
+        return
+    with scheduler.acquire(**amounts):
+        yield
+
+
+@contextlib.asynccontextmanager
+async def acquire_resources_async(**amounts):
+    scheduler = _SCHEDULER
+    if scheduler is None:
+        yield
+        return
+    async with scheduler.acquire_async(**amounts):
+        yield
@@ -0,0 +1,129 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import List, Union
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of LLM completions, stored in a single sqlite file. Each sampled choice is stored
+    under a key derived from the request (model, messages, temperature, n, max_tokens) and its sample index.
+    Modes:
+        record: always query the model and store the responses.
+        replay: only serve from the cache (offline), fail on a miss.
+        read-through: serve from the cache, query the model for the missing samples and store them.
+    """
+    MODES = ('off', 'record', 'replay', 'read-through')
+
+    def __init__(self, path: str, mode: str, max_size_mb: float = 1024):
+        assert mode in self.MODES, f"Unknown cache mode: {mode}"
+        self.path = path
+        self.mode = mode
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # Running total of the entry sizes, so that puts do not scan the table. Other processes sharing the file are
+        # not counted, so the total is recomputed before evicting.
+        self._total_size = self._get_total_size()
+
+    @property
+    def reads_enabled(self):
+        return self.mode in ('replay', 'read-through')
+
+    @property
+    def writes_enabled(self):
+        return self.mode in ('record', 'read-through')
+
+    @staticmethod
+    def make_keys(model: str, messages: list, temperature: float, n: int, max_tokens: int) -> List[str]:
+        request_str = json.dumps(
+            {'model': model, 'messages': messages, 'temperature': temperature, 'n': n, 'max_tokens': max_tokens},
+            sort_keys=True
+        )
+        return [hashlib.sha256(f"{request_str}#{i}".encode('utf-8')).hexdigest() for i in range(n)]
+
+    def get_many(self, keys: List[str]) -> List[Union[dict, None]]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall()
+            found = {key: json.loads(zlib.decompress(value)) for key, value in rows}
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?", [(time.time(), key) for key in found]
+            )
+            self._conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, keys: List[str], values: List[dict]):
+        if len(keys) == 0:
+            return
+        now = time.time()
+        rows = []
+        for key, value in zip(keys, values):
+            blob = zlib.compress(json.dumps(value).encode('utf-8'))
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            replaced_size, = self._conn.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE key IN ({','.join('?' * len(rows))})",
+                [row[0] for row in rows]
+            ).fetchone()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            self._total_size += sum(row[2] for row in rows) - replaced_size
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+
+    def _get_total_size(self) -> int:
+        total_size, = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return total_size
+
+    def _evict(self):
+        total_size = self._get_total_size()
+        if total_size <= self.max_size_bytes:
+            self._total_size = total_size
+            return
+        # Evict the least recently used entries until the cache is back under 90% of its budget
+        target_size = int(0.9 * self.max_size_bytes)
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total_size <= target_size:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+            evicted += 1
+        self._conn.commit()
+        self._total_size = total_size
+        logging.info(f"Evicted {evicted} entries from the response cache at {self.path}.")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
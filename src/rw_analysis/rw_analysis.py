@@ -6,6 +6,7 @@
 #
 
 import multiprocessing
+from collections import Counter
 
 from absl import app
 import os
@@ -18,7 +19,7 @@ sys.path.append('../')
 
 from ml_collections import ConfigDict, config_flags
 from domains import Domain, PDDLEnv
-from pddl_utils import PDDLObj
+from pddl_utils import FormulaInterner, PDDLObj
 import numpy as np
 import uuid
 
@@ -60,20 +61,17 @@ def _get_operands(precond_effect):
 
 
 def compare_domain_actions(domain, pddl1, pddl2):
-    def compare_clause_list(lst1, lst2):
-        clause_strs1 = set({str(clause) for clause in lst1})
-        clause_strs2 = set({str(clause) for clause in lst2})
-        return len(clause_strs1.symmetric_difference(clause_strs2))
-
     n_diff = 0
     pddl_obj1 = PDDLObj.from_pddl_str(pddl1, domain.get_domain_template_pddl())
     pddl_obj2 = PDDLObj.from_pddl_str(pddl2, domain.get_domain_template_pddl())
     action_names = {action.name for action in pddl_obj1.domain_pddl.actions}
+    interner = FormulaInterner()
     for action_name in action_names:
-        action1 = pddl_obj1.get_action_by_name(action_name)
-        action2 = pddl_obj2.get_action_by_name(action_name)
-        n_diff += compare_clause_list(_get_operands(action1._precondition), _get_operands(action2._precondition))
-        n_diff += compare_clause_list(_get_operands(action1._effect), _get_operands(action2._effect))
+        for clause_ids1, clause_ids2 in zip(
+                pddl_obj1.get_action_clause_ids(action_name, interner),
+                pddl_obj2.get_action_clause_ids(action_name, interner)
+        ):
+            n_diff += len(clause_ids1.symmetric_difference(clause_ids2))
     return n_diff
 
 
@@ -103,29 +101,59 @@ def create_random_domain_removed(domain: Domain, total_remove):
     return pddl_obj.to_str()
 
 
+class _ClauseList:
+    """
+    Top-level clauses of a precondition or an effect, tracked as interned ids and counts while clauses are removed.
+    """
+
+    def __init__(self, clauses, interner: FormulaInterner):
+        self.clauses = clauses
+        self.clause_ids = interner.intern_all(clauses)
+        self.counts = Counter(self.clause_ids)
+        self.size = len(self.clause_ids)
+
+    def remove(self, clause_id, do_remove):
+        if self.size > 1 and self.counts[clause_id] > 0:
+            if do_remove:
+                self.counts[clause_id] -= 1
+                self.size -= 1
+            return 1
+        return 0
+
+    def apply(self):
+        # Like list.remove, which removes the first occurrences of duplicate clauses
+        remaining = Counter(self.counts)
+        kept = []
+        for clause, clause_id in zip(reversed(self.clauses), reversed(self.clause_ids)):
+            if remaining[clause_id] > 0:
+                remaining[clause_id] -= 1
+                kept.append(clause)
+        self.clauses[:] = kept[::-1]
+
+
 def create_random_pair_removed(domain: Domain, total_remove, target_diff):
     pddl_objs = [PDDLObj.from_pddl_str(
         domain.get_domain_pddl(), domain.get_domain_template_pddl()
     ) for _ in range(2)]
     totals = [total_remove, total_remove + (total_remove - target_diff) % 2]
+    interner = FormulaInterner()
 
-    def _get_remove_fn(lst, element):
+    def _get_remove_fn(clause_list, clause_id):
         def remove_clause(do_remove):
-            if len(lst) > 1 and element in lst:
-                if do_remove:
-                    lst.remove(element)
-                return 1
-            return 0
+            return clause_list.remove(clause_id, do_remove)
 
         return remove_clause
 
     remove_fn_list = []
+    clause_lists = []
     for pddl_obj in pddl_objs:
         remove_fns = []
         for action in pddl_obj.domain_pddl.actions:
             for lst in [_get_operands(action._precondition), _get_operands(action._effect)]:
-                for i in range(len(lst)):
-                    remove_fns.append(_get_remove_fn(lst, lst[i]))
+                clause_list = _ClauseList(lst, interner)
+                clause_lists.append(clause_list)
+                for clause_id in clause_list.clause_ids:
+                    remove_fns.append(_get_remove_fn(clause_list, clause_id))
         remove_fn_list.append(remove_fns)
     max_removable = len(remove_fn_list[0]) - 2 * len(pddl_objs[0].domain_pddl.actions)
     assert max_removable >= 2 * target_diff, f"Cannot remove {target_diff} clauses from the domain"
@@ -152,6 +180,8 @@ def create_random_pair_removed(domain: Domain, total_remove, target_diff):
         ptr += 1
     if ptr == len(list_perm):
         raise ValueError("Cannot remove the target number of clauses")
+    for clause_list in clause_lists:
+        clause_list.apply()
     pddl_strs = [pddl_obj.to_str() for pddl_obj in pddl_objs]
     np.random.shuffle(pddl_strs)
     return pddl_strs[0], pddl_strs[1]
@@ -10,6 +10,8 @@ import os
 import uuid
 import multiprocessing
 
+from concurrency import join_process
+
 
 def postprocess(x):
     return x.strip()
@@ -53,6 +55,27 @@ def extract_code(text, lang):
         return "\n".join(code_blocks)
 
 
+def find_code_block_end(text, lang):
+    """
+    Returns the index right after the closing fence of the first complete code block in the text, or None if no
+    complete code block has been seen yet (e.g., in a partially streamed response).
+    """
+    code_start = f"```{lang}"
+    code_end = "```"
+    start = text.find(code_start)
+    if start == -1:
+        return None
+    end = text.find(code_end, start + len(code_start))
+    if end == -1:
+        return None
+    return end + len(code_end)
+
+
+def estimate_tokens(text):
+    # Rough estimate of ~4 characters per token for English text and code
+    return max(1, len(text) // 4)
+
+
 def safe_function_execute(func, *args):
     def _exec_func(q, f, *ar):
         res = f(*ar)
@@ -63,8 +86,8 @@ def safe_function_execute(func, *args):
     queue = multiprocessing.Queue()
     process = multiprocessing.Process(target=_exec_func, args=(queue, func, *args))
     process.start()
-    # Wait for the process to finish
-    process.join()
+    # Wait for the process to finish, or kill it if the current job is cancelled
+    join_process(process)
 
     # Retrieve the result from the queue
     try:
@@ -0,0 +1,232 @@
+# Copyright (c) 2024-present, Royal Bank of Canada.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""
+Work queue of experiment runs in a directory of a shared filesystem, so that the runs of a grid (see
+experiment_grid.py) can be spread over several nodes without a broker. Each job is a JSON file that moves between
+the pending/, running/, done/ and failed/ subdirectories by atomic renames, so exactly one worker claims it. A worker
+keeps a lease on its running job by touching the job file; jobs whose lease expired (e.g. their worker died) are
+moved back to pending/ by the other workers, and retried with cfg.resume so they continue from their checkpoint. A
+worker that loses the lease of its job aborts the run, since the job now belongs to another worker.
+
+Job files are plain JSON, so secrets are not submitted with the jobs: the workers read the API key from the
+OPENAI_API_KEY environment variable.
+
+python src/work_queue.py submit --queue /shared/queue --grid grids/paper_table_2.json --set env_args.fd_py_path=<path>
+OPENAI_API_KEY=<key> python src/work_queue.py work --queue /shared/queue --node_workers 2   # twice on each node
+python src/work_queue.py status --queue /shared/queue
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from checkpoint import atomic_write_json
+from concurrency import CancelToken, cancel_scope
+from experiment_grid import build_config, expand_grid, parse_overrides, run_one, split_machine_capacities
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+class DirectoryWorkQueue:
+    def __init__(self, root: str, lease_seconds: float = 600, max_attempts: int = 3):
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state: str, job_id: str) -> str:
+        return os.path.join(self.root, state, f"{job_id}.json")
+
+    def list_jobs(self, state: str):
+        return sorted(f_name[:-len(".json")] for f_name in os.listdir(os.path.join(self.root, state))
+                      if f_name.endswith(".json"))
+
+    def submit(self, script: str, overrides: dict, job_id: str = None) -> str:
+        # Job ids sort in submission order, which is the order in which jobs are claimed
+        job_id = job_id or f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        atomic_write_json(self._path('pending', job_id), {
+            'id': job_id, 'script': script, 'overrides': overrides, 'attempts': 0, 'errors': [],
+        })
+        return job_id
+
+    def claim(self):
+        """
+        Moves the first pending job to running/ and returns it, or returns None if there is no pending job.
+        """
+        for job_id in self.list_jobs('pending'):
+            pending_path, running_path = self._path('pending', job_id), self._path('running', job_id)
+            try:
+                # The rename keeps the modification time, so start the lease before the job shows up in running/,
+                # where another worker would otherwise see an old file as an expired lease
+                os.utime(pending_path)
+                os.rename(pending_path, running_path)
+                with open(running_path, 'r') as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+        return None
+
+    def heartbeat(self, job_id: str) -> bool:
+        """
+        Renews the lease of a running job. Returns False if the job is no longer running (its lease expired).
+        """
+        try:
+            os.utime(self._path('running', job_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, job: dict, error: str = None):
+        """
+        Moves a running job to done/, or after an error back to pending/ (or to failed/ after max_attempts).
+        """
+        if error is None:
+            try:
+                os.rename(self._path('running', job['id']), self._path('done', job['id']))
+            except FileNotFoundError:
+                logging.warning(f"Job {job['id']} finished after its lease expired, it may have run twice.")
+            return
+        self._retry(job['id'], error)
+
+    def requeue_expired(self):
+        """
+        Moves the running jobs whose lease expired back to pending/ (or to failed/ after max_attempts).
+        """
+        for job_id in self.list_jobs('running'):
+            try:
+                expired = time.time() - os.path.getmtime(self._path('running', job_id)) > self.lease_seconds
+            except FileNotFoundError:
+                continue
+            if expired:
+                logging.warning(f"The lease of job {job_id} expired, requeueing it.")
+                self._retry(job_id, "Lease expired")
+
+    def _retry(self, job_id: str, error: str):
+        # Take the job out of running/ first, so that only one worker retries it
+        retry_path = os.path.join(self.root, 'running', f"{job_id}.retry-{uuid.uuid4().hex[:8]}")
+        try:
+            os.rename(self._path('running', job_id), retry_path)
+        except FileNotFoundError:
+            return
+        with open(retry_path, 'r') as f:
+            job = json.load(f)
+        job['attempts'] += 1
+        job['errors'].append(error)
+        state = 'failed' if job['attempts'] >= self.max_attempts else 'pending'
+        atomic_write_json(self._path(state, job_id), job)
+        os.remove(retry_path)
+        logging.info(f"Job {job_id} moved to {state} after {job['attempts']} attempts.")
+
+    def get_counts(self) -> dict:
+        return {state: len(self.list_jobs(state)) for state in STATES}
+
+
+def _run_with_heartbeat(queue: DirectoryWorkQueue, job: dict, heartbeat_seconds: float, node_workers: int = 1):
+    """
+    Runs a job while renewing its lease. Returns the error of the run (None on success), and whether the lease was lost,
+    in which case the run is cancelled.
+    """
+    stop_event = threading.Event()
+    cancel_token = CancelToken()
+
+    def beat():
+        while not stop_event.wait(heartbeat_seconds):
+            if not queue.heartbeat(job['id']):
+                logging.error(f"Lost the lease of job {job['id']}, aborting its run.")
+                cancel_token.cancel()
+                return
+
+    heartbeat_thread = threading.Thread(target=beat, name="work-queue-heartbeat", daemon=True)
+    heartbeat_thread.start()
+    try:
+        overrides = dict(job['overrides'])
+        if job['attempts'] > 0 and 'resume' in build_config(job['script'], {}):
+            overrides['resume'] = True
+        # Capacities of the node this worker runs on, rather than of the node that submitted the job
+        split_machine_capacities(overrides, node_workers)
+        with cancel_scope(cancel_token):
+            error = run_one(job['script'], overrides)
+        return error, cancel_token.cancelled
+    finally:
+        stop_event.set()
+        heartbeat_thread.join()
+
+
+def work(queue: DirectoryWorkQueue, max_jobs: int = 0, poll_seconds: float = 30, node_workers: int = 1):
+    """
+    Runs jobs of the queue until no job is pending or running (or max_jobs jobs were run). Each run gets a
+    1/node_workers share of the cores and memory of the node.
+    """
+    worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    n_jobs = 0
+    while max_jobs <= 0 or n_jobs < max_jobs:
+        queue.requeue_expired()
+        job = queue.claim()
+        if job is None:
+            if len(queue.list_jobs('running')) == 0:
+                break
+            # Running jobs of other workers may still be requeued if their worker died
+            time.sleep(poll_seconds)
+            continue
+        logging.info(f"Worker {worker_name} running job {job['id']} (attempt {job['attempts'] + 1}): {job['script']} "
+                     f"{job['overrides']}")
+        error, lease_lost = _run_with_heartbeat(
+            queue, job, heartbeat_seconds=queue.lease_seconds / 4, node_workers=node_workers
+        )
+        n_jobs += 1
+        if lease_lost:
+            # The job was requeued, so its outcome is left to the worker that claims it next
+            continue
+        if error is not None:
+            logging.error(f"Job {job['id']} failed:\n{error}")
+        queue.complete(job, error)
+    logging.info(f"Worker {worker_name} stopping after {n_jobs} jobs, queue: {queue.get_counts()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared-directory work queue of experiment runs.")
+    parser.add_argument('command', choices=['submit', 'work', 'status'])
+    parser.add_argument('--queue', required=True, help="Queue directory, on a filesystem shared by the workers.")
+    parser.add_argument('--grid', help="JSON grid spec to submit, see experiment_grid.py.")
+    parser.add_argument('--set', action='append', default=[], help="key=value override applied to all runs.")
+    parser.add_argument('--lease_seconds', type=float, default=600, help="Lease of a running job without heartbeat.")
+    parser.add_argument('--max_attempts', type=int, default=3)
+    parser.add_argument('--max_jobs', type=int, default=0, help="Stop a worker after this many jobs (0: no limit).")
+    parser.add_argument('--poll_seconds', type=float, default=30)
+    parser.add_argument('--node_workers', type=int, default=1, help="Workers started on this node, sharing it.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    queue = DirectoryWorkQueue(args.queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    if args.command == 'submit':
+        if args.grid is None:
+            raise ValueError("--grid is required to submit jobs")
+        with open(args.grid, 'r') as f:
+            runs = expand_grid(json.load(f))
+        global_overrides = parse_overrides(args.set)
+        for script, overrides in runs:
+            overrides.update(global_overrides)
+            if 'gpt_args.api_key' in overrides:
+                raise ValueError("Do not submit the API key with the jobs, set OPENAI_API_KEY on the workers instead")
+            build_config(script, overrides)  # Fail on unknown keys before submitting any job
+        for script, overrides in runs:
+            queue.submit(script, overrides)
+        logging.info(f"Submitted {len(runs)} jobs to {args.queue}")
+    elif args.command == 'work':
+        work(queue, max_jobs=args.max_jobs, poll_seconds=args.poll_seconds, node_workers=args.node_workers)
+    print(json.dumps(queue.get_counts()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import time
+import types
+
+import pytest
+
+pytest.importorskip('wandb')
+
+import main
+import work_queue
+from concurrency import raise_if_cancelled
+
+
+class _FakeWandbRun:
+    def __init__(self):
+        self.exit_code = None
+        self.summary = {}
+
+    def finish(self, exit_code=0):
+        self.exit_code = exit_code
+
+    def save(self, *args):
+        pass
+
+    def log(self, *args, **kwargs):
+        pass
+
+
+def test_lost_lease_cancels_run_and_next_run_gets_fresh_wandb_run(tmp_path, monkeypatch):
+    wandb_runs = []
+
+    def init(**kwargs):
+        wandb_runs.append(_FakeWandbRun())
+        fake_wandb.run = wandb_runs[-1]
+        return wandb_runs[-1]
+
+    fake_wandb = types.SimpleNamespace(init=init, config=types.SimpleNamespace(update=lambda *args: None), run=None)
+    monkeypatch.setattr(main, 'wandb', fake_wandb)
+    queue = work_queue.DirectoryWorkQueue(str(tmp_path / 'queue'), lease_seconds=0.4)
+    overrides = {'exp_path': str(tmp_path / 'experiments'), 'gpt_args.backend': 'mock', 'debug': True}
+    lost_job_id = queue.submit('main', {**overrides, 'log_prefix': 'lost'})
+    queue.submit('main', {**overrides, 'log_prefix': 'next'})
+    gpt_clients = []
+
+    def run_experiment(cfg, run_exp_dir, summary_log_path, wandb_run, gpt_client, translation_executor):
+        gpt_clients.append(gpt_client)
+        conv_id, _ = gpt_client.make_new_chat("You are a helpful assistant.")
+        gpt_client.complete_one_chat(conv_id, "Hello")
+        if cfg.log_prefix == 'lost':
+            # Another worker requeues the job, as if its lease had expired
+            os.rename(queue._path('running', lost_job_id), queue._path('failed', lost_job_id))
+            while True:
+                raise_if_cancelled()
+                time.sleep(0.01)
+
+    monkeypatch.setattr(main, '_run_experiment', run_experiment)
+    work_queue.work(queue, max_jobs=2, poll_seconds=0.1)
+
+    assert len(wandb_runs) == 2 and wandb_runs[0] is not wandb_runs[1]
+    assert wandb_runs[0].exit_code == 1
+    assert wandb_runs[1].exit_code is None  # Finished by the run itself, which the stub above skips
+    assert all(gpt_client._loop is None for gpt_client in gpt_clients)
+    assert queue.get_counts() == {'pending': 0, 'running': 0, 'done': 1, 'failed': 1}